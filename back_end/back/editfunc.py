@@ -6,6 +6,7 @@ import numpy as np
 import boto3
 from back.config import ConfigAWS, SHARPEN_KERNEL
 import base64
+import json
 from flask import request
 import logging
 
@@ -23,13 +24,75 @@ def home():
     return "home"
 
 
-def readb64(base64_string):
-    decoded_data = base64.b64decode(base64_string)
-    np_data = np.fromstring(decoded_data, np.uint8)
+def decodeImage(data):
+    np_data = np.frombuffer(data, np.uint8)
     img = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
     return img
 
 
+# Wire formats of the edit endpoints:
+#   json    {"image_path": <base64 image>, <parameters>} in, {"image_string": <base64 PNG>, <results>} out
+#   binary  the raw image in, with each parameter in an X-Edit-<Name> header (kernel_size -> X-Edit-Kernel-Size);
+#           the raw PNG out, with each further result JSON-encoded in an X-Edit-<Name> header
+# A request is answered in the format it was sent in. Every response carries X-Edit-Protocol, so the
+# front end knows this back end accepts the binary format.
+HEADER_PREFIX = 'X-Edit-'
+PROTOCOL_HEADER = 'X-Edit-Protocol'
+
+
+def headerName(name):
+    return HEADER_PREFIX + '-'.join(part.capitalize() for part in name.split('_'))
+
+
+def readEdit(image_field='image_path'):
+    """
+    Arguments:
+        image_field : key of the base64 image in a JSON request
+
+    Function:
+        Reads the image and the parameters of an edit request in either wire format
+
+    Returns:
+        the image bytes, and a dict of the parameters (strings in a binary request)
+    """
+    if request.is_json:
+        params = dict(request.json)
+        return base64.b64decode(params.pop(image_field)), params
+    params = {name[len(HEADER_PREFIX):].lower().replace('-', '_'): value
+              for name, value in request.headers.items()
+              if name.lower().startswith(HEADER_PREFIX.lower())}
+    return request.get_data(), params
+
+
+def writeEdit(image, **results):
+    """
+    Arguments:
+        image : the edited image
+        results : further results of the edit, e.g. the labels
+
+    Function:
+        Encodes the edited image as PNG and answers in the wire format of the request
+
+    Returns:
+        the response
+    """
+    png = cv2.imencode('.png', image)[1].tobytes()
+    if request.is_json:
+        data = {"image_string": base64.b64encode(png).decode('utf-8')}
+        data.update(results)
+        return data
+    response = webapp.response_class(response=png, status=200, mimetype='image/png')
+    for name, value in results.items():
+        response.headers[headerName(name)] = json.dumps(value)
+    return response
+
+
+@webapp.after_request
+def addProtocolHeader(response):
+    response.headers[PROTOCOL_HEADER] = 'binary'
+    return response
+
+
 @webapp.route('/resize_image', methods=['GET', 'POST'])
 # Resize an image by the given width and height
 def resize_image():
@@ -46,20 +109,17 @@ def resize_image():
         path to resized image
     """
     try:
-        image = request.json["image_path"]
-        image = readb64(image)
-        width = request.json["width"]
-        height = request.json["height"]
+        image, params = readEdit()
+        image = decodeImage(image)
+        width = int(params["width"])
+        height = int(params["height"])
 
         w = int(image.shape[1] * width / 100)
         h = int(image.shape[0] * height / 100)
 
         image_resized = cv2.resize(image, (w, h), interpolation=cv2.INTER_CUBIC)
 
-        image_string = cv2.imencode('.png', image_resized)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-        data = {"image_string": image_string}
-        return data
+        return writeEdit(image_resized)
     except Exception as e:
         logging.exception("Error occurred while resizing the image.")
         return {"error": "An error occurred while resizing the image."}, 500
@@ -79,14 +139,11 @@ def sharpen_image():
         path to sharpened image
     """
     try:
-        image = request.json["image_path"]
-        image = readb64(image)
+        image, params = readEdit()
+        image = decodeImage(image)
         sharpened_image = cv2.filter2D(image, -1, SHARPEN_KERNEL)
 
-        image_string = cv2.imencode('.png', sharpened_image)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-        data = {"image_string": image_string}
-        return data
+        return writeEdit(sharpened_image)
     except Exception as e:
         logging.exception("Error occurred while sharpening the image.")
         return {"error": "An error occurred while sharpening the image."}, 500
@@ -107,11 +164,11 @@ def blurr_image():
         path to blurred image
     """
     try:
-        kernel_size = request.json["kernel_size"]
-        filter_type = request.json["filter"]
+        image, params = readEdit()
+        kernel_size = int(params["kernel_size"])
+        filter_type = params["filter"]
         kernel = (kernel_size, kernel_size)
-        image = request.json["image_path"]
-        image = readb64(image)
+        image = decodeImage(image)
 
         if filter_type == 'averaging':
             blurred_image = cv2.blur(image, kernel)
@@ -120,11 +177,7 @@ def blurr_image():
         elif filter_type == 'median':
             blurred_image = cv2.medianBlur(image, kernel_size)
 
-        image_string = cv2.imencode('.png', blurred_image)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-
-        data = {"image_string": image_string}
-        return data
+        return writeEdit(blurred_image)
     except Exception as e:
         logging.exception("Error occurred while blurring the image.")
         return {"error": "An error occurred while blurring the image."}, 500
@@ -145,16 +198,12 @@ def rotate_image():
         path to rotated image
     """
     try:
-        image = request.json["image_path"]
-        image = readb64(image)
-        degree = request.json["degree"]
+        image, params = readEdit()
+        image = decodeImage(image)
+        degree = int(params["degree"])
         rotated_image = imutils.rotate_bound(image, degree)
 
-        image_string = cv2.imencode('.png', rotated_image)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-
-        data = {"image_string": image_string}
-        return data
+        return writeEdit(rotated_image)
     except Exception as e:
         logging.exception("Error occurred while rotating the image.")
         return {"error": "An error occurred while rotating the image."}, 500
@@ -174,9 +223,9 @@ def threshold_image():
         path to thresholded image
     """
     try:
-        image = request.json["image_path"]
-        image = readb64(image)
-        threshold_type = request.json["type"]
+        image, params = readEdit()
+        image = decodeImage(image)
+        threshold_type = params["type"]
         image = cv2.medianBlur(image, 5)
 
         if threshold_type == 'Binary':
@@ -185,11 +234,7 @@ def threshold_image():
             thresh = cv2.adaptiveThreshold(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 255, \
                                            cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
 
-        image_string = cv2.imencode('.png', thresh)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-
-        data = {"image_string": image_string}
-        return data
+        return writeEdit(thresh)
     except Exception as e:
         logging.exception("Error occurred while applying threshold to the image.")
         return {"error": "An error occurred while applying threshold to the image."}, 500
@@ -209,15 +254,11 @@ def grayscale_image():
         path to grayscale image
     """
     try:
-        image = request.json["image_path"]
-        image = readb64(image)
+        image, params = readEdit()
+        image = decodeImage(image)
         gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-        image_string = cv2.imencode('.png', gray_image)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-
-        data = {"image_string": image_string}
-        return data
+        return writeEdit(gray_image)
     except Exception as e:
         logging.exception("Error occurred while converting the image to grayscale.")
         return {"error": "An error occurred while converting the image to grayscale."}, 500
@@ -234,10 +275,9 @@ def get_label():
     """
     try:
         label_count = 3
-        image = request.json["image"]
-        image_cv = readb64(image)
+        image, params = readEdit('image')
+        image_cv = decodeImage(image)
         imgHeight, imgWidth, channels = image_cv.shape
-        image = base64.b64decode(image)
         response = client.detect_labels(
             Image={
                 'Bytes': image
@@ -273,19 +313,13 @@ def get_label():
                                 (int(boxLeft * imgWidth), (int(boxTop * imgHeight)) - 10), cv2.FONT_HERSHEY_SIMPLEX,
                                 0.85,
                                 color, thickness)
-        image_string = cv2.imencode('.png', image_cv)[1].tostring()
-        image_string = base64.b64encode(image_string).decode('utf-8')
-
         label_list = []
         confidence_list = []
         for label in response['Labels']:
             label_list.append(label['Name'])
             confidence_list.append(round(label['Confidence'], 2))
 
-        data = {"image_string": image_string,
-                "label_list": label_list,
-                "confidence_list": confidence_list}
-        return data
+        return writeEdit(image_cv, label_list=label_list, confidence_list=confidence_list)
     except Exception as e:
         logging.exception("Error occurred while generating labels for the image.")
         return {"error": "An error occurred while generating labels for the image."}, 500
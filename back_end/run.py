@@ -1,18 +1,24 @@
 """IMPORT FLASK INSTANCES FROM FOLDER FrontEnd"""
 
 from back import webapp as back
+import argparse
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)  # Set the desired log level
 logger = logging.getLogger(__name__)
 if __name__ == "__main__":
+    # several back ends can run side by side on one host, each on its own port, behind the
+    # front end's backendConfig['endpoints']
+    parser = argparse.ArgumentParser(description="Run the image editing back end.")
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
 
     # Run the Flask application
     try:
         back.run(
             host='0.0.0.0',
-            port='5001',
+            port=args.port,
             debug=False,  # Disable debug mode in production
             use_reloader=False,
             use_debugger=False,
@@ -1,5 +1,7 @@
 # Add the following import at the top of the file
 import pytest
+import cv2
+import numpy as np
 
 # Define a fixture for the Flask app
 @pytest.fixture
@@ -81,6 +83,13 @@ def test_get_label(client):
     assert "label_list" in response.json
     assert "confidence_list" in response.json
 
+def test_binary_format(client):
+    image = cv2.imencode('.png', np.zeros((8, 8, 3), np.uint8))[1].tobytes()
+    response = client.post('/rotate_image', data=image,
+                           headers={"Content-Type": "application/octet-stream", "X-Edit-Degree": "90"})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.headers['X-Edit-Protocol'] == 'binary'
 
 # Run the tests
 if __name__ == '__main__':
@@ -0,0 +1,525 @@
+import io
+import sys
+import time
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, redirect, url_for
+from werkzeug.exceptions import HTTPException, NotFound, InternalServerError
+from FrontEnd import webapp, main
+from FrontEnd.config import asgiConfig, backendConfig, memcacheConfig
+from FrontEnd.memcache import subGET, subPUT
+from FrontEnd.keyfilter import mayExist, recordMissing
+from FrontEnd.renditions import RENDITIONS
+from FrontEnd.backend_client import (client as edit_client, editEncoder, checkProtocol, decodeEdit,
+                                     RETRY_STATUSES, EDIT_ERRORS)
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - only the ASGI mode needs httpx (see requirements.txt)
+    httpx = None
+
+"""
+ASGI serving mode of the front end, for many concurrent requests per process:
+
+    uvicorn FrontEnd.asgi:app --host 0.0.0.0 --port 5000
+
+The routes that spend their time waiting on S3 or the back end (/image/<key>, /result/<token> and the
+edit routes) are coroutines on one event loop. They fetch and store S3 objects through presigned URLs
+and send edits to the back ends with an httpx.AsyncClient, so a request in flight holds a coroutine and
+a socket rather than an OS thread. They answer the same URLs, matched against the url_map of the Flask
+app, and render the same templates as their views in FrontEnd/main.py. The DynamoDB lookup of /image
+is short and runs in a thread.
+
+Every other route runs the Flask app itself in a pool of asgiConfig['threads'] threads, the way the
+threaded server runs it.
+"""
+
+# seconds a presigned S3 URL stays valid; each is used right after it is made
+PRESIGN_SECONDS = 300
+
+# runs the Flask app for the routes that are not coroutines, and blocking calls of the coroutines
+threads = ThreadPoolExecutor(max_workers=asgiConfig['threads'], thread_name_prefix='asgi')
+# the httpx.AsyncClient and AsyncBackendClient, made on startup inside the event loop
+http = None
+async_client = None
+# S3 uploads still running, referenced so they are not garbage-collected before they finish
+background = set()
+
+
+class AsyncBackendClient:
+    """
+    Coroutine counterpart of BackendClient, used by the edit routes.
+
+    Description:
+        Sends edit requests through an httpx.AsyncClient with the timeouts, retries and hedging of
+        BackendClient. It picks back ends from the pool of that client and counts its requests in the
+        statistics of that client, so the health checks, ejections and /backend/stats cover both serving
+        modes. The losing copy of a hedged request is cancelled rather than left running.
+    """
+
+    def __init__(self, sync, http_client):
+        self.sync = sync
+        self.http = http_client
+
+    async def _send(self, backend, endpoint, encode):
+        """Make one attempt on backend. Returns the response; raises httpx.TransportError."""
+        timeouts = backendConfig['timeouts']
+        kwargs = encode(backend.url)
+        if 'data' in kwargs:
+            # httpx takes a raw body as content
+            kwargs['content'] = kwargs.pop('data')
+        start = time.perf_counter()
+        try:
+            response = await self.http.post(backend.url + endpoint,
+                                            timeout=httpx.Timeout(timeouts.get(endpoint, timeouts['default']),
+                                                                  connect=backendConfig['connectTimeout']),
+                                            **kwargs)
+        except BaseException as e:
+            # cancelled hedges release their back end too, without counting as failures
+            self.sync.pool.release(backend, isinstance(e, httpx.TransportError))
+            raise
+        return self.sync.finish(backend, endpoint, response, start)
+
+    async def _attempt(self, endpoint, encode, tried):
+        """Make one attempt, hedged if it is slow. Returns the first answer; raises if both copies fail."""
+        backend = self.sync.pool.acquire(tried)
+        tried.add(backend.url)
+        delay = self.sync.hedge_delay(endpoint)
+        if delay is None:
+            return await self._send(backend, endpoint, encode)
+        first = asyncio.ensure_future(self._send(backend, endpoint, encode))
+        done, pending = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        with self.sync.lock:
+            self.sync.counters['hedges'] += 1
+        backend = self.sync.pool.acquire(tried)
+        tried.add(backend.url)
+        hedge = asyncio.ensure_future(self._send(backend, endpoint, encode))
+        pending = {first, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        with self.sync.lock:
+                            self.sync.counters['hedge_wins'] += 1
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def post(self, endpoint, encode):
+        """
+        POST an edit request to a back end; see BackendClient.post.
+
+        Returns:
+            httpx.Response: The response, with the base URL of the back end that answered in backend_url.
+            Raises httpx.TransportError if the last attempt could not connect or timed out.
+        """
+        start = time.perf_counter()
+        with self.sync.lock:
+            self.sync.counters['requests'] += 1
+            self.sync.outstanding += 1
+        tried = set()
+        try:
+            attempts = backendConfig['retries'] + 1
+            for attempt in range(attempts):
+                try:
+                    response = await self._attempt(endpoint, encode, tried)
+                    if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                        return response
+                    logging.info(f"Back end {response.backend_url} answered {endpoint} with "
+                                 f"{response.status_code}, retrying")
+                except httpx.TransportError as e:
+                    if attempt == attempts - 1:
+                        with self.sync.lock:
+                            self.sync.counters['failures'] += 1
+                        raise
+                    logging.info(f"Back-end request {endpoint} failed, retrying: {e}")
+                with self.sync.lock:
+                    self.sync.counters['retries'] += 1
+                await asyncio.sleep(random.uniform(0, backendConfig['retryBackoff'] * 2 ** attempt))
+        finally:
+            with self.sync.lock:
+                self.sync.outstanding -= 1
+                self.sync.latency.observe(time.perf_counter() - start)
+
+    async def edit_image(self, endpoint, image, image_field='image_path', **params):
+        """Have a back end edit an image; see editImage."""
+        encode = editEncoder(image, image_field, params)
+        response = await self.post(endpoint, encode)
+        if checkProtocol(response):
+            response = await self.post(endpoint, encode)
+        return decodeEdit(response)
+
+
+async def runSync(function, *args, **kwargs):
+    """Run a blocking call in the thread pool and return its result."""
+    return await asyncio.get_running_loop().run_in_executor(threads, lambda: function(*args, **kwargs))
+
+
+def cacheBlocks():
+    """Whether memcache calls wait on the network: the 'pool' backend asks the cache nodes over TCP."""
+    return memcacheConfig.get('backend', 'local') == 'pool'
+
+
+async def cacheGet(key):
+    """subGET without blocking the event loop: the memcache nodes are asked from a thread."""
+    if cacheBlocks():
+        return await runSync(subGET, key)
+    return subGET(key)
+
+
+async def cachePut(key, content, **kwargs):
+    """subPUT without blocking the event loop: the memcache nodes are written from a thread."""
+    if cacheBlocks():
+        return await runSync(subPUT, key, content, **kwargs)
+    return subPUT(key, content, **kwargs)
+
+
+def presign(operation, path):
+    """A presigned URL of an S3 operation on path; signing is local and does not block."""
+    return main.s3_client.generate_presigned_url(operation, Params={'Bucket': main.bucket_name, 'Key': path},
+                                                 ExpiresIn=PRESIGN_SECONDS)
+
+
+def persistLater(path, content):
+    """Save content to S3 under path in the background, like upload_to_S3."""
+    async def put():
+        try:
+            response = await http.put(presign('put_object', path), content=content)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logging.error(f"Error saving {path} to S3: {e}")
+
+    task = asyncio.ensure_future(put())
+    background.add(task)
+    task.add_done_callback(background.discard)
+
+
+async def streamObject(path, cache_key, version=None):
+    """
+    Respond with an S3 object, caching it in the memcache when it is small enough; see stream_object.
+
+    Returns:
+        Response or tuple: The response, or (the response, async iterator of its body) when it is streamed.
+        Raises NotFound if the object does not exist.
+    """
+    url = presign('get_object', path)
+    s3_object = await http.send(http.build_request('GET', url), stream=True)
+    if s3_object.status_code == 404:
+        await s3_object.aclose()
+        raise NotFound()
+    if s3_object.status_code >= 400:
+        await s3_object.aclose()
+        s3_object.raise_for_status()
+    if int(s3_object.headers['Content-Length']) <= main.max_buffered_size():
+        content = await s3_object.aread()
+        if not await cachePut(cache_key, content, version=version):
+            logging.info(f"Image {cache_key} not admitted to memcache")
+        return main.send_image(content)
+
+    etag = s3_object.headers['ETag'].strip('"')
+    status = 200
+    if request.if_none_match.contains(etag):
+        await s3_object.aclose()
+        status = 304
+    elif request.range is not None and request.if_range.date is None and request.if_range.etag in (None, etag):
+        await s3_object.aclose()
+        s3_object = await http.send(http.build_request('GET', url, headers={'Range': request.headers['Range']}),
+                                    stream=True)
+        status = 206 if 'Content-Range' in s3_object.headers else 200
+
+    response = webapp.response_class(
+        status=status,
+        mimetype=main.object_mimetype(path, {'ContentType': s3_object.headers.get('Content-Type')}))
+    if status != 304:
+        response.content_length = int(s3_object.headers['Content-Length'])
+        if status == 206:
+            response.headers['Content-Range'] = s3_object.headers['Content-Range']
+    response.set_etag(etag)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = main.IMAGE_CACHE_CONTROL
+    if status == 304:
+        return response
+
+    async def chunks():
+        try:
+            async for chunk in s3_object.aiter_bytes(main.IMAGE_CHUNK_SIZE):
+                yield chunk
+        finally:
+            await s3_object.aclose()
+
+    return response, chunks()
+
+
+async def serveImage(image_key):
+    """The /image/<key> route; see image in FrontEnd/main.py."""
+    rendition = request.args.get('rendition', 'original')
+    if rendition not in RENDITIONS:
+        rendition = 'original'
+    cache_key = image_key if rendition == 'original' else main.rendition_cache_key(image_key, rendition)
+    content = await cacheGet(cache_key)
+    if content:
+        return main.send_image(content)
+    if not mayExist(image_key):
+        raise NotFound()
+    response = await runSync(main.table.get_item, Key={'image_key': image_key})
+    if 'Item' not in response:
+        recordMissing(image_key)
+        raise NotFound()
+    path, source_key = main.gallery_source(response['Item'], rendition)
+    if source_key != cache_key:
+        content = await cacheGet(source_key)
+        if content:
+            return main.send_image(content)
+    return await streamObject(path, source_key, main.item_version(response['Item']))
+
+
+async def serveResult(token):
+    """The /result/<token> route; see edit_result in FrontEnd/main.py."""
+    content = await cacheGet(main.result_cache_key(token))
+    if not content:
+        content = await runSync(main.stored_result, token)
+    if not content:
+        raise NotFound()
+    return main.send_image(content)
+
+
+def blurCheck(form):
+    """The failure message of a blur form with an even kernel for a filter that needs an odd one, or None."""
+    if form.get('filter_type') in ('gaussian', 'median') and int(form['kernel_size']) % 2 == 0:
+        return "Kernel size should be an odd number for gaussian and median mode"
+    return None
+
+
+# Flask endpoint of an edit route -> its back-end endpoint, the form fields it needs, the parameters of the
+# edit made of the form, the result template, and an optional check of the form returning a failure message
+EDITS = {
+    'resize': ('/resize_image', ('width', 'height'),
+               lambda form: {'width': int(form['width']), 'height': int(form['height'])},
+               'show_image_resize.html', None),
+    'sharpen': ('/sharpen_image', (), lambda form: {}, 'show_image_after_process.html', None),
+    'blur': ('/blurr_image', ('kernel_size', 'filter_type'),
+             lambda form: {'kernel_size': int(form['kernel_size']), 'filter': form['filter_type']},
+             'show_image_after_process.html', blurCheck),
+    'rotate': ('/rotate_image', ('degree',), lambda form: {'degree': int(form['degree'])},
+               'show_image_after_process.html', None),
+    'grayscale': ('/grayscale_image', (), lambda form: {}, 'show_image_after_process.html', None),
+    'threshold': ('/threshold_image', ('threshold_type',), lambda form: {'type': form['threshold_type']},
+                  'show_image_after_process.html', None),
+    'detection': ('/get_label', (), lambda form: {}, 'show_label.html', None),
+}
+
+
+async def serveEdit():
+    """The edit routes, e.g. /image_resize; see resize in FrontEnd/main.py."""
+    name = request.endpoint
+    endpoint, fields, params, template, check = EDITS[name]
+    image_file = request.files.get('file')
+    if not image_file or any(not request.form.get(field) for field in fields):
+        return redirect(url_for('failure', msg="Missing information!"))
+    if image_file.filename == '':
+        return redirect(url_for('failure', msg="Fields cannot be empty!"))
+    if not main.allowed_file(image_file.filename):
+        return redirect(url_for('failure', msg="Image file type not supported"))
+    message = check(request.form) if check else None
+    if message:
+        return redirect(url_for('failure', msg=message))
+
+    image_path = "image/" + image_file.filename
+    original = image_file.read()
+    persistLater(image_path, original)
+    # the results are stored in the memcache and S3 from a thread, since either may block
+    edit_params = params(request.form)
+    try:
+        if name == 'detection':
+            content, results = await async_client.edit_image(endpoint, original, image_field='image')
+            labels = {'labels': results["label_list"], 'confidence': results["confidence_list"]}
+        else:
+            content, results = await async_client.edit_image(endpoint, original, **edit_params)
+            labels = {}
+    except EDIT_ERRORS + (httpx.HTTPError,) as e:
+        return main.edit_failed(endpoint, e)
+    saved = original if name == 'detection' else content
+    tokens = await runSync(main.stash_results, saved, content)
+    return main.render_result(template, saved, content, tokens, key=image_path, **labels)
+
+
+# Flask endpoint -> coroutine serving it, called with the arguments of the URL rule
+ROUTES = {'image': serveImage, 'edit_result': serveResult}
+ROUTES.update(dict.fromkeys(EDITS, serveEdit))
+
+
+async def readBody(receive):
+    """Read the whole body of an ASGI HTTP request."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def wsgiEnviron(scope, body):
+    """The WSGI environ of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+async def sendResponse(send, environ, response, chunks=None):
+    """Send a Flask response, with its body from chunks (an async iterator) if it is streamed."""
+    body, status, headers = response.get_wsgi_response(environ)
+    await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    try:
+        if chunks is not None and environ['REQUEST_METHOD'] != 'HEAD':
+            async for chunk in chunks:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            body = ()
+        await send({'type': 'http.response.body', 'body': b''.join(body)})
+    finally:
+        if chunks is not None:
+            await chunks.aclose()
+        response.close()
+
+
+async def runWSGI(environ, send):
+    """Serve a request with the Flask app in the thread pool, streaming its response."""
+    loop = asyncio.get_running_loop()
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+
+    body = await loop.run_in_executor(threads, webapp, environ, start_response)
+    try:
+        status, headers = started
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers]})
+        chunks = iter(body)
+        while True:
+            chunk = await loop.run_in_executor(threads, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(body, 'close'):
+            await loop.run_in_executor(threads, body.close)
+
+
+def startApp():
+    """Run the before_first_request functions of the Flask app (runOnAppStart), as its first request would."""
+    with webapp._before_request_lock:
+        if not webapp._got_first_request:
+            for function in webapp.before_first_request_funcs:
+                function()
+            webapp._got_first_request = True
+
+
+async def startup():
+    """Open the async HTTP client and start the app."""
+    global http, async_client
+    if httpx is None:
+        raise RuntimeError("The ASGI mode needs httpx; install the front-end requirements")
+    http = httpx.AsyncClient(limits=httpx.Limits(max_connections=asgiConfig['connections'],
+                                                 max_keepalive_connections=asgiConfig['keepAlive']))
+    async_client = AsyncBackendClient(edit_client, http)
+    await runSync(startApp)
+
+
+async def shutdown():
+    """Let the background S3 uploads finish and close the async HTTP client."""
+    if background:
+        await asyncio.wait(set(background))
+    await http.aclose()
+
+
+async def lifespan(receive, send):
+    """Handle the ASGI lifespan protocol."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as e:
+                logging.exception("Error starting the ASGI app")
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+
+    Description:
+        Requests to a route in ROUTES are served by its coroutine inside a request context of the Flask
+        app (request contexts are context variables, so each request task sees its own); all other
+        requests are passed to the Flask app in the thread pool.
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    environ = wsgiEnviron(scope, await readBody(receive))
+    with webapp.request_context(environ):
+        route = ROUTES.get(request.endpoint) if request.routing_exception is None else None
+        if route is not None:
+            try:
+                response = await route(**request.view_args)
+            except HTTPException as e:
+                response = e.get_response(environ)
+            except Exception:
+                logging.exception(f"Error serving {scope['path']}")
+                response = InternalServerError().get_response(environ)
+            chunks = None
+            if isinstance(response, tuple):
+                response, chunks = response
+            await sendResponse(send, environ, webapp.make_response(response), chunks)
+            return
+    await runWSGI(environ, send)
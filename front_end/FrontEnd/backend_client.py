@@ -0,0 +1,531 @@
+import json
+import time
+import base64
+import random
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+from FrontEnd.config import backendConfig
+from FrontEnd.metrics import Histogram, prometheus_text
+
+"""
+Wire formats of the back-end edit endpoints (back_end/back/editfunc.py):
+
+    binary  The request body is the raw image (Content-Type: application/octet-stream) and every
+            parameter is an X-Edit-<name> header, e.g. X-Edit-Kernel-Size: 5. The response body is the
+            edited PNG (Content-Type: image/png); further results, such as the labels of /get_label,
+            are JSON-encoded X-Edit-<name> headers.
+    json    The request is a JSON object with the base64-encoded image and the parameters, and the
+            response a JSON object with the base64-encoded PNG under 'image_string'.
+
+Back ends that speak the binary format mark every response with the X-Edit-Protocol header. The first
+binary request to a back end without it is repeated as JSON, and JSON is used for that back end for
+backendConfig['protocolRetry'] seconds, so older back ends keep working; the binary format is tried again
+after that. A 502/503/504 without the header tells nothing about the back end, which may not have
+answered it at all (e.g. a proxy in front of it), and leaves the format as it is.
+"""
+
+HEADER_PREFIX = 'X-Edit-'
+PROTOCOL_HEADER = 'X-Edit-Protocol'
+# responses that are retried like connection errors: the back end or a proxy in front of it is overloaded or restarting
+RETRY_STATUSES = (502, 503, 504)
+# what editImage raises when no back end answers, the back end fails, or its result cannot be read (bad JSON,
+# bad base64, or a missing field)
+EDIT_ERRORS = (requests.RequestException, ValueError, KeyError)
+# answered attempts of an endpoint needed before its latency quantile is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+
+# back-end base URL -> True if it speaks the binary format, or the time.monotonic() until which it is
+# sent JSON, since it answered a binary request without the protocol header
+protocols = {}
+
+
+class Backend:
+    """State of one back end in a BackendPool, guarded by the lock of the pool."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        # requests and health checks failed in a row
+        self.failures = 0
+        self.failed_checks = 0
+        self.healthy = True
+        # recent ejections, each one longer than the last, and ejections so far
+        self.ejections = 0
+        self.times_ejected = 0
+        self.ejected_until = 0.0
+
+    def available(self, now):
+        """True if the back end takes requests."""
+        return self.healthy and self.ejected_until <= now
+
+
+class BackendPool:
+    """
+    The back ends of the edit service, and the choice between them.
+
+    Description:
+        acquire() picks one of the healthy, not ejected back ends by backendConfig['balancer'] and counts the
+        request as outstanding on it until release(). Health checks mark back ends unhealthy or healthy
+        again, and release() ejects a back end whose requests keep failing. If no back end is available,
+        requests go to all of them rather than fail outright, so a pool that is entirely down recovers as
+        soon as any back end does.
+    """
+
+    def __init__(self, urls=()):
+        self.lock = threading.Lock()
+        self.backends = {}
+        self.set_endpoints(urls)
+
+    def set_endpoints(self, urls):
+        """Use the back ends at urls, keeping the state of those already in the pool."""
+        with self.lock:
+            self.backends = {url: self.backends.get(url) or Backend(url) for url in urls}
+
+    def urls(self):
+        """The base URLs of the back ends."""
+        with self.lock:
+            return list(self.backends)
+
+    def acquire(self, exclude=()):
+        """
+        Pick the back end of a request.
+
+        Parameters:
+            exclude (set): URLs of back ends the request was already sent to; they are only picked if no
+                other back end is available.
+
+        Returns:
+            Backend: The back end, with the request counted as outstanding on it.
+            Raises requests.ConnectionError if there are no back ends.
+        """
+        with self.lock:
+            if not self.backends:
+                raise requests.ConnectionError("No back-end endpoints are configured")
+            now = time.monotonic()
+            backends = list(self.backends.values())
+            available = [backend for backend in backends if backend.available(now)] or backends
+            candidates = [backend for backend in available if backend.url not in exclude] or available
+            if backendConfig['balancer'] == 'p2c' and len(candidates) > 2:
+                backend = min(random.sample(candidates, 2), key=lambda backend: backend.outstanding)
+            else:
+                # least outstanding, ties broken at random so idle back ends share the load
+                backend = min(candidates, key=lambda backend: (backend.outstanding, random.random()))
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend, failed):
+        """
+        Finish a request on backend.
+
+        Parameters:
+            backend (Backend): The back end returned by acquire().
+            failed (bool): True if the request could not connect, timed out or got a 502/503/504.
+        """
+        with self.lock:
+            backend.outstanding -= 1
+            if not failed:
+                backend.failures = 0
+                return
+            backend.failures += 1
+            now = time.monotonic()
+            if backend.failures < backendConfig['ejectAfter'] or backend.ejected_until > now:
+                return
+            ejected = sum(1 for other in self.backends.values() if other.ejected_until > now)
+            if ejected + 1 > backendConfig['maxEjectedRatio'] * len(self.backends):
+                return
+            if now - backend.ejected_until > backendConfig['ejectTime'] * backend.ejections:
+                # the last ejection is long past
+                backend.ejections = 0
+            backend.ejections += 1
+            backend.times_ejected += 1
+            backend.failures = 0
+            backend.ejected_until = now + backendConfig['ejectTime'] * backend.ejections
+        logging.warning(f"Ejected back end {backend.url} for {backendConfig['ejectTime'] * backend.ejections:g} "
+                        f"seconds after {backendConfig['ejectAfter']} failed requests in a row")
+
+    def record_check(self, url, passed):
+        """Record the outcome of a health check of the back end at url."""
+        with self.lock:
+            backend = self.backends.get(url)
+            if backend is None:
+                return
+            if passed:
+                backend.failed_checks = 0
+                if backend.healthy:
+                    return
+                backend.healthy = True
+            else:
+                backend.failed_checks += 1
+                if not backend.healthy or backend.failed_checks < backendConfig['unhealthyAfter']:
+                    return
+                backend.healthy = False
+        logging.warning(f"Back end {url} is {'healthy' if passed else 'unhealthy'}")
+
+    def snapshot(self):
+        """The state of every back end, by URL."""
+        with self.lock:
+            now = time.monotonic()
+            return {url: {'outstanding': backend.outstanding, 'requests': backend.requests,
+                          'healthy': backend.healthy, 'ejected': backend.ejected_until > now,
+                          'ejections': backend.times_ejected}
+                    for url, backend in self.backends.items()}
+
+
+class BackendClient:
+    """
+    Pooled HTTP client of the back-end edit service, shared by all request threads.
+
+    Description:
+        One requests.Session keeps up to backendConfig['poolSize'] keep-alive connections per back end,
+        so edits reuse connections instead of opening one each. Every attempt has the connect timeout
+        and the read timeout of its endpoint, so a stuck back end cannot hold a front-end thread for
+        longer than that. Each attempt goes to the back end picked by the BackendPool.
+
+        Edits are idempotent, so an attempt that fails to connect, times out or gets a 502/503/504 is
+        retried on another back end, up to backendConfig['retries'] times after a random (full jitter)
+        exponential backoff. An attempt still unanswered after the hedgeQuantile latency of its endpoint
+        is hedged: a second copy is sent to another back end, and whichever answers first is used. Hedges
+        are limited to hedgeRatio of all requests, so they cannot double the load of a slow back end.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_maxsize=backendConfig['poolSize'], max_retries=0)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.pool = BackendPool(backendConfig['endpoints'])
+        # runs the attempts of hedged requests, both copies of which may be in flight at once, and health checks
+        self.executor = ThreadPoolExecutor(max_workers=2 * backendConfig['poolSize'], thread_name_prefix='backend')
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.outstanding = 0
+        # seconds per request, retries and hedges included, and per answered attempt of each endpoint
+        self.latency = Histogram()
+        self.endpoint_latency = {}
+
+    def _send(self, backend, endpoint, encode):
+        """Make one attempt on backend. Returns the response; raises requests.RequestException."""
+        timeouts = backendConfig['timeouts']
+        start = time.perf_counter()
+        try:
+            response = self.session.post(backend.url + endpoint,
+                                         timeout=(backendConfig['connectTimeout'],
+                                                  timeouts.get(endpoint, timeouts['default'])),
+                                         **encode(backend.url))
+        except requests.RequestException:
+            self.pool.release(backend, True)
+            raise
+        return self.finish(backend, endpoint, response, start)
+
+    def finish(self, backend, endpoint, response, start):
+        """Record an answered attempt: release its back end and observe its latency. Returns response."""
+        self.pool.release(backend, response.status_code in RETRY_STATUSES)
+        if response.status_code not in RETRY_STATUSES:
+            with self.lock:
+                self.endpoint_latency.setdefault(endpoint, Histogram()).observe(time.perf_counter() - start)
+        response.backend_url = backend.url
+        return response
+
+    def hedge_delay(self, endpoint):
+        """Seconds after which an attempt on endpoint is hedged, or None to not hedge it."""
+        with self.lock:
+            histogram = self.endpoint_latency.get(endpoint)
+            if histogram is None or histogram.count < HEDGE_MIN_SAMPLES:
+                return None
+            if self.counters['hedges'] >= backendConfig['hedgeRatio'] * self.counters['requests']:
+                return None
+            delay = max(histogram.quantile(backendConfig['hedgeQuantile']), backendConfig['hedgeMinDelay'])
+        return None if delay == float('inf') else delay
+
+    def _attempt(self, endpoint, encode, tried):
+        """Make one attempt, hedged if it is slow. Returns the first answer; raises if both copies fail."""
+        backend = self.pool.acquire(tried)
+        tried.add(backend.url)
+        delay = self.hedge_delay(endpoint)
+        if delay is None:
+            return self._send(backend, endpoint, encode)
+        first = self.executor.submit(self._send, backend, endpoint, encode)
+        done, pending = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        with self.lock:
+            self.counters['hedges'] += 1
+        backend = self.pool.acquire(tried)
+        tried.add(backend.url)
+        hedge = self.executor.submit(self._send, backend, endpoint, encode)
+        pending = {first, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    with self.lock:
+                        self.counters['hedge_wins'] += 1
+                return response
+        raise error
+
+    def post(self, endpoint, encode):
+        """
+        POST an edit request to a back end.
+
+        Parameters:
+            endpoint (str): The edit endpoint, e.g. /resize_image, which selects the timeout.
+            encode (callable): Takes the base URL of the back end picked for an attempt and returns the
+                arguments of requests.post for it, e.g. data and headers.
+
+        Returns:
+            requests.Response: The response, with the base URL of the back end that answered in
+            backend_url; a 502/503/504 only if it is still the answer after the last retry.
+            Raises requests.RequestException if the last attempt could not connect or timed out.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            self.counters['requests'] += 1
+            self.outstanding += 1
+        tried = set()
+        try:
+            attempts = backendConfig['retries'] + 1
+            for attempt in range(attempts):
+                try:
+                    response = self._attempt(endpoint, encode, tried)
+                    if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                        return response
+                    logging.info(f"Back end {response.backend_url} answered {endpoint} with "
+                                 f"{response.status_code}, retrying")
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == attempts - 1:
+                        with self.lock:
+                            self.counters['failures'] += 1
+                        raise
+                    logging.info(f"Back-end request {endpoint} failed, retrying: {e}")
+                with self.lock:
+                    self.counters['retries'] += 1
+                time.sleep(random.uniform(0, backendConfig['retryBackoff'] * 2 ** attempt))
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+                self.latency.observe(time.perf_counter() - start)
+
+    def _check(self, url):
+        """Health-check the back end at url."""
+        try:
+            passed = self.session.get(url + backendConfig['healthPath'],
+                                      timeout=backendConfig['healthTimeout']).status_code < 500
+        except requests.RequestException:
+            passed = False
+        self.pool.record_check(url, passed)
+
+    def check_health(self):
+        """Health-check every back end at once."""
+        list(self.executor.map(self._check, self.pool.urls()))
+
+    def pool_stats(self):
+        """Connections per back end: opened so far, and idle in the pool."""
+        pools = {}
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                pools[f"{pool.host}:{pool.port}"] = {
+                    'opened': pool.num_connections,
+                    'idle': sum(1 for connection in list(pool.pool.queue) if connection is not None)}
+        return pools
+
+    def stats(self, output_format='json'):
+        """
+        Report the client statistics.
+
+        Parameters:
+            output_format (str): 'json' for a dict, 'prometheus' for the Prometheus text format.
+
+        Returns:
+            dict or str: Request, retry, hedge and failure counts, outstanding requests, the state of every
+            back end, connection pool usage per back end, and latency histograms.
+        """
+        pools = self.pool_stats()
+        backends = self.pool.snapshot()
+        with self.lock:
+            counters = dict(self.counters)
+            outstanding = self.outstanding
+            latency = Histogram()
+            latency.merge(self.latency)
+            endpoints = {endpoint: histogram.snapshot() for endpoint, histogram in self.endpoint_latency.items()}
+        for name in ('requests', 'retries', 'hedges', 'hedge_wins', 'failures'):
+            counters.setdefault(name, 0)
+        if output_format == 'prometheus':
+            counters['routed'] = {(('backend', url),): backend['requests'] for url, backend in backends.items()}
+            counters['ejections'] = {(('backend', url),): backend['ejections'] for url, backend in backends.items()}
+            counters['connections_opened'] = {(('backend', backend),): pool['opened'] for backend, pool in pools.items()}
+            return prometheus_text('backend', counters,
+                                   {'outstanding_requests': outstanding,
+                                    'idle_connections': sum(pool['idle'] for pool in pools.values()),
+                                    'healthy_backends': sum(backend['healthy'] for backend in backends.values()),
+                                    'ejected_backends': sum(backend['ejected'] for backend in backends.values())},
+                                   {'request_seconds': latency})
+        return dict(counters, outstanding=outstanding, backends=backends, pools=pools, latency=latency.snapshot(),
+                    endpoints=endpoints)
+
+
+client = BackendClient()
+
+health_lock = threading.Lock()
+# (thread, stop event) of the running health checker, or None
+health_checker = None
+
+
+def healthLoop(stop):
+    """
+    Health-check the back ends every backendConfig['healthInterval'] seconds until stop is set.
+
+    Parameters:
+        stop (threading.Event): Set to end the loop.
+    """
+    while True:
+        try:
+            client.check_health()
+        except Exception as e:
+            logging.error(f"Error in back-end health checks: {e}")
+        if stop.wait(backendConfig['healthInterval']):
+            return
+
+
+def startHealthChecks():
+    """
+    Start the background health checker if it is not running yet.
+
+    Returns:
+        threading.Event: Set it to stop the health checker.
+    """
+    global health_checker
+    with health_lock:
+        if health_checker is None or not health_checker[0].is_alive():
+            stop = threading.Event()
+            thread = threading.Thread(target=healthLoop, args=(stop,), name='backend-health', daemon=True)
+            thread.start()
+            health_checker = (thread, stop)
+        return health_checker[1]
+
+
+def headerName(name):
+    """The header carrying parameter name, e.g. kernel_size -> X-Edit-Kernel-Size."""
+    return HEADER_PREFIX + '-'.join(part.capitalize() for part in name.split('_'))
+
+
+def binaryRequest(image, params):
+    """
+    Encode an edit request in the binary format.
+
+    Returns:
+        dict: The arguments of requests.post.
+    """
+    headers = {headerName(name): str(value) for name, value in params.items()}
+    headers['Content-Type'] = 'application/octet-stream'
+    headers['Accept'] = 'image/png'
+    return {'data': image, 'headers': headers}
+
+
+def jsonRequest(image, image_field, params):
+    """
+    Encode an edit request in the JSON format.
+
+    Returns:
+        dict: The arguments of requests.post.
+    """
+    data = dict(params)
+    data[image_field] = base64.b64encode(image).decode('utf-8')
+    return {'json': data}
+
+
+def editEncoder(image, image_field, params):
+    """
+    Encoder of an edit request for BackendClient.post.
+
+    Returns:
+        callable: Takes the base URL of a back end and returns the arguments of the request to it, in the
+        binary format unless that back end is known to only speak JSON.
+    """
+    def encode(base_url):
+        if speaksBinary(base_url):
+            return binaryRequest(image, params)
+        return jsonRequest(image, image_field, params)
+    return encode
+
+
+def speaksBinary(base_url):
+    """Whether requests go out to a back end in the binary format: unless it recently answered one without it."""
+    known = protocols.get(base_url, True)
+    return known is True or time.monotonic() >= known
+
+
+def checkProtocol(response):
+    """
+    Learn the wire format of the back end that sent response.
+
+    Returns:
+        bool: True if the request was sent in the binary format to a back end that does not speak it,
+        and must be sent again (it goes out as JSON to that back end for backendConfig['protocolRetry']
+        seconds).
+    """
+    if PROTOCOL_HEADER in response.headers:
+        protocols[response.backend_url] = True
+        return False
+    if response.status_code in RETRY_STATUSES:
+        return False
+    if speaksBinary(response.backend_url):
+        logging.info(f"Back end {response.backend_url} does not speak the binary edit format, using JSON")
+        protocols[response.backend_url] = time.monotonic() + backendConfig.get('protocolRetry', 600)
+        return True
+    return False
+
+
+def decodeEdit(response):
+    """
+    Read the result of an edit from the response of the back end, in the format it is in.
+
+    Returns:
+        tuple: (the edited PNG in bytes, dict of the further results of the edit). Raises the HTTP error of
+        the client library if the back end failed.
+    """
+    response.raise_for_status()
+    if response.headers.get('Content-Type', '').startswith('application/json'):
+        results = response.json()
+        return base64.b64decode(results.pop('image_string')), results
+    results = {name[len(HEADER_PREFIX):].lower().replace('-', '_'): json.loads(value)
+               for name, value in response.headers.items()
+               if name.lower().startswith(HEADER_PREFIX.lower()) and name.lower() != PROTOCOL_HEADER.lower()}
+    return response.content, results
+
+
+def editImage(endpoint, image, image_field='image_path', **params):
+    """
+    Have a back end edit an image.
+
+    Parameters:
+        endpoint (str): The edit endpoint, e.g. /resize_image.
+        image (bytes): The image to edit.
+        image_field (str): The key of the image in the JSON format ('image' for /get_label).
+        **params: The parameters of the edit, e.g. width=50.
+
+    Returns:
+        tuple: (the edited PNG in bytes, dict of the further results of the edit). Raises
+        requests.HTTPError if the back end fails and requests.RequestException if none can be reached.
+
+    Description:
+        The binary format is used unless the back end picked for the request is known to only speak JSON;
+        see the module notes. Responses are read in the format they are in.
+    """
+    encode = editEncoder(image, image_field, params)
+    response = client.post(endpoint, encode)
+    if checkProtocol(response):
+        response = client.post(endpoint, encode)
+    return decodeEdit(response)
@@ -0,0 +1,388 @@
+"""Memcache node server and the consistent-hashing client that spreads keys over several nodes.
+
+Start a node with:
+
+    python -m FrontEnd.cachenode --port 11311 --capacity 2048 --policy LRU
+
+and point the front ends at the nodes with memcacheConfig['backend'] = 'pool' and
+memcacheConfig['nodes'] = ['10.0.0.5:11311', '10.0.0.6:11311', ...].
+
+The protocol has no authentication or encryption: anyone who can reach the port can read, overwrite and
+clear the cached images. A node therefore listens on 127.0.0.1 unless --host says otherwise; to serve front
+ends on other hosts, bind it to a private interface (e.g. --host 10.0.0.5) and only let the front ends reach
+the port, with a security group or firewall rule.
+
+Wire protocol (little-endian), one request/response pair at a time on a persistent TCP connection:
+
+    request   op (u8), key length (u16), value length (u32), ttl seconds (f64, 0 for none), key (utf-8), value
+    response  status (u8), payload length (u32), payload
+"""
+import sys
+import json
+import time
+import socket
+import struct
+import hashlib
+import logging
+import argparse
+import bisect
+import threading
+import socketserver
+from FrontEnd import config
+from FrontEnd import memcache
+from FrontEnd.memcache import CacheStats, mergeStats, subGET, subTOUCH, subPUT, subInvalidateKey, subCLEAR, subSTATS
+
+REQUEST = struct.Struct('<BHId')
+RESPONSE = struct.Struct('<BI')
+# OP_EXISTS and OP_TOUCH answer STATUS_OK or STATUS_MISS without sending the value; OP_TOUCH also marks the
+# key as most recently used
+OP_GET, OP_PUT, OP_INVALIDATE, OP_CLEAR, OP_STATS, OP_EXISTS, OP_TOUCH = 1, 2, 3, 4, 5, 6, 7
+STATUS_OK, STATUS_MISS, STATUS_NOT_STORED, STATUS_ERROR = 0, 1, 2, 3
+
+
+def recvExact(sock, length):
+    """Read exactly length bytes into a bytearray. Returns None if the peer closed the connection first."""
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+
+"""///SERVER///"""
+
+
+class CacheNodeHandler(socketserver.BaseRequestHandler):
+    """Serve requests from one client connection until it is closed."""
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            header = recvExact(sock, REQUEST.size)
+            if header is None:
+                return
+            op, key_length, value_length, ttl = REQUEST.unpack(header)
+            key = recvExact(sock, key_length)
+            value = recvExact(sock, value_length)
+            if key is None or value is None:
+                return
+            try:
+                status, payload = dispatch(op, key.decode('utf-8'), value, ttl)
+            except Exception as e:
+                logging.error(f"Error in cache node request {op}: {e}")
+                status, payload = STATUS_ERROR, b''
+            sock.sendall(RESPONSE.pack(status, len(payload)))
+            if payload:
+                sock.sendall(payload)
+
+
+def dispatch(op, image_key, value, ttl=0):
+    """Run one protocol operation against this process's memcache. Returns (status, payload)."""
+    if op == OP_GET:
+        content = subGET(image_key)
+        return (STATUS_OK, content) if content else (STATUS_MISS, b'')
+    if op == OP_PUT:
+        # the received bytearray is owned by this request, so it can be cached without a copy
+        return (STATUS_OK if subPUT(image_key, memoryview(value), ttl) else STATUS_NOT_STORED), b''
+    if op == OP_INVALIDATE:
+        return (STATUS_OK if subInvalidateKey(image_key) else STATUS_ERROR), b''
+    if op == OP_CLEAR:
+        return (STATUS_OK if subCLEAR() else STATUS_ERROR), b''
+    if op == OP_STATS:
+        return STATUS_OK, json.dumps(subSTATS()).encode('utf-8')
+    if op == OP_EXISTS:
+        return (STATUS_OK if image_key in memcache.memcache else STATUS_MISS), b''
+    if op == OP_TOUCH:
+        return (STATUS_OK if subTOUCH(image_key) else STATUS_MISS), b''
+    return STATUS_ERROR, b''
+
+
+class CacheNodeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, CacheNodeHandler)
+
+
+"""///CLIENT///"""
+
+
+class CacheNodeClient:
+    """
+    Connection pool to one cache node.
+
+    Idle connections are reused most-recently-used first; a connection that fails is closed and
+    the error is raised to the caller, which treats the node as unavailable for that request.
+    """
+
+    def __init__(self, address, timeout=1.0, max_idle=16):
+        host, port = address.rsplit(':', 1)
+        self.address = address
+        self.endpoint = (host, int(port))
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        sock = socket.create_connection(self.endpoint, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _release(self, sock):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def request(self, op, image_key='', value=b'', ttl=0):
+        """Send one request and return (status, payload). Raises OSError if the node is unreachable."""
+        key = image_key.encode('utf-8')
+        sock = self._acquire()
+        try:
+            value = memoryview(value)
+            sock.sendall(REQUEST.pack(op, len(key), value.nbytes, ttl) + key)
+            if value.nbytes:
+                sock.sendall(value)
+            header = recvExact(sock, RESPONSE.size)
+            if header is None:
+                raise ConnectionError(f"cache node {self.address} closed the connection")
+            status, length = RESPONSE.unpack(header)
+            payload = recvExact(sock, length)
+            if payload is None:
+                raise ConnectionError(f"cache node {self.address} closed the connection")
+        except BaseException:
+            sock.close()
+            raise
+        self._release(sock)
+        return status, payload
+
+    def close(self):
+        with self.lock:
+            for sock in self.idle:
+                sock.close()
+            self.idle.clear()
+
+
+def ringHash(value):
+    """Stable 64-bit hash used for ring positions (Python's hash() differs between processes)."""
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent-hash ring with virtual nodes.
+
+    Each node owns `virtual_nodes` points on the ring and a key belongs to the first point at or
+    after its hash. Adding or removing one of N nodes therefore only moves about 1/N of the keys,
+    and only to or from that node.
+    """
+
+    def __init__(self, nodes=(), virtual_nodes=160):
+        self.virtual_nodes = virtual_nodes
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.virtual_nodes):
+            point = ringHash(f"{node}#{i}")
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        keep = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, owner in keep]
+        self.owners = [owner for point, owner in keep]
+
+    def node(self, image_key):
+        """Return the node responsible for image_key."""
+        if not self.points:
+            raise LookupError("the hash ring has no nodes")
+        index = bisect.bisect_left(self.points, ringHash(image_key))
+        return self.owners[index % len(self.owners)]
+
+
+class NodePoolCache:
+    """
+    Memcache backend that shards keys over several cache nodes with consistent hashing.
+
+    Description:
+        Implements the same interface as ShardedMemCache, so subGET/subPUT/subInvalidateKey/subCLEAR
+        work unchanged. An unreachable node behaves like an empty cache: GETs miss and PUTs are not
+        stored, and the front end falls back to S3/DynamoDB. Hit/miss counts and latencies are
+        measured on this client; entry counts, sizes and evictions are collected from the nodes, and
+        reused for stats_ttl seconds, since len(), capacity and total_size are read often.
+    """
+
+    def __init__(self, nodes, virtual_nodes=160, timeout=1.0, stats_ttl=1.0):
+        self.timeout = timeout
+        self.stats_ttl = stats_ttl
+        self.clients = {}
+        self.ring = HashRing(virtual_nodes=virtual_nodes)
+        self.lock = threading.Lock()
+        self.local_stats = CacheStats()
+        # (time.monotonic() when collected, node address -> report), or None
+        self.remote_stats = None
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        with self.lock:
+            self.clients[node] = CacheNodeClient(node, self.timeout)
+            self.ring.add(node)
+            self.remote_stats = None
+
+    def remove_node(self, node):
+        with self.lock:
+            self.ring.remove(node)
+            client = self.clients.pop(node)
+            self.remote_stats = None
+        client.close()
+
+    def _call(self, image_key, op, value=b'', ttl=0):
+        with self.lock:
+            client = self.clients[self.ring.node(image_key)]
+        try:
+            return client.request(op, image_key, value, ttl)
+        except OSError as e:
+            logging.error(f"Cache node {client.address} unavailable: {e}")
+            return STATUS_ERROR, b''
+
+    def _remote_stats(self):
+        with self.lock:
+            if self.remote_stats is not None and time.monotonic() - self.remote_stats[0] < self.stats_ttl:
+                return self.remote_stats[1]
+            clients = list(self.clients.values())
+        collected = time.monotonic()
+        reports = {}
+        for client in clients:
+            try:
+                status, payload = client.request(OP_STATS)
+                reports[client.address] = json.loads(payload.decode('utf-8'))
+            except (OSError, ValueError) as e:
+                reports[client.address] = {'error': str(e)}
+        with self.lock:
+            self.remote_stats = (collected, reports)
+        return reports
+
+    @property
+    def capacity(self):
+        return sum(report.get('capacity_bytes', 0) for report in self._remote_stats().values())
+
+    @property
+    def total_size(self):
+        return sum(report.get('size_bytes', 0) for report in self._remote_stats().values())
+
+    def __len__(self):
+        return sum(report.get('entries', 0) for report in self._remote_stats().values())
+
+    @property
+    def max_item_size(self):
+        """The largest entry a node admits, if it runs with the capacity, shards and ratio configured here."""
+        return (config.memcacheConfig['capacity'] * 1048576 // config.memcacheConfig.get('shards', 16)
+                * config.memcacheConfig.get('maxItemRatio', 1))
+
+    def __contains__(self, image_key):
+        return self._call(image_key, OP_EXISTS)[0] == STATUS_OK
+
+    def get(self, image_key):
+        start = time.perf_counter()
+        status, payload = self._call(image_key, OP_GET)
+        with self.lock:
+            if status == STATUS_OK:
+                self.local_stats.hits += 1
+                self.local_stats.window.add('hits')
+            else:
+                self.local_stats.misses += 1
+                self.local_stats.window.add('misses')
+            self.local_stats.get_latency.observe(time.perf_counter() - start)
+        return bytes(payload) if status == STATUS_OK else None
+
+    def touch(self, image_key):
+        return self._call(image_key, OP_TOUCH)[0] == STATUS_OK
+
+    def put(self, image_key, value, size, ttl=None):
+        start = time.perf_counter()
+        status, payload = self._call(image_key, OP_PUT, value, ttl or 0)
+        with self.lock:
+            self.local_stats.puts += 1
+            if status == STATUS_OK:
+                self.local_stats.bytes_admitted += size
+                self.local_stats.window.add('bytes_admitted', size)
+            else:
+                self.local_stats.rejected += 1
+            self.local_stats.put_latency.observe(time.perf_counter() - start)
+        return status == STATUS_OK
+
+    def invalidate(self, image_key):
+        status, payload = self._call(image_key, OP_INVALIDATE)
+        if status != STATUS_OK:
+            raise ConnectionError(f"could not invalidate {image_key} on its cache node")
+        return True
+
+    def clear(self):
+        with self.lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.request(OP_CLEAR)
+        with self.lock:
+            self.remote_stats = None
+
+    def sweep(self, limit, watermark=1.0):
+        """Nothing to do here: every cache node runs its own sweeper."""
+        return 0
+
+    def stats(self):
+        """Return the (report, get_latency, put_latency, evictions) tuple, with per-node reports added."""
+        nodes = self._remote_stats()
+        with self.lock:
+            report = mergeStats([(self.local_stats,
+                                  sum(node.get('entries', 0) for node in nodes.values()),
+                                  sum(node.get('size_bytes', 0) for node in nodes.values()),
+                                  sum(node.get('capacity_bytes', 0) for node in nodes.values()))])
+        for node in nodes.values():
+            report[3].update(node.get('evictions', {}))
+        report[0]['evictions'] = dict(report[3])
+        report[0]['nodes'] = nodes
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a standalone front-end memcache node.")
+    # the protocol is unauthenticated, so only local clients can reach a node unless told otherwise
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on; anyone who can reach it can read and clear the cache")
+    parser.add_argument('--port', type=int, default=11311)
+    parser.add_argument('--capacity', type=float, default=config.memcacheConfig['capacity'], help="capacity in MB")
+    parser.add_argument('--policy', default=config.memcacheConfig['policy'])
+    parser.add_argument('--shards', type=int, default=config.memcacheConfig.get('shards', 16))
+    args = parser.parse_args(argv)
+
+    config.memcacheConfig.update({'capacity': args.capacity, 'policy': args.policy, 'shards': args.shards,
+                                  'backend': 'local'})
+    memcache.memcache = memcache.createMemCache()
+    memcache.startSweeper()
+    server = CacheNodeServer((args.host, args.port))
+    # print the bound port so callers that asked for port 0 can find the node
+    print(f"cache node listening on {server.server_address[0]}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,8 +6,83 @@ ConfigAWS = {
     'securityID': '###'
 }
 
-memcache = {}
-total_image_size = 0
+# backend: 'local' keeps the cache in this process, 'shared' in a memory-mapped file shared by all
+#     front-end processes on the host (sharedPath, default /dev/shm/frontend-memcache; sharedSlots index slots),
+#     'pool' on the cache nodes in nodes ('host:port', see FrontEnd/cachenode.py) with virtualNodes ring points
+#     per node and nodeTimeout seconds per request; the entry counts and sizes of the nodes are collected at
+#     most every nodeStatsTTL seconds. The nodes do not authenticate their clients, so keep them on a private network
+# capacity: MB of cached raw image bytes, including per-entry overhead (see FrontEnd.memcache.entrySize)
+# policy: one of 'LRU', 'Random', 'LFU', 'ARC', 'W-TinyLFU' (see FrontEnd.memcache.POLICIES)
+# maxItemRatio: largest share of the capacity of one shard (capacity / shards; the whole capacity for the shared
+#     backend) a single image may take, e.g. 0.05 of 2048 MB / 16 shards admits images up to 6.4 MB
+# shards: number of lock-striped cache shards, each holding capacity / shards
+# statsWindowMinutes: how many minutes of per-minute statistics /memcache/stats keeps
+# windowRatio, sketchWidth: W-TinyLFU admission window share and frequency sketch width
+# ttl: default seconds an entry stays cached (None or 0 for no expiry); subPUT can override it per entry
+# sweepInterval, sweepBatch, sweepWatermark: the background sweeper wakes every sweepInterval seconds, expires
+#     entries and evicts down to sweepWatermark of the capacity, at most sweepBatch entries per shard lock
+# snapshotPath, snapshotInterval, snapshotMB: the local backend writes its hottest snapshotMB of entries to
+#     snapshotPath (default: frontend-memcache.snapshot in the temp dir) every snapshotInterval seconds (0 disables)
+#     and at exit, and loads that file in the background on start
+# snapshotCompactRatio: snapshots only append the images cached since the last one; the file is rewritten with
+#     just the current snapshot once it grows past this many times its size (see FrontEnd/snapshot.py)
+# tracePath: if set, every subGET/subPUT is appended to this CSV file for benchmarks/bench_traces.py
+# writeMode: 'write-through' puts the image written by /upload or /save_image straight into the memcache,
+#     'invalidate' only drops the cached one, so the next read fetches it from S3
+# versionsKept: keys whose latest version is remembered, so a stale image is never cached over a newer one
+memcacheConfig = {'capacity': 2048, 'policy': 'LRU', 'maxItemRatio': 0.05, 'windowRatio': 0.01, 'sketchWidth': 65536,
+                  'shards': 16, 'statsWindowMinutes': 60, 'backend': 'local', 'sharedPath': None,
+                  'sharedSlots': 65536, 'nodes': [], 'virtualNodes': 160, 'nodeTimeout': 1.0, 'nodeStatsTTL': 1.0,
+                  'ttl': 86400, 'sweepInterval': 1.0, 'sweepBatch': 64, 'sweepWatermark': 0.9,
+                  'snapshotPath': None, 'snapshotInterval': 300, 'snapshotMB': 512, 'snapshotCompactRatio': 2,
+                  'tracePath': None, 'writeMode': 'write-through', 'versionsKept': 65536}
 
-memcacheConfig = {'capacity': 2048, 'policy': 'LRU'}
 
+# Client of the back-end edit service (see FrontEnd/backend_client.py):
+# poolSize: keep-alive connections kept per back end, shared by all request threads
+# connectTimeout: seconds to open a connection; timeouts: seconds to wait for the response per edit endpoint,
+#     'default' for the others
+# retries: further attempts after a connection error, a timeout or a 502/503/504 response (edits are idempotent),
+#     retryBackoff seconds times 2**attempt at most between attempts, with full jitter
+# hedgeQuantile, hedgeMinDelay, hedgeRatio: a second copy of a request is sent once the first has been waiting
+#     longer than the hedgeQuantile latency of its endpoint (and at least hedgeMinDelay seconds), for at most
+#     hedgeRatio of all requests; the first answer wins
+# endpoints: base URLs of the back ends, e.g. ['http://127.0.0.1:5001', 'http://127.0.0.1:5002']; if empty, the
+#     public addresses of the EC2 instances are used, with the back-end port
+# balancer: 'least_outstanding' sends each request to the back end with the fewest requests in flight,
+#     'p2c' to the less busy of two random back ends
+# healthPath, healthInterval, healthTimeout, unhealthyAfter: every back end is sent GET healthPath every
+#     healthInterval seconds; it takes no requests after unhealthyAfter failed checks in a row, until one passes
+# ejectAfter, ejectTime, maxEjectedRatio: a back end whose requests fail ejectAfter times in a row (connection
+#     error, timeout or 502/503/504) takes no requests for ejectTime seconds times the number of its recent ejections;
+#     at most maxEjectedRatio of the back ends are ejected at once
+# protocolRetry: seconds a back end that answered a binary edit request without X-Edit-Protocol is sent JSON,
+#     before the binary format is tried again
+backendConfig = {'poolSize': 16, 'connectTimeout': 2.0, 'timeouts': {'default': 30.0, '/get_label': 60.0},
+                 'retries': 2, 'retryBackoff': 0.1, 'hedgeQuantile': 0.95, 'hedgeMinDelay': 0.05, 'hedgeRatio': 0.1,
+                 'endpoints': [], 'instances': ['i-0c841e13abbf09d94'], 'port': 5001,
+                 'balancer': 'least_outstanding', 'healthPath': '/home', 'healthInterval': 5.0, 'healthTimeout': 1.0,
+                 'unhealthyAfter': 2, 'ejectAfter': 5, 'ejectTime': 30.0, 'maxEjectedRatio': 0.5,
+                 'protocolRetry': 600}
+
+
+# ASGI serving mode (see FrontEnd/asgi.py):
+# threads: threads running the routes that are not coroutines, and the DynamoDB lookups of the ones that are
+# connections, keepAlive: most connections the async HTTP client opens to S3 and the back ends, and keeps idle
+asgiConfig = {'threads': 32, 'connections': 1000, 'keepAlive': 100}
+
+
+# Background purge of all image data (see FrontEnd/purge.py):
+# segments: parallel scan segments each DynamoDB table is read and emptied in, one thread each
+# workers: threads running the scans of one purge
+# deleteWorkers: threads running the S3 delete_objects calls of one purge, 1000 keys per call
+# keepJobs: finished purges whose progress is still reported
+purgeConfig = {'segments': 8, 'workers': 16, 'deleteWorkers': 8, 'keepJobs': 20}
+
+
+# Negative cache of unknown image keys, so repeated lookups of them skip DynamoDB (see FrontEnd/keyfilter.py):
+# enabled: whether /key and /image consult the cache
+# ttl: seconds a key DynamoDB reported missing is rejected without a lookup; a key written meanwhile through
+#     another front-end process is found again after at most this long
+# maxKeys: most missing keys remembered
+keyFilterConfig = {'enabled': True, 'ttl': 10, 'maxKeys': 100000}
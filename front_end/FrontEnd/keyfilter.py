@@ -0,0 +1,108 @@
+import time
+import threading
+from collections import OrderedDict
+from FrontEnd.config import keyFilterConfig
+from FrontEnd.metrics import prometheus_text
+
+"""
+Negative cache of the image keys DynamoDB recently reported missing, so repeated lookups of unknown keys
+(scrapers, typos) are answered without a get_item.
+
+Only a key this process has itself looked up and found missing is rejected, and only for
+keyFilterConfig['ttl'] seconds: a key written since by another front-end process, Lambda container or
+worker is found again once its entry expires. Keys written by this process are dropped from the cache as
+they are written. Every other key is looked up in the table as before. The cache holds at most
+keyFilterConfig['maxKeys'] keys, the least recently missed ones being forgotten first.
+"""
+
+lock = threading.Lock()
+# image key -> time.monotonic() when its missing entry expires, least recently missed first
+missing = OrderedDict()
+checks = rejected = lookups_missed = 0
+
+
+def mayExist(image_key):
+    """
+    Check the negative cache before looking a key up in the table.
+
+    Parameters:
+        image_key (str): The key.
+
+    Returns:
+        bool: False if the table reported the key missing within the last keyFilterConfig['ttl'] seconds,
+        True if it has to be looked up.
+    """
+    global checks, rejected
+    if not keyFilterConfig['enabled']:
+        return True
+    now = time.monotonic()
+    with lock:
+        checks += 1
+        expires = missing.get(image_key)
+        if expires is None:
+            return True
+        if expires <= now:
+            del missing[image_key]
+            return True
+        rejected += 1
+        return False
+
+
+def recordMissing(image_key):
+    """
+    Remember a key the table did not have.
+
+    Parameters:
+        image_key (str): The key that was looked up.
+
+    Returns:
+        None
+    """
+    global lookups_missed
+    if not keyFilterConfig['enabled']:
+        return
+    with lock:
+        lookups_missed += 1
+        missing[image_key] = time.monotonic() + keyFilterConfig['ttl']
+        missing.move_to_end(image_key)
+        while len(missing) > keyFilterConfig['maxKeys']:
+            missing.popitem(last=False)
+
+
+def addKeys(image_keys):
+    """
+    Forget written keys, so they are looked up again.
+
+    Parameters:
+        image_keys (iterable of str): The keys.
+
+    Returns:
+        None
+    """
+    with lock:
+        for image_key in image_keys:
+            missing.pop(image_key, None)
+
+
+def keyFilterStats(output_format='json'):
+    """
+    Report the negative cache statistics.
+
+    Parameters:
+        output_format (str): 'json' for a dict, or 'prometheus' for the Prometheus text format.
+
+    Returns:
+        dict or str: The lookups checked and rejected, the lookups of missing keys that still reached the
+        table, the false positive rate (the share of lookups of missing keys that reached the table) and
+        the number of keys cached.
+    """
+    with lock:
+        report = {'enabled': keyFilterConfig['enabled'], 'checks': checks, 'rejected': rejected,
+                  'lookups_missed': lookups_missed, 'keys': len(missing)}
+    absent = report['rejected'] + report['lookups_missed']
+    report['false_positive_rate'] = report['lookups_missed'] / absent if absent else 0.0
+    if output_format != 'prometheus':
+        return report
+    counters = {name: report[name] for name in ('checks', 'rejected', 'lookups_missed')}
+    gauges = {name: report[name] for name in ('keys', 'false_positive_rate')}
+    return prometheus_text('keyfilter', counters, gauges, {})
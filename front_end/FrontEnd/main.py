@@ -1,15 +1,30 @@
 import base64
+import io
 import os
+import time
+import uuid
+import hashlib
+import mimetypes
 import logging
-from flask import render_template, request, g, redirect, url_for
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from flask import render_template, request, g, redirect, url_for, send_file, abort, after_this_request
 from FrontEnd import webapp
 from flask_paginate import Pagination
 import json
-from FrontEnd.memcache import subPUT, subCLEAR, subInvalidateKey, subGET
-from botocore.exceptions import ClientError
+from FrontEnd.memcache import (subPUT, subCLEAR, subInvalidateKey, subInvalidateKeys, subGET, subTOUCH, subSTATS,
+                               startSweeper, maxItemSize)
+from FrontEnd.snapshot import startSnapshots
+from FrontEnd.purge import startPurge, purgeStatus, PurgeBusy
+from FrontEnd.keyfilter import mayExist, recordMissing, addKeys, keyFilterStats
+from FrontEnd.renditions import RENDITIONS, makeRenditions, renditionPath
+from FrontEnd.backend_client import editImage, startHealthChecks, client as edit_client, EDIT_ERRORS
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 import boto3
-from FrontEnd.config import ConfigAWS
-import requests
+from boto3.s3.transfer import TransferConfig
+from FrontEnd.config import ConfigAWS, memcacheConfig, backendConfig
 
 # Configure logging
 logging.basicConfig(filename='image_processing.log', level=logging.INFO,
@@ -20,161 +35,647 @@ ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tiff', '.gif', '.tif', '.bmp',
                       '.psd', '.xcf', '.ai', 'cdr'}
 global bucket
 bucket_name = 'images'
+# S3 connections kept for the request threads that read images: a gallery page loads each of its images
+# through the '/image' route, so the browser fetches them in parallel and every request reads one object
+S3_REQUEST_CONNECTIONS = 16
+# images stored at once by one bulk upload, and the parts of each one sent at once by a multipart transfer
+BULK_UPLOAD_WORKERS = 8
+TRANSFER_CONCURRENCY = 4
+# items accepted by one bulk upload
+BULK_UPLOAD_MAX_ITEMS = 100
+# the connection pool covers the request threads and the transfer threads of the upload pool, so concurrent
+# reads and uploads never queue for a connection
+s3_config = BotoConfig(max_pool_connections=S3_REQUEST_CONNECTIONS + BULK_UPLOAD_WORKERS * TRANSFER_CONCURRENCY,
+                       connect_timeout=2, read_timeout=5,
+                       retries={'max_attempts': 3, 'mode': 'standard'})
 s3_boto = boto3.resource('s3',
                          region_name='us-east-1',
                          aws_access_key_id=ConfigAWS["aws_access_key_id"],
-                         aws_secret_access_key=ConfigAWS['aws_secret_access_key'])
+                         aws_secret_access_key=ConfigAWS['aws_secret_access_key'],
+                         config=s3_config)
+# boto3 clients are thread-safe: every request and transfer thread shares this one and its connection pool
+s3_client = s3_boto.meta.client
+# files of 8 MB and more are sent as multipart uploads of 8 MB parts, TRANSFER_CONCURRENCY parts at a time
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=TRANSFER_CONCURRENCY, use_threads=True)
+# stores the images of a bulk upload (see bulk_upload)
+upload_pool = ThreadPoolExecutor(max_workers=BULK_UPLOAD_WORKERS, thread_name_prefix='s3-upload')
+# Lambda (Zappa) freezes the container as soon as the response is returned, so work left on a pool
+# may never run there; the work the routes would defer is then done before they respond (see after_response)
+DEFER_WORK = 'AWS_LAMBDA_FUNCTION_NAME' not in os.environ
+# releases the images replaced by uploads after the response is sent (see store_image)
+cleanup_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='s3-cleanup')
+# saves the images uploaded for editing to S3 while the back end edits them (see upload_to_S3)
+persist_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='s3-persist')
 dynamodb = boto3.resource('dynamodb', region_name='us-east-1',
                           aws_access_key_id=ConfigAWS["aws_access_key_id"],
                           aws_secret_access_key=ConfigAWS['aws_secret_access_key'])
 global table
-global results
-global URL
+# reference counts of the content-addressed objects, keyed by object_path
+global objects_table
+# images are stored in S3 under this prefix and the SHA-256 of their content
+OBJECT_PREFIX = 'objects/'
+# DynamoDB table name -> partition key name
+TABLE_KEYS = {'images': 'image_key', 'objects': 'object_path'}
+
+GALLERY_PER_PAGE = 4
+# the item of the 'objects' table counting the items of the 'images' table, kept up to date by the writes
+IMAGE_COUNT_KEY = 'counter/images'
+# seconds the gallery's total image count is reused before the counter is read again
+GALLERY_COUNT_TTL = 60
+gallery_lock = threading.Lock()
+# page number -> ExclusiveStartKey of that page (None for page 1), learned while paging through the table
+gallery_cursors = {1: None}
+# (image count, time.monotonic() when it was counted), or None
+gallery_count = None
+
+# browsers and proxies may store images but must revalidate them (a cheap 304) before reuse, since
+# uploading to an existing key replaces the image behind the same URL
+IMAGE_CACHE_CONTROL = 'public, no-cache'
+# bytes per chunk when streaming an object from S3 to the client
+IMAGE_CHUNK_SIZE = 65536
+# seconds an edited image is kept in the memcache for its result page and the save form
+EDIT_RESULT_TTL = 600
+# edited images are also kept in S3 under this prefix and their token, so their page and save form still
+# work once the memcache dropped them or on another process; the bucket expires them with a lifecycle rule
+RESULT_PREFIX = 'results/'
+# length of the hexadecimal tokens of edited images
+RESULT_TOKEN_LENGTH = 32
+# share of the memcache capacity the edit results stashed by one process may take, so they do not push
+# hot images out; past it the oldest results are dropped first
+EDIT_RESULT_SHARE = 0.05
+result_lock = threading.Lock()
+# token -> (size in bytes, time.monotonic() when it expires) of the results stashed by this process, oldest first
+stashed_results = OrderedDict()
+# leading bytes of the image formats that can be uploaded -> Content-Type
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'8BPS', 'image/vnd.adobe.photoshop'),
+    (b'gimp xcf', 'image/x-xcf'),
+)
+
+class DigestFile:
+    """File that hashes everything written to it, so an upload is hashed while it streams in.
+
+    Args:
+        file (file object): The file the data is stored in.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+
+class DigestRequest(webapp.request_class):
+    """Request whose uploaded files are DigestFiles, hashed as the multipart body is parsed."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return DigestFile(super()._get_file_stream(total_content_length, content_type, filename, content_length))
+
+
+webapp.request_class = DigestRequest
+
+
+def content_digest(image_file):
+    """SHA-256 of an uploaded file.
+
+    Args:
+        image_file (FileStorage): The uploaded file.
+
+    Returns:
+        str: The hex digest, taken from the DigestFile the upload was stored in; a file that was not
+        parsed by DigestRequest is read once and rewound.
+    """
+    stream = image_file.stream
+    if isinstance(stream, DigestFile):
+        return stream.digest.hexdigest()
+    digest = hashlib.sha256()
+    position = stream.tell()
+    for chunk in iter(lambda: stream.read(IMAGE_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(position)
+    return digest.hexdigest()
+
+
+def object_path(digest):
+    """S3 key of the stored object with the given content hash. Identical images share one object."""
+    return OBJECT_PREFIX + digest
 
-# Function to check if the file exists in the bucket
-def checkKeyBucket(file):
-    """Check if the file exists in the S3 bucket.
+
+def acquire_object(digest, source):
+    """Take a reference to the stored object with this content, storing it and its renditions if it is new.
+
+    The reference count of the object is kept in the DynamoDB table 'objects' and incremented
+    atomically. The object is marked 'stored' only once it and its renditions are in S3, so an upload
+    that finds the mark only adds a reference. One that does not, because the first upload of the same
+    bytes is still storing them or has failed, stores them as well: the S3 key is the content hash, so
+    writing it twice is harmless.
 
     Args:
-        file (str): The file name (Key) to check in the S3 bucket.
+        digest (str): The SHA-256 hex digest of the image.
+        source (bytes or file object): The image. A file object is read from its current position.
 
     Returns:
-        bool: True if the file exists in the bucket, False otherwise.
+        dict: The DynamoDB attributes of the image: 'image_path' and those of its renditions.
+        Raises ClientError if the image cannot be stored, in which case the reference is released.
     """
+    path = object_path(digest)
+    renditions = {}
+    record = objects_table.update_item(
+        Key={'object_path': path},
+        UpdateExpression="add refs :one",
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='ALL_NEW')['Attributes']
+    if record.get('stored'):
+        return dict({name + '_path': record[name + '_path'] for name in RENDITIONS if name + '_path' in record},
+                    image_path=path)
     try:
-        s3_boto.meta.client.head_object(Bucket=bucket_name, Key=file)
-        return True
-    except ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            return False
-        logging.error(f"Error checking S3 bucket: {e}")
+        if isinstance(source, (bytes, bytearray)):
+            renditions = store_renditions(path, source)
+            s3_client.put_object(Bucket=bucket_name, Key=path, Body=source, ContentType=image_mimetype(source))
+        else:
+            start = source.tell()
+            content_type = image_mimetype(source.read(8))
+            source.seek(start)
+            # make the renditions first: upload_fileobj closes the file when it is done
+            renditions = store_renditions(path, source)
+            source.seek(start)
+            s3_client.upload_fileobj(source, bucket_name, path, ExtraArgs={'ContentType': content_type},
+                                     Config=TRANSFER_CONFIG)
+        # only now mark it stored, and only while the record still exists, so no record is made without refs
+        attributes = dict(renditions, stored=True)
+        objects_table.update_item(
+            Key={'object_path': path},
+            UpdateExpression="set " + ", ".join(f"{attribute} = :{attribute}" for attribute in attributes),
+            ConditionExpression="attribute_exists(object_path)",
+            ExpressionAttributeValues={':' + attribute: value for attribute, value in attributes.items()})
+    except ClientError:
+        release_object(dict(renditions, image_path=path))
         raise
+    return dict(renditions, image_path=path)
 
 
-def processDuplicateFilename(filename):
-    """If a duplicate file name is found, add a number after it to make it unique.
+def release_object(item):
+    """Drop a reference to the stored object of an item, deleting it and its renditions with the last one.
 
     Args:
-        filename (str): The original filename to process.
+        item (dict): The DynamoDB item, or any dict with its 'image_path' and rendition paths.
 
     Returns:
-        str: The final unique filename after handling duplicates.
+        bool: True if the object was deleted. Objects stored before content addressing have no
+        reference count and are always deleted; a content-addressed object without a record was
+        already released and is left alone.
     """
-    finalName = filename
-    count = 1
-    if checkKeyBucket(finalName):
-        name, extension = os.path.splitext(finalName)
-        finalName = name + str(count) + extension
-    while checkKeyBucket(finalName):
-        count = count + 1
-        name, extension = os.path.splitext(finalName)
-        finalName = name[:-1] + str(count) + extension
-    return finalName
+    path = item['image_path']
+    try:
+        record = objects_table.update_item(
+            Key={'object_path': path},
+            UpdateExpression="add refs :minus",
+            ConditionExpression="attribute_exists(object_path)",
+            ExpressionAttributeValues={':minus': -1},
+            ReturnValues='ALL_NEW')['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if path.startswith(OBJECT_PREFIX):
+            # deleted with its last reference already, or by a purge; an upload storing the same bytes
+            # again has a new record and must keep the object
+            return False
+        record = {'refs': 0}
+    else:
+        if record['refs'] > 0:
+            return False
+        # forget the object before deleting it, unless an upload of the same bytes took a reference meanwhile
+        try:
+            objects_table.delete_item(Key={'object_path': path},
+                                      ConditionExpression="refs <= :zero",
+                                      ExpressionAttributeValues={':zero': 0})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+    paths = dict(item, **record)
+    s3_client.delete_object(Bucket=bucket_name, Key=path)
+    for name in RENDITIONS:
+        if paths.get(name + '_path'):
+            s3_client.delete_object(Bucket=bucket_name, Key=paths[name + '_path'])
+    return True
 
 
 def upload_to_S3(image_path):
-    """Upload the image to the S3 bucket.
+    """Read an image uploaded for editing and save a copy of it to the S3 bucket in the background.
 
-    If the filename already exists in the bucket, it handles the duplicate filename scenario
-    by adding a unique number after the filename.
+    The edit routes send the bytes read here straight to the back end, so the request neither waits
+    for the S3 upload nor downloads the object again. Unless DEFER_WORK, the upload still overlaps the
+    edit but the response waits for it, since the container may be frozen once it is returned.
 
     Args:
         image_path (FileStorage): The uploaded image file object.
 
     Returns:
-        str: The S3 object key (file path) where the image is saved.
+        tuple: (the S3 object key the image is saved under, the image content in bytes).
     """
     filename = "image/" + image_path.filename
-    # save image to s3
+    content = image_path.read()
+
+    def save():
+        try:
+            s3_client.put_object(Bucket=bucket_name, Key=filename, Body=content)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(f"Error saving {filename} to S3: {e}")
+
+    saving = persist_pool.submit(save)
+    if not DEFER_WORK:
+        @after_this_request
+        def saved(response):
+            saving.result()
+            return response
+    return filename, content
+
+
+def store_renditions(image_path, source):
+    """Make the thumbnail and preview renditions of an image and upload them to S3 next to it.
+
+    Args:
+        image_path (str): The S3 key of the original image.
+        source (bytes or file object): The original image. A file object is read from its current position.
+
+    Returns:
+        dict: The DynamoDB attributes ('thumbnail_path', 'preview_path') of the uploaded renditions, or an
+        empty dict if none could be made, in which case the gallery shows the original.
+    """
+    paths = {}
+    for name, data in makeRenditions(source).items():
+        path = renditionPath(image_path, name)
+        try:
+            s3_client.put_object(Bucket=bucket_name, Key=path, Body=data, ContentType='image/jpeg')
+        except ClientError as e:
+            logging.error(f"Error uploading {name} rendition of {image_path}: {e}")
+            return {}
+        paths[name + '_path'] = path
+    return paths
+
+
+def image_path_update(image_path, renditions):
+    """Build the update_item arguments that point an existing item at a new image and its renditions.
+
+    Args:
+        image_path (str): The S3 key of the new original image.
+        renditions (dict): The rendition attributes returned by store_renditions.
+
+    Returns:
+        dict: UpdateExpression and ExpressionAttributeValues; rendition attributes the new image does not
+        have are removed from the item.
+    """
+    assignments = ["image_path = :p"]
+    values = {':p': image_path}
+    removals = []
+    for name in RENDITIONS:
+        attribute = name + '_path'
+        if attribute in renditions:
+            assignments.append(f"{attribute} = :{name}")
+            values[':' + name] = renditions[attribute]
+        else:
+            removals.append(attribute)
+    expression = "set " + ", ".join(assignments)
+    if removals:
+        expression += " remove " + ", ".join(removals)
+    return {'UpdateExpression': expression, 'ExpressionAttributeValues': values}
+
+
+def rendition_cache_key(image_key, name):
+    """Memcache key under which the /image route caches rendition name of the image stored under image_key."""
+    return f"rendition:{name}:{image_key}"
+
+
+def after_response(pool, work):
+    """Run work on a pool, so the response does not wait for it, or right away unless DEFER_WORK.
+
+    Args:
+        pool (ThreadPoolExecutor): The pool of long-lived server modes.
+        work (callable): Called without arguments.
+
+    Returns:
+        Future: The result of work.
+    """
+    if DEFER_WORK:
+        return pool.submit(work)
+    future = Future()
     try:
-        s3_boto.meta.client.upload_fileobj(image_path, bucket_name, filename)
-    except ClientError as e:
-        return redirect(url_for('failure', msg="Upload error"))
+        future.set_result(work())
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def release_later(item):
+    """Release the stored image of a replaced DynamoDB item on the cleanup_pool; failures are logged.
+
+    On Lambda the image is released before the response instead (see after_response).
+
+    Args:
+        item (dict): The old DynamoDB item.
+
+    Returns:
+        Future: The release, whose result is True if the S3 objects were deleted.
+    """
+    def release():
+        try:
+            return release_object(item)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(f"Could not release {item['image_path']} of key {item['image_key']}: {e}")
+            return False
+
+    return after_response(cleanup_pool, release)
+
+
+def item_version(item):
+    """Version of the image of a DynamoDB item: the number of times its key was written, 0 if never counted."""
+    return int(item.get('version', 0))
+
+
+def cache_written_image(image_key, version, content=None):
+    """Update the memcache after a key was pointed at a new image.
+
+    In the 'write-through' memcacheConfig['writeMode'] the new image is put in the memcache under its
+    key, if it is given and small enough to cache; otherwise the cached image is invalidated. The
+    cached renditions are always invalidated. Both are versioned, so a slower writer of the same key,
+    or a read that looked the key up before the write, cannot cache an older image afterwards.
+
+    Args:
+        image_key (str): The key.
+        version (int): The item version the write produced.
+        content (bytes, optional): The new image.
+
+    Returns:
+        bool: True if the cached images of the key were replaced or invalidated.
+    """
+    cached = (content is not None and memcacheConfig.get('writeMode') == 'write-through'
+              and len(content) <= max_buffered_size() and subPUT(image_key, content, version=version))
+    return all([cached or subInvalidateKey(image_key, version)] +
+               [subInvalidateKey(rendition_cache_key(image_key, name), version) for name in RENDITIONS])
+
+
+def store_image(image_key, attributes, content=None):
+    """Point a key at a stored image with a single upsert, and release the image it replaces.
+
+    The item is written with one update_item, which inserts it if the key is new, and ReturnValues
+    ALL_OLD returns the item it replaced, so no get_item is needed beforehand. The same update
+    increments the version of the item. The cached images of the key are replaced or invalidated right
+    away (see cache_written_image); the old image is released by the cleanup_pool after the response,
+    or before it on Lambda.
+
+    Args:
+        image_key (str): The key.
+        attributes (dict): The attributes returned by acquire_object.
+        content (bytes, optional): The new image, to write through to the memcache.
+
+    Returns:
+        bool: True if the cached images of the key were replaced or invalidated. Raises ClientError if
+        the item cannot be written, in which case the reference to the new image is released.
+    """
+    update = image_path_update(attributes['image_path'], attributes)
+    update['UpdateExpression'] += " add version :one"
+    update['ExpressionAttributeValues'][':one'] = 1
+    # drop the key from the negative cache before the write, so no lookup is turned away once the item
+    # exists, and again after it, since a lookup that missed before the write may record the key meanwhile
+    addKeys([image_key])
+    try:
+        response = table.update_item(
+            Key={
+                'image_key': image_key
+            },
+            ReturnValues='ALL_OLD',
+            **update)
+    except ClientError:
+        release_object(attributes)
+        raise
+    addKeys([image_key])
+    # the update is atomic, so the version it replaced plus one is the version it wrote
+    invalidated = cache_written_image(image_key, item_version(response.get('Attributes', {})) + 1, content)
+    if 'Attributes' in response:
+        release_later(response['Attributes'])
+    else:
+        count_new_images(1)
+        invalidate_gallery()
+    return invalidated
+
 
-    return filename
+def get_images_batch(image_keys):
+    """Read the items of many keys from the DynamoDB table 'images' with batch_get_item.
+
+    Args:
+        image_keys (list): The keys, at most 100 per batch_get_item call.
+
+    Returns:
+        dict: image_key -> item, for the keys that have one. Keys DynamoDB leaves unprocessed are asked
+        for again until every key is answered.
+    """
+    items = {}
+    for start in range(0, len(image_keys), 100):
+        request_items = {table.name: {'Keys': [{'image_key': image_key}
+                                               for image_key in image_keys[start:start + 100]]}}
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(table.name, []):
+                items[item['image_key']] = item
+            request_items = response.get('UnprocessedKeys')
+    return items
+
+
+def store_images(attributes):
+    """Point many keys at stored images with batched writes, and release the images they replace.
+
+    The bulk form of store_image: the replaced items are read with get_images_batch and the new ones
+    written through table.batch_writer, 25 to a request, each one version past the item it replaces.
+    Unlike the upsert of store_image this is not atomic per key, so an image stored by a single upload of
+    the same key between the read and the write is not released; it keeps its reference and stays in S3.
+    The cached images of the keys are invalidated, not written through.
+
+    Args:
+        attributes (dict): image_key -> the attributes returned by acquire_object.
+
+    Returns:
+        bool: True if the cached images of the keys were invalidated. Raises ClientError if the items
+        cannot be written; since some may have been written, no reference is released then.
+    """
+    old = get_images_batch(list(attributes))
+    versions = {image_key: item_version(old.get(image_key, {})) + 1 for image_key in attributes}
+    addKeys(attributes)
+    with table.batch_writer() as batch:
+        for image_key, item in attributes.items():
+            batch.put_item(Item=dict(item, image_key=image_key, version=versions[image_key]))
+    addKeys(attributes)
+    cache_versions = {cache_key: versions[image_key] for image_key in attributes
+                      for cache_key in [image_key] + [rendition_cache_key(image_key, name) for name in RENDITIONS]}
+    invalidated = subInvalidateKeys(list(cache_versions), cache_versions)
+    for item in old.values():
+        release_later(item)
+    if len(old) < len(attributes):
+        count_new_images(len(attributes) - len(old))
+        invalidate_gallery()
+    return invalidated
 
 
 @webapp.route('/delete_table', methods=['GET', 'POST'])
 def delete_table():
-    """Delete the DynamoDB table 'images' if it exists.
+    """Delete the DynamoDB tables 'images' and 'objects' if they exist.
 
-    This function deletes the table 'images' and waits until the table is deleted before returning.
+    This function deletes the tables and waits until they are deleted before returning.
 
     Returns:
         Redirect: Redirects to the 'failure' page if there's an error, otherwise, returns None.
     """
-    try:
-        response = dynamodb.meta.client.delete_table(TableName='images')
-        waiter = dynamodb.meta.client.get_waiter('table_not_exists')
-        waiter.wait(TableName="images")
-    except dynamodb.meta.client.exceptions.ResourceNotFoundException:
-        pass
-    except Exception as e:
-        logging.error(f"Error deleting table: {e}")
-        return redirect(url_for('failure', msg="Error deleting table"))
+    for table_name in TABLE_KEYS:
+        try:
+            response = dynamodb.meta.client.delete_table(TableName=table_name)
+            waiter = dynamodb.meta.client.get_waiter('table_not_exists')
+            waiter.wait(TableName=table_name)
+        except dynamodb.meta.client.exceptions.ResourceNotFoundException:
+            pass
+        except Exception as e:
+            logging.error(f"Error deleting table: {e}")
+            return redirect(url_for('failure', msg="Error deleting table"))
 
 @webapp.route('/truncate_table', methods=['GET', 'POST'])
 def truncate_table():
-    """Empty the DynamoDB table 'images'.
+    """Empty the DynamoDB tables 'images' and 'objects' in the background.
 
-    This function scans all items in the 'images' table and deletes them in batches.
+    Every table is read with a parallel scan and its items deleted in batches by a purge job (see
+    FrontEnd/purge.py); the gallery is invalidated when the job is done. On Lambda the job is run to the
+    end before the response (see DEFER_WORK).
 
     Returns:
-        Redirect: Redirects to the 'failure' page if there's an error, otherwise, returns None.
+        Response: A JSON response with the id of the purge job, whose progress is reported by
+        '/clear_data/<job_id>', or 409 if a purge of something else is running.
     """
     try:
-        scan = table.scan()
-        with table.batch_writer() as batch:
-            for each in scan['Items']:
-                batch.delete_item(
-                    Key={
-                        'image_key': each['image_key']
-                    }
-                )
-    except Exception as e:
-        logging.error(f"Error truncating table: {e}")
-        return redirect(url_for('failure', msg="Error truncating table"))
+        job = startPurge({table: 'image_key', objects_table: 'object_path'}, on_done=tables_purged,
+                         background=DEFER_WORK)
+    except PurgeBusy as e:
+        return purge_busy_response(e.job)
+    return purge_response(job)
+
+
+def purge_response(job):
+    """Build the 202 JSON response of a route that started a purge job."""
+    data = {
+        "success": "true",
+        "job_id": job.id,
+        "status_url": url_for('clear_data_status', job_id=job.id),
+    }
+    return webapp.response_class(
+        response=json.dumps(data),
+        status=202,
+        mimetype='application/json')
+
+
+def purge_busy_response(job):
+    """Build the 409 JSON response of a route whose purge was refused while another job runs."""
+    data = {
+        "success": "false",
+        "error": {
+            "code": 409,
+            "message": "Another purge is running",
+            "job_id": job.id,
+            "status_url": url_for('clear_data_status', job_id=job.id),
+        }}
+    return webapp.response_class(
+        response=json.dumps(data),
+        status=409,
+        mimetype='application/json')
+
+
+def tables_purged(job):
+    """Forget the gallery cursors and the image counter once a purge job has emptied the tables.
+
+    The counter is deleted even if the purge missed it, since it may have been counted while the purge
+    ran; the next count_images counts the table again.
+
+    Args:
+        job (PurgeJob): The finished job.
+
+    Returns:
+        None
+    """
+    objects_table.delete_item(Key={'object_path': IMAGE_COUNT_KEY})
+    invalidate_gallery()
+
+
+def purge_done(job):
+    """Forget everything cached about the purged images once a purge job of all image data is done.
+
+    Args:
+        job (PurgeJob): The finished job.
+
+    Returns:
+        None: Raises RuntimeError if the memcache could not be cleared, which is recorded by the job.
+    """
+    tables_purged(job)
+    if not subCLEAR():
+        raise RuntimeError("Memcache data clearing error")
+
 
 @webapp.route('/create_table', methods=['GET', 'POST'])
 def create_table():
-    """Create the DynamoDB table 'images' if it does not exist.
+    """Create the DynamoDB tables 'images' and 'objects' if they do not exist.
 
-    This function creates the table 'images' with a primary key 'image_key' if it does not already exist.
+    This function creates the table 'images' with a primary key 'image_key', and the table 'objects'
+    holding the reference counts of the stored images with a primary key 'object_path', if they do not
+    already exist.
 
     Returns:
         Redirect: Redirects to the 'failure' page if there's an error, otherwise, returns a JSON response.
     """
-    try:
-        new_table = dynamodb.create_table(
-            TableName='images',
-            KeySchema=[
-                {
-                    'AttributeName': 'image_key',
-                    'KeyType': 'HASH'  # Partition key
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    'AttributeName': 'image_key',
-                    'AttributeType': 'S'
+    for table_name, key_name in TABLE_KEYS.items():
+        try:
+            new_table = dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[
+                    {
+                        'AttributeName': key_name,
+                        'KeyType': 'HASH'  # Partition key
+                    }
+                ],
+                AttributeDefinitions=[
+                    {
+                        'AttributeName': key_name,
+                        'AttributeType': 'S'
+                    }
+                ],
+                ProvisionedThroughput={
+                    'ReadCapacityUnits': 10,
+                    'WriteCapacityUnits': 10
                 }
-            ],
-            ProvisionedThroughput={
-                'ReadCapacityUnits': 10,
-                'WriteCapacityUnits': 10
-            }
-        )
-        # wait until the table is created
-        waiter = dynamodb.meta.client.get_waiter('table_exists')
-        waiter.wait(TableName='images')
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        pass
-    except Exception as e:
-        logging.error(f"Error creating table: {e}")
-        return redirect(url_for('failure', msg="Error creating table"))
-
-    global table
+            )
+            # wait until the table is created
+            waiter = dynamodb.meta.client.get_waiter('table_exists')
+            waiter.wait(TableName=table_name)
+        except dynamodb.meta.client.exceptions.ResourceInUseException:
+            pass
+        except Exception as e:
+            logging.error(f"Error creating table: {e}")
+            return redirect(url_for('failure', msg="Error creating table"))
+
+    global table, objects_table
     table = dynamodb.Table('images')
+    objects_table = dynamodb.Table('objects')
     data = {
         "success": "true",
     }
@@ -186,24 +687,21 @@ def create_table():
 
 @webapp.route('/clearImageData', methods=['GET', 'POST'])
 def clearImageData():
-    """Clear all image data from the S3 bucket and DynamoDB table 'images'.
+    """Clear all image data from the S3 bucket, the DynamoDB tables and the memcache in the background.
 
-    This function deletes all objects in the S3 bucket and empties the 'images' table in DynamoDB.
+    The purge job deletes the objects of the bucket with delete_objects, 1000 keys per call, while it
+    empties the tables with parallel scans; the memcache is cleared when it is done. On Lambda the job is
+    run to the end before the response (see DEFER_WORK).
 
     Returns:
-        Response: A JSON response indicating the success or failure of the data clearing process.
+        Response: A JSON response with the id of the purge job, 409 if a purge of the tables only is
+        running, or one indicating the failure to start it.
     """
     try:
-        # clear s3 data
-        bucket.objects.all().delete()
-        truncate_table()
-        data = {
-            "success": "true",
-        }
-        response = webapp.response_class(
-            response=json.dumps(data),
-            status=200,
-            mimetype='application/json')
+        job = startPurge({table: 'image_key', objects_table: 'object_path'}, s3_client, bucket_name,
+                         on_done=purge_done, background=DEFER_WORK)
+    except PurgeBusy as e:
+        return purge_busy_response(e.job)
     except Exception as e:
         logging.error(f"Error clearing image data: {e}")
         data = {
@@ -212,34 +710,20 @@ def clearImageData():
                 "code": 500,
                 "message": "Clear Data Error"
             }}
-        response = webapp.response_class(
+        return webapp.response_class(
             response=json.dumps(data),
             status=500,
             mimetype='application/json')
-    return response
-
-def waitTableActive():
-    """Wait until the DynamoDB table 'images' is in the 'ACTIVE' state.
-
-    This function continuously checks the status of the 'images' table until it becomes active.
-
-    Returns:
-        None: Once the table becomes active, the function returns.
-    """
-    while True:
-        response = dynamodb.meta.client.describe_table(
-            TableName='images'
-        )
-        if response['Table']['TableStatus'] == 'ACTIVE':
-            break
-
+    return purge_response(job)
 
 @webapp.before_first_request
 def runOnAppStart():
     """This function is executed before the first request to the Flask app.
 
     It creates or retrieves the S3 bucket 'group-31-images', clears the image data from the S3 bucket,
-    creates the DynamoDB table 'images', and stores the public IP address in the 'URL' variable.
+    creates the DynamoDB tables and waits until they are active (requests do not check this again), starts the memcache sweeper that expires and evicts cached
+    images in the background, starts warming the memcache from its last snapshot, and points the
+    back-end client at the back ends and starts their health checks.
 
     Returns:
         None: This function only performs setup tasks on app start.
@@ -251,13 +735,25 @@ def runOnAppStart():
     # bucket.objects.all().delete()
     # clearImageData()
     create_table()
+    startSweeper()
+    startSnapshots()
+    edit_client.pool.set_endpoints(backend_endpoints())
+    startHealthChecks()
+
+
+def backend_endpoints():
+    """Return the base URLs of the back ends.
+
+    Returns:
+        list: backendConfig['endpoints'] if set, otherwise the public addresses of the EC2 instances in
+        backendConfig['instances'] with the back-end port.
+    """
+    if backendConfig['endpoints']:
+        return list(backendConfig['endpoints'])
     ec2_client = boto3.resource('ec2', aws_access_key_id=ConfigAWS["aws_access_key_id"],
                                 aws_secret_access_key=ConfigAWS['aws_secret_access_key'])
-
-    instance = ec2_client.Instance("i-0c841e13abbf09d94")
-    public_IP = instance.public_ip_address
-    global URL
-    URL = "http://" + public_IP + ":5001"
+    return [f"http://{ec2_client.Instance(instance_id).public_ip_address}:{backendConfig['port']}"
+            for instance_id in backendConfig['instances']]
 
 
 def allowed_file(filename):
@@ -307,31 +803,506 @@ def failure():
     return render_template("failure.html", msg=msg)
 
 
-def get_images(offset=0, per_page=4):
-    """Get images from the DynamoDB table 'images' with pagination.
+def invalidate_gallery():
+    """Forget the cached gallery page cursors and image count after the table has changed.
 
-    This function retrieves images from the 'images' table in DynamoDB and paginates the results.
+    Returns:
+        None
+    """
+    global gallery_count
+    with gallery_lock:
+        gallery_cursors.clear()
+        gallery_cursors[1] = None
+        gallery_count = None
 
-    Args:
-        offset (int, optional): The starting index for pagination. Defaults to 0.
-        per_page (int, optional): The number of images per page. Defaults to 4.
+
+def count_images():
+    """Read the number of items in the DynamoDB table 'images', reusing it for GALLERY_COUNT_TTL seconds.
+
+    The number is kept in the IMAGE_COUNT_KEY item of the 'objects' table, which the writes of new keys
+    increment (see count_new_images). Only if that item is missing, e.g. after a purge, is the table
+    counted with a Select='COUNT' scan, and the item created with the result.
 
     Returns:
-        list: A list of images with the specified pagination settings.
+        int: The number of images stored.
     """
-    response = table.scan()
-    global results
-    results = response['Items']
-    for i in range(len(results)):
-        path = results[i]['image_path']
+    global gallery_count
+    with gallery_lock:
+        if gallery_count is not None and time.monotonic() - gallery_count[1] < GALLERY_COUNT_TTL:
+            return gallery_count[0]
+    counter = objects_table.get_item(Key={'object_path': IMAGE_COUNT_KEY}).get('Item')
+    if counter is not None:
+        count = int(counter['images'])
+    else:
+        count = 0
+        scan_kwargs = {'Select': 'COUNT'}
+        while True:
+            response = table.scan(**scan_kwargs)
+            count += response['Count']
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
         try:
-            obj = bucket.Object(path)
-            base64_image = base64.b64encode(obj.get()['Body'].read()).decode('utf-8')
-            results[i]['image_path'] = base64_image
+            objects_table.put_item(Item={'object_path': IMAGE_COUNT_KEY, 'images': count},
+                                   ConditionExpression="attribute_not_exists(object_path)")
         except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                return redirect(url_for('failure', msg="Key not exist in S3 error"))
-    return results[offset: offset + per_page]
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    with gallery_lock:
+        gallery_count = (count, time.monotonic())
+    return count
+
+
+def count_new_images(count):
+    """Add newly written keys to the image counter, unless it is missing and will be counted anew.
+
+    Args:
+        count (int): The number of keys that had no item before.
+
+    Returns:
+        None
+    """
+    try:
+        objects_table.update_item(
+            Key={'object_path': IMAGE_COUNT_KEY},
+            UpdateExpression="add images :count",
+            ConditionExpression="attribute_exists(object_path)",
+            ExpressionAttributeValues={':count': count})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logging.error(f"Could not count {count} new images: {e}")
+
+
+def scan_page(start_key, per_page, **scan_kwargs):
+    """Scan one page of the 'images' table.
+
+    Args:
+        start_key (dict): The ExclusiveStartKey of the page, or None for the first page.
+        per_page (int): The number of items on a page.
+        **scan_kwargs: Extra arguments for table.scan, e.g. a ProjectionExpression.
+
+    Returns:
+        tuple: (items, start key of the next page or None if this is the last page).
+    """
+    items = []
+    while len(items) < per_page:
+        if start_key is not None:
+            scan_kwargs['ExclusiveStartKey'] = start_key
+        response = table.scan(Limit=per_page - len(items), **scan_kwargs)
+        items.extend(response['Items'])
+        start_key = response.get('LastEvaluatedKey')
+        if start_key is None:
+            break
+    return items, start_key
+
+
+def page_cursor(page, per_page):
+    """Find the ExclusiveStartKey of a gallery page.
+
+    Pages visited before are looked up in gallery_cursors. Otherwise the table is paged forward
+    from the closest known page, reading only the image keys.
+
+    Args:
+        page (int): The page number, starting at 1.
+        per_page (int): The number of images per page.
+
+    Returns:
+        tuple: (True, start key) if the page exists, (False, None) if the table has fewer pages.
+    """
+    with gallery_lock:
+        known = max(number for number in gallery_cursors if number <= page)
+        start_key = gallery_cursors[known]
+    while known < page:
+        items, start_key = scan_page(start_key, per_page, ProjectionExpression='image_key')
+        if start_key is None:
+            return False, None
+        known += 1
+        with gallery_lock:
+            gallery_cursors[known] = start_key
+    return True, start_key
+
+
+def gallery_source(item, rendition):
+    """Find where the image of an item is loaded from.
+
+    Args:
+        item (dict): The DynamoDB item.
+        rendition (str): 'thumbnail' or 'preview' for that rendition if the item has one, or
+            'original' for the uploaded image.
+
+    Returns:
+        tuple: (S3 key, memcache key) of the rendition, or of the original if the item has no such rendition.
+    """
+    path = item.get(rendition + '_path')
+    if path:
+        return path, rendition_cache_key(item['image_key'], rendition)
+    return item['image_path'], item['image_key']
+
+
+def get_images(page=1, per_page=GALLERY_PER_PAGE):
+    """Get one page of items from the DynamoDB table 'images'.
+
+    Only the items of the requested page are read from the table, using Limit and ExclusiveStartKey.
+    The images themselves are not loaded here: the gallery page links each of them to the /image
+    route, and the browser fetches them concurrently and keeps them in its HTTP cache.
+
+    Args:
+        page (int, optional): The page number, starting at 1. Defaults to 1.
+        per_page (int, optional): The number of images per page. Defaults to GALLERY_PER_PAGE.
+
+    Returns:
+        list: The items of the page.
+    """
+    found, start_key = page_cursor(page, per_page)
+    if not found:
+        return []
+    items, next_key = scan_page(start_key, per_page)
+    if next_key is not None:
+        with gallery_lock:
+            gallery_cursors[page + 1] = next_key
+    return items
+
+
+def image_mimetype(content):
+    """Content-Type of an image, recognised from its leading bytes.
+
+    Args:
+        content (bytes): The image.
+
+    Returns:
+        str: The MIME type, or 'application/octet-stream' for a format not in IMAGE_SIGNATURES.
+    """
+    head = bytes(content[:8])
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+
+def image_etag(content):
+    """Strong ETag of an image: a hash of its content, so the same bytes get the same tag from every source.
+
+    Args:
+        content (bytes): The image.
+
+    Returns:
+        str: The unquoted entity tag.
+    """
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def max_buffered_size():
+    """Largest object the /image route reads whole from S3: the largest image the memcache admits.
+
+    Returns:
+        float: The size in bytes (see maxItemSize).
+    """
+    return maxItemSize()
+
+
+def send_image(content):
+    """Respond with an image held in memory.
+
+    The response carries the Content-Type, a strong ETag and Cache-Control, and is made conditional:
+    If-None-Match is answered with 304 Not Modified and a Range request with 206 Partial Content.
+
+    Args:
+        content (bytes): The image.
+
+    Returns:
+        Response: The image response.
+    """
+    response = send_file(io.BytesIO(content), mimetype=image_mimetype(content), etag=image_etag(content))
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    return response
+
+
+def object_mimetype(path, s3_object):
+    """Content-Type of an S3 object: the one it was stored with, else guessed from its key (older uploads).
+
+    Args:
+        path (str): The S3 object key.
+        s3_object (dict): The GetObject response.
+
+    Returns:
+        str: The MIME type.
+    """
+    content_type = s3_object.get('ContentType')
+    if content_type and content_type not in ('binary/octet-stream', 'application/octet-stream'):
+        return content_type
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def stream_object(path, cache_key, version=None):
+    """Respond with an S3 object, caching it in the memcache when it is small enough.
+
+    An object the memcache could admit is read whole, put in the memcache and sent with send_image,
+    so it gets the same content ETag as when it is later served from the memcache. A larger object is
+    never cached and is streamed to the client in IMAGE_CHUNK_SIZE chunks as it arrives from S3, with
+    the ETag S3 keeps for it; a Range request for it is passed on to S3.
+
+    Args:
+        path (str): The S3 object key.
+        cache_key (str): The memcache key to cache the object under.
+        version (int, optional): The version of the item the object was found through; the object is not
+            cached if a newer version has been written meanwhile.
+
+    Returns:
+        Response: The image response. Aborts with 404 if the object does not exist.
+    """
+    try:
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=path)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            abort(404)
+        raise
+    if s3_object['ContentLength'] <= max_buffered_size():
+        content = s3_object['Body'].read()
+        if not subPUT(cache_key, content, version=version):
+            logging.info(f"Image {cache_key} not admitted to memcache")
+        return send_image(content)
+
+    etag = s3_object['ETag'].strip('"')
+    status = 200
+    if request.if_none_match.contains(etag):
+        s3_object['Body'].close()
+        status = 304
+    elif request.range is not None and request.if_range.date is None and request.if_range.etag in (None, etag):
+        s3_object['Body'].close()
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=path, Range=request.headers['Range'])
+        status = 206 if 'ContentRange' in s3_object else 200
+
+    def chunks(body):
+        try:
+            yield from body.iter_chunks(IMAGE_CHUNK_SIZE)
+        finally:
+            body.close()
+
+    response = webapp.response_class(
+        response=chunks(s3_object['Body']) if status != 304 else None,
+        status=status,
+        mimetype=object_mimetype(path, s3_object))
+    if status != 304:
+        response.content_length = s3_object['ContentLength']
+        if status == 206:
+            response.headers['Content-Range'] = s3_object['ContentRange']
+    response.set_etag(etag)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    return response
+
+
+@webapp.route('/image/<path:image_key>')
+def image(image_key):
+    """Serve the image stored under a key.
+
+    Templates reference images through this route instead of inlining them, so browsers fetch them
+    in parallel and revalidate them with If-None-Match. The image is served from the memcache when it
+    is cached, otherwise from S3 (see stream_object).
+
+    Args:
+        image_key (str): The key of the image.
+
+    Returns:
+        Response: The image, or 404 if there is no image under the key. With ?rendition=thumbnail or
+        ?rendition=preview the rendition is served instead, or the original if the image has none.
+    """
+    rendition = request.args.get('rendition', 'original')
+    if rendition not in RENDITIONS:
+        rendition = 'original'
+    cache_key = image_key if rendition == 'original' else rendition_cache_key(image_key, rendition)
+    content = subGET(cache_key)
+    if content:
+        return send_image(content)
+    if not mayExist(image_key):
+        abort(404)
+    response = table.get_item(Key={'image_key': image_key})
+    if 'Item' not in response:
+        recordMissing(image_key)
+        abort(404)
+    path, source_key = gallery_source(response['Item'], rendition)
+    if source_key != cache_key:
+        content = subGET(source_key)
+        if content:
+            return send_image(content)
+    return stream_object(path, source_key, item_version(response['Item']))
+
+
+def result_cache_key(token):
+    """Memcache key of the edited image stashed under token."""
+    return "result:" + token
+
+
+def result_path(token):
+    """S3 key of the edited image stored under token."""
+    return RESULT_PREFIX + token
+
+
+def valid_token(token):
+    """Whether token may be the token of an edited image, so it is safe to use in an S3 key."""
+    return len(token) == RESULT_TOKEN_LENGTH and all(char in '0123456789abcdef' for char in token)
+
+
+def stash_result(content):
+    """Store an edited image in S3 under a new token, so its page and the save form can refer to it.
+
+    The image is also stashed in the memcache for EDIT_RESULT_TTL seconds, from which it is served while
+    it lasts; it is then written to S3 in the background (see after_response), else before returning.
+
+    Args:
+        content (bytes): The edited image.
+
+    Returns:
+        str: The token of the result for the /result route and the save form, or None if it could not
+        be stored, in which case the page inlines it.
+    """
+    token = uuid.uuid4().hex
+
+    def store():
+        s3_client.put_object(Bucket=bucket_name, Key=result_path(token), Body=content,
+                             ContentType=image_mimetype(content))
+
+    def store_logged():
+        try:
+            store()
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f"Error storing edited image {token}: {e}")
+
+    if cache_result(token, content):
+        after_response(persist_pool, store_logged)
+        return token
+    try:
+        store()
+    except (BotoCoreError, ClientError) as e:
+        logging.error(f"Error storing edited image {token}: {e}")
+        return None
+    return token
+
+
+def cache_result(token, content):
+    """Stash an edited image in the memcache for EDIT_RESULT_TTL seconds.
+
+    The results stashed by this process take at most EDIT_RESULT_SHARE of the memcache capacity: the
+    oldest of them are invalidated to make room for a new one, and one larger than the whole share is
+    not stashed.
+
+    Args:
+        token (str): The token of the result.
+        content (bytes): The edited image.
+
+    Returns:
+        bool: True if the memcache admitted the image.
+    """
+    share = memcacheConfig['capacity'] * 1048576 * EDIT_RESULT_SHARE
+    if len(content) > share:
+        return False
+    now = time.monotonic()
+    dropped = []
+    with result_lock:
+        total = 0
+        for stashed, (size, expires) in list(stashed_results.items()):
+            if expires <= now:
+                del stashed_results[stashed]
+            else:
+                total += size
+        while stashed_results and total + len(content) > share:
+            stashed, (size, expires) = stashed_results.popitem(last=False)
+            total -= size
+            dropped.append(stashed)
+        stashed_results[token] = (len(content), now + EDIT_RESULT_TTL)
+    subInvalidateKeys([result_cache_key(each) for each in dropped])
+    if subPUT(result_cache_key(token), content, ttl=EDIT_RESULT_TTL):
+        return True
+    with result_lock:
+        stashed_results.pop(token, None)
+    return False
+
+
+def stored_result(token):
+    """Read an edited image stored by stash_result from S3.
+
+    Args:
+        token (str): The token returned by stash_result.
+
+    Returns:
+        bytes: The image, or None if there is none under the token.
+    """
+    if not valid_token(token):
+        return None
+    try:
+        return s3_client.get_object(Bucket=bucket_name, Key=result_path(token))['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def load_result(token):
+    """Read an edited image stored by stash_result, from the memcache while it is stashed there, else S3.
+
+    Args:
+        token (str): The token returned by stash_result.
+
+    Returns:
+        bytes: The image, or None if there is none under the token.
+    """
+    content = subGET(result_cache_key(token))
+    if content:
+        return bytes(content)
+    return stored_result(token)
+
+
+@webapp.route('/result/<token>')
+def edit_result(token):
+    """Serve an edited image stored by stash_result.
+
+    Args:
+        token (str): The token returned by stash_result.
+
+    Returns:
+        Response: The image, or 404 if there is none under the token.
+    """
+    content = load_result(token)
+    if not content:
+        abort(404)
+    return send_image(content)
+
+
+def stash_results(original, result):
+    """Store the images of a result page with stash_result; this may wait on the memcache and S3.
+
+    Args:
+        original (bytes): The image the form saves.
+        result (bytes): The edited image shown on the page.
+
+    Returns:
+        tuple: The tokens of original and result, None for an image that could not be stored.
+    """
+    result_token = stash_result(result)
+    image_token = result_token if original is result else stash_result(original)
+    return image_token, result_token
+
+
+def render_result(template, original, result, tokens=None, **context):
+    """Render the page of an edited image, linking to the stored image instead of inlining it.
+
+    Args:
+        template (str): The template of the result page.
+        original (bytes): The image the form saves: the uploaded image for labelling, else the edited one.
+        result (bytes): The edited image shown on the page.
+        tokens (tuple, optional): What stash_results returned for the images, if they are stored already.
+        **context: Further template variables.
+
+    Returns:
+        Rendered Template: The result page. Images that could not be stored are inlined in base64.
+    """
+    image_token, result_token = tokens or stash_results(original, result)
+    return render_template(template,
+                           result_token=result_token,
+                           image_token=image_token,
+                           content=None if result_token else base64.b64encode(result).decode('utf-8'),
+                           image=None if image_token else base64.b64encode(original).decode('utf-8'),
+                           **context)
 
 
 @webapp.route('/image_gallery', methods=['GET', 'POST'])
@@ -342,14 +1313,17 @@ def image_gallery():
         Rendered Template: The rendered HTML template for the image gallery page.
     """
 
-    page = int(request.args.get('page', 1))
-    per_page = 4
-    offset = (page - 1) * per_page
+    page = max(int(request.args.get('page', 1)), 1)
+    per_page = GALLERY_PER_PAGE
+    rendition = request.args.get('rendition', 'thumbnail')
+    if rendition not in RENDITIONS:
+        rendition = 'original'
 
-    pagination_images = get_images(offset=offset, per_page=4)
-    pagination = Pagination(page=page, per_page=4, total=len(results), css_framework="bootstrap5")
+    pagination_images = get_images(page=page, per_page=per_page)
+    pagination = Pagination(page=page, per_page=per_page, total=count_images(), css_framework="bootstrap5")
     return render_template("image_gallery.html",
                            images=pagination_images,
+                           rendition=rendition,
                            page=page,
                            per_page=per_page,
                            pagination=pagination)
@@ -383,36 +1357,24 @@ def key():
     if image_key == '':
         return redirect(url_for('failure', msg="Key is empty"))
 
-    # get image directly if in cache
-    res = subGET(image_key)
-    if res:
-        return render_template('show_image.html', key=image_key, image=res)
+    # a cached image needs no lookup; the page loads the image itself through the /image route, which
+    # serves it from the memcache or S3
+    if subTOUCH(image_key):
+        return render_template('show_image.html', key=image_key)
 
-    # if image not in cache, get image from database
-    # check if database has the key or not
+    # otherwise check if database has the key or not, unless it was just found missing
+    if not mayExist(image_key):
+        return redirect(url_for('failure', msg="Unknown Key"))
     response = dynamodb.meta.client.get_item(
         TableName="images",
         Key={
             'image_key': image_key
         }
     )
-
-    # database has the key, store the image key and the encoded image content pair in cache for next retrieval
     if 'Item' in response:
-        path = response['Item']['image_path']
-        try:
-            obj = bucket.Object(path)
-        except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                return redirect(url_for('failure', msg="Key not exist in S3 error"))
-        base64_image = base64.b64encode(obj.get()['Body'].read()).decode('utf-8')
-        # put image in memcache
-        res = subPUT(image_key, base64_image)
-        if res:
-            return render_template('show_image.html', key=image_key, image=base64_image)
-        else:
-            return redirect(url_for('failure', msg="Memcache Put Error"))
+        return render_template('show_image.html', key=image_key)
     else:
+        recordMissing(image_key)
         return redirect(url_for('failure', msg="Unknown Key"))
 
 
@@ -450,75 +1412,201 @@ def upload():
     if not allowed_file(image_file.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
 
-    # check if database has the key or not
-    response = dynamodb.meta.client.get_item(
-        TableName="images",
-        Key={
-            'image_key': image_key
-        }
-    )
-    # handle duplicate filename
-    filename = "userImages/" + processDuplicateFilename(image_file.filename)
+    # keep the bytes of an image the memcache can hold, to write them through once the key points at them
+    content = None
+    stream = image_file.stream
+    if memcacheConfig.get('writeMode') == 'write-through':
+        start = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        if stream.tell() - start <= max_buffered_size():
+            stream.seek(start)
+            content = stream.read()
+        stream.seek(start)
+
+    # store the image under the hash of its content, computed while it was uploaded: an image that is
+    # already stored only gets another reference; the bytes read above are stored, so the S3 object and
+    # the memcache entry are the same data
+    try:
+        attributes = acquire_object(content_digest(image_file), stream if content is None else content)
+    except ClientError as e:
+        return redirect(url_for('failure', msg="S3 Upload error"))
 
-    # if the database has the key, delete the associated image in the s3 bucket
-    # save new image in s3 bucket
-    # and replace the old file name in the database with the new one
-    if 'Item' in response:
-        rows = response['Item']
-        file_to_delete = rows['image_path']
-        s3_boto.Object(bucket_name, file_to_delete).delete()
-        try:
-            s3_boto.meta.client.upload_fileobj(image_file, bucket_name, filename)
-        except ClientError as e:
-            return redirect(url_for('failure', msg="S3 Upload error"))
-        try:
-            response = table.update_item(
-                Key={
-                    'image_key': image_key
-                },
-                UpdateExpression="set image_path = :p",
-                ExpressionAttributeValues={
-                    ':p': filename
-                })
-        except ClientError as err:
-            return redirect(url_for('failure', msg="DB Update error"))
-
-    # if database doesn't have the key, insert key, image pair into it.
-    # save new image in s3 bucket
-    else:
+    # insert the key or point it at the new image; the old image is deleted from the s3 bucket in the
+    # background unless another key shares it
+    try:
+        invalidated = store_image(image_key, attributes, content)
+    except ClientError as err:
+        return redirect(url_for('failure', msg="DB Update error"))
+    if not invalidated:
+        return redirect(url_for('failure', msg="Invalidate key error"))
+    return redirect(url_for('success', msg="Image Successfully Uploaded"))
+
+
+@webapp.route('/upload/bulk', methods=['POST'])
+def bulk_upload():
+    """Upload many key-image pairs in one request.
+
+    The form holds the keys as repeated 'key' fields and the images as repeated 'file' fields, in the
+    same order. The images are stored on the upload_pool, BULK_UPLOAD_WORKERS at a time, and the keys
+    are written together by store_images.
+
+    Returns:
+        Response: JSON with the result of every item in request order ({'key', 'status', and 'image_path'
+        or 'error'}) and the number of items uploaded and failed. The status is 400 if the request itself
+        is malformed, otherwise 200 even if some items failed.
+    """
+    image_keys = request.form.getlist('key')
+    image_files = request.files.getlist('file')
+    if not image_keys or len(image_keys) != len(image_files):
+        return bulk_response({'error': "Every key needs exactly one image file"}, 400)
+    if len(image_keys) > BULK_UPLOAD_MAX_ITEMS:
+        return bulk_response({'error': f"At most {BULK_UPLOAD_MAX_ITEMS} images per request"}, 400)
+
+    results = [{'key': image_key, 'status': 'failed'} for image_key in image_keys]
+    futures = {}
+    seen = set()
+    for index, (image_key, image_file) in enumerate(zip(image_keys, image_files)):
+        if image_key == '' or image_file.filename == '':
+            results[index]['error'] = "Image file or key is empty"
+        elif not allowed_file(image_file.filename):
+            results[index]['error'] = "Image file type not supported"
+        elif image_key in seen:
+            results[index]['error'] = "Duplicate key"
+        else:
+            seen.add(image_key)
+            futures[upload_pool.submit(acquire_object, content_digest(image_file), image_file.stream)] = index
+
+    stored = {}
+    for future, index in futures.items():
         try:
-            s3_boto.meta.client.upload_fileobj(image_file, bucket_name, filename)
-        except ClientError as e:
-            return redirect(url_for('failure', msg="Upload error"))
+            stored[image_keys[index]] = future.result()
+        except (ClientError, BotoCoreError) as e:
+            logging.error(f"Bulk upload of key {image_keys[index]} failed: {e}")
+            results[index]['error'] = "S3 Upload error"
+    stored_indexes = [index for index in futures.values() if image_keys[index] in stored]
+
+    if stored:
         try:
-            response = table.put_item(
-                Item={
-                    'image_key': image_key,
-                    'image_path': filename
-                }
-            )
-        except ClientError as err:
-            return redirect(url_for('failure', msg="DB Put error"))
-    res = subInvalidateKey(image_key)
-    if not res:
-        return redirect(url_for('failure', msg="Invalidate key error"))
-    else:
-        waitTableActive()
-        return redirect(url_for('success', msg="Image Successfully Uploaded"))
+            invalidated = store_images(stored)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(f"Bulk upload could not write {len(stored)} keys: {e}")
+            for index in stored_indexes:
+                results[index]['error'] = "DB Update error"
+            stored_indexes = []
+        else:
+            for index in stored_indexes:
+                results[index].update(status='uploaded', image_path=stored[image_keys[index]]['image_path'])
+                if not invalidated:
+                    results[index]['warning'] = "Invalidate key error"
+    return bulk_response({'results': results, 'uploaded': len(stored_indexes),
+                          'failed': len(results) - len(stored_indexes)}, 200)
+
+
+def bulk_response(body, status):
+    """Build the JSON response of bulk_upload."""
+    return webapp.response_class(
+        response=json.dumps(body),
+        status=status,
+        mimetype='application/json')
 
 
 @webapp.route('/clear_data')
 def clear_data():
-    """Clear image data and redirect to the success page.
+    """Start clearing all image data and redirect to the success page right away.
+
+    Returns:
+        Redirect: Redirects to the success page with the id of the purge job, or the failure page if it
+        could not be started.
+    """
+    response = clearImageData()
+    if response.status_code == 409:
+        job_id = response.get_json()['error']['job_id']
+        return redirect(url_for('failure', msg=f"Another purge is running, job {job_id}; try again later"))
+    if response.status_code != 202:
+        return redirect(url_for('failure', msg="Image data clearing error"))
+    job_id = response.get_json()['job_id']
+    return redirect(url_for('success', msg=f"Clearing all image data in the background, job {job_id}"))
+
+
+@webapp.route('/clear_data/<job_id>')
+def clear_data_status(job_id):
+    """Report the progress of a purge job started by '/clear_data', '/clearImageData' or '/truncate_table'.
+
+    Returns:
+        Response: JSON with the state of the job ('running', 'done' or 'failed'), the items deleted from
+        every table and scan segments finished, the S3 objects deleted and the errors, or 404 if the job
+        is unknown.
+    """
+    status = purgeStatus(job_id)
+    if status is None:
+        abort(404)
+    return webapp.response_class(
+        response=json.dumps(status),
+        status=200,
+        mimetype='application/json')
+
+
+@webapp.route('/memcache/stats')
+def memcache_stats():
+    """Report memcache statistics.
+
+    Returns JSON by default, or the Prometheus text format when called with ?format=prometheus.
+
+    Returns:
+        Response: Hit/miss counts, evictions per policy, bytes admitted/evicted, entry count,
+        GET/PUT latency histograms and per-minute counters.
+    """
+    if request.args.get('format') == 'prometheus':
+        return webapp.response_class(
+            response=subSTATS('prometheus'),
+            status=200,
+            mimetype='text/plain; version=0.0.4')
+    return webapp.response_class(
+        response=json.dumps(subSTATS()),
+        status=200,
+        mimetype='application/json')
+
+
+@webapp.route('/backend/stats')
+def backend_stats():
+    """Report statistics of the back-end edit client.
+
+    Returns JSON by default, or the Prometheus text format when called with ?format=prometheus.
+
+    Returns:
+        Response: Request, retry, hedge and failure counts, outstanding requests, pooled connections
+        per back end and request latency histograms.
+    """
+    if request.args.get('format') == 'prometheus':
+        return webapp.response_class(
+            response=edit_client.stats('prometheus'),
+            status=200,
+            mimetype='text/plain; version=0.0.4')
+    return webapp.response_class(
+        response=json.dumps(edit_client.stats()),
+        status=200,
+        mimetype='application/json')
+
+
+@webapp.route('/keyfilter/stats')
+def keyfilter_stats():
+    """Report statistics of the negative cache of unknown image keys.
+
+    Returns JSON by default, or the Prometheus text format when called with ?format=prometheus.
 
     Returns:
-        Redirect: Redirects to the success page if the data clearing is successful, or the failure page otherwise.
+        Response: The lookups the cache checked and rejected, the lookups of missing keys that still
+        reached DynamoDB, its false positive rate and the keys it holds.
     """
-    clearImageData()
-    res = subCLEAR()
-    if not res:
-        return redirect(url_for('failure', msg="Memcache data clearing error"))
-    return redirect(url_for('success', msg="All Image Data Cleared Successfully"))
+    if request.args.get('format') == 'prometheus':
+        return webapp.response_class(
+            response=keyFilterStats('prometheus'),
+            status=200,
+            mimetype='text/plain; version=0.0.4')
+    return webapp.response_class(
+        response=json.dumps(keyFilterStats()),
+        status=200,
+        mimetype='application/json')
 
 
 """Image Processing Part"""
@@ -542,58 +1630,48 @@ def save_image():
         Rendered Template: The rendered HTML template for displaying the edited image.
     """
     image_key = request.form['key']
-    image_path = "userImages/" + image_key
-    image_string = request.form['image']
-    image_string = base64.b64decode(image_string)
-    # check if database has the key or not
-    response = dynamodb.meta.client.get_item(
-        TableName="images",
-        Key={
-            'image_key': image_key
-        }
-    )
-    # if the database has the key, delete the associated image in the s3 bucket
-    # save new image in s3 bucket
-    # and replace the old file name in the database with the new one
-    if 'Item' in response:
-        rows = response['Item']
-        file_to_delete = rows['image_path']
-        s3_boto.Object(bucket_name, file_to_delete).delete()
-        try:
-            s3_boto.meta.client.put_object(Bucket=bucket_name, Key=image_path, Body=image_string)
-        except ClientError as e:
-            return redirect(url_for('failure', msg="S3 Upload error"))
+    # the result page refers to the stored edited image, or inlines it if it could not be stored
+    token = request.form.get('token')
+    if token:
         try:
-            response = table.update_item(
-                Key={
-                    'image_key': image_key
-                },
-                UpdateExpression="set image_path = :p",
-                ExpressionAttributeValues={
-                    ':p': image_path
-                })
-        except ClientError as err:
-            return redirect(url_for('failure', msg="DB Update error"))
-
-    # if database doesn't have the key, insert key, image pair into it.
-    # save new image in s3 bucket
+            image_string = load_result(token)
+        except (BotoCoreError, ClientError) as e:
+            return redirect(url_for('failure', msg="S3 Download error"))
+        if not image_string:
+            return redirect(url_for('failure', msg="The edited image has expired, please edit it again"))
     else:
-        try:
-            s3_boto.meta.client.put_object(Bucket=bucket_name, Key=image_path, Body=image_string)
-        except ClientError as e:
-            return redirect(url_for('failure', msg="Upload error"))
-        try:
-            response = table.put_item(
-                Item={
-                    'image_key': image_key,
-                    'image_path': image_path
-                }
-            )
-        except ClientError as err:
-            return redirect(url_for('failure', msg="DB Put error"))
+        image_string = base64.b64decode(request.form['image'])
+    # store the image and its renditions under the hash of its content, or reference the stored copy
+    try:
+        attributes = acquire_object(hashlib.sha256(image_string).hexdigest(), image_string)
+    except ClientError as e:
+        return redirect(url_for('failure', msg="S3 Upload error"))
+
+    # insert the key or point it at the new image, and cache it in place of the image it replaces; the
+    # old image is released in the background
+    try:
+        invalidated = store_image(image_key, attributes, image_string)
+    except ClientError as err:
+        return redirect(url_for('failure', msg="DB Update error"))
+    if not invalidated:
+        return redirect(url_for('failure', msg="Invalidate key error"))
     return render_template('success.html', msg="Image Saved successfully")
 
 
+def edit_failed(endpoint, error):
+    """Log an edit the back end could not make, and send the user to the failure page.
+
+    Args:
+        endpoint (str): The back-end endpoint of the edit.
+        error (Exception): One of EDIT_ERRORS.
+
+    Returns:
+        Redirect: Redirects to the 'failure' page.
+    """
+    logging.error(f"Error editing an image with {endpoint}: {error}")
+    return redirect(url_for('failure', msg="Image processing error"))
+
+
 @webapp.route('/resize_form')
 def resize_form():
     """Render the resize form.
@@ -626,15 +1704,13 @@ def resize():
 
     if not allowed_file(image_path.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image_path": image, "width": int(width), "height": int(height)}
-    res = requests.post(URL + "/resize_image",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    return render_template('show_image_resize.html', key=image_path, image=content)
+    image_path, image = upload_to_S3(image_path)
+    width, height = int(width), int(height)
+    try:
+        content, results = editImage("/resize_image", image, width=width, height=height)
+    except EDIT_ERRORS as e:
+        return edit_failed("/resize_image", e)
+    return render_result('show_image_resize.html', content, content, key=image_path)
 
 
 """Sharpen"""
@@ -671,15 +1747,12 @@ def sharpen():
     if not allowed_file(image_path.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
 
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image_path": image}
-    res = requests.post(URL + "/sharpen_image",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    return render_template('show_image_after_process.html', key=image_path, image=content)
+    image_path, image = upload_to_S3(image_path)
+    try:
+        content, results = editImage("/sharpen_image", image)
+    except EDIT_ERRORS as e:
+        return edit_failed("/sharpen_image", e)
+    return render_result('show_image_after_process.html', content, content, key=image_path)
 
 
 """Blur"""
@@ -719,18 +1792,14 @@ def blur():
         return redirect(url_for('failure', msg="Image file type not supported"))
 
     if (image_type == 'gaussian' or image_type == 'median') and (kernel_size % 2 == 0):
-        print("here")
         return redirect(url_for('failure', msg="Kernel size should be an odd number for gaussian and median mode"))
 
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image_path": image, "kernel_size": kernel_size, "filter": image_type}
-    res = requests.post(URL + "/blurr_image",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    return render_template('show_image_after_process.html', key=image_path, image=content)
+    image_path, image = upload_to_S3(image_path)
+    try:
+        content, results = editImage("/blurr_image", image, kernel_size=kernel_size, filter=image_type)
+    except EDIT_ERRORS as e:
+        return edit_failed("/blurr_image", e)
+    return render_result('show_image_after_process.html', content, content, key=image_path)
 
 
 """Rotate Image"""
@@ -768,15 +1837,13 @@ def rotate():
     if not allowed_file(image_path.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
 
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image_path": image, "degree": int(degree)}
-    res = requests.post(URL + "/rotate_image",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    return render_template('show_image_after_process.html', key=image_path, image=content)
+    image_path, image = upload_to_S3(image_path)
+    degree = int(degree)
+    try:
+        content, results = editImage("/rotate_image", image, degree=degree)
+    except EDIT_ERRORS as e:
+        return edit_failed("/rotate_image", e)
+    return render_result('show_image_after_process.html', content, content, key=image_path)
 
 
 """GrayScale"""
@@ -813,15 +1880,12 @@ def grayscale():
     if not allowed_file(image_path.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
 
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image_path": image}
-    res = requests.post(URL + "/grayscale_image",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    return render_template('show_image_after_process.html', key=image_path, image=content)
+    image_path, image = upload_to_S3(image_path)
+    try:
+        content, results = editImage("/grayscale_image", image)
+    except EDIT_ERRORS as e:
+        return edit_failed("/grayscale_image", e)
+    return render_result('show_image_after_process.html', content, content, key=image_path)
 
 
 """Threshold"""
@@ -859,15 +1923,12 @@ def threshold():
     if not allowed_file(image_path.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
 
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image_path": image, "type": image_type}
-    res = requests.post(URL + "/threshold_image",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    return render_template('show_image_after_process.html', key=image_path, image=content)
+    image_path, image = upload_to_S3(image_path)
+    try:
+        content, results = editImage("/threshold_image", image, type=image_type)
+    except EDIT_ERRORS as e:
+        return edit_failed("/threshold_image", e)
+    return render_result('show_image_after_process.html', content, content, key=image_path)
 
 
 @webapp.route('/image_label_form')
@@ -901,16 +1962,13 @@ def detection():
     if not allowed_file(image_path.filename):
         return redirect(url_for('failure', msg="Image file type not supported"))
 
-    image_path = upload_to_S3(image_path)
-    image = bucket.Object(image_path).get()['Body'].read()
-    image = base64.b64encode(image).decode('utf-8')
-
-    dataSend = {"image": image}
-    res = requests.post(URL + "/get_label",
-                        json=dataSend)
-    content = res.json()["image_string"]
-    label_list = res.json()["label_list"]
-    confidence_list = res.json()["confidence_list"]
-
-    return render_template('show_label.html', key=image_path, content=content, labels=label_list,
-                           image=image, confidence=confidence_list)
+    image_path, original = upload_to_S3(image_path)
+    try:
+        content, results = editImage("/get_label", original, image_field='image')
+        label_list = results["label_list"]
+        confidence_list = results["confidence_list"]
+    except EDIT_ERRORS as e:
+        return edit_failed("/get_label", e)
+
+    return render_result('show_label.html', original, content, key=image_path, labels=label_list,
+                         confidence=confidence_list)
@@ -1,8 +1,14 @@
-import datetime
 import sys
+import csv
+import heapq
 import random
 import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import ExitStack
 from FrontEnd import config
+from FrontEnd.metrics import Histogram, RollingWindow, window_snapshot, prometheus_text
 
 # Basic logging configuration
 logging.basicConfig(
@@ -10,102 +16,1101 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-def subInvalidateKey(image_key):
+
+"""///REPLACEMENT POLICY///"""
+
+
+class ReplacementPolicy:
     """
-    Delete a key from the memcache if it exists.
-    
+    Base class for the memcache replacement policies.
+
+    Description:
+        A policy only tracks keys and sizes; the cached content itself lives in MemCache. The cache
+        calls on_insert after storing a new key, on_get on every lookup (hit or miss), on_remove when
+        a key is invalidated, and victim whenever it is over capacity. The key passed to the most
+        recent on_insert is never chosen as a victim while any other key is cached, so a new entry
+        is not evicted by its own insertion unless the policy rejects it on purpose.
+    """
+
+    name = None
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.incoming = None
+
+    def admit(self, image_key, size):
+        """
+        Size-aware admission check made before a new key is stored.
+
+        Description:
+            Rejects any entry bigger than memcacheConfig['maxItemRatio'] of the capacity of the shard it
+            would be stored in (see maxItemSize), so a single huge upload cannot flush a large part of it.
+        """
+        return size <= self.cache.capacity * config.memcacheConfig.get('maxItemRatio', 1)
+
+    def on_insert(self, image_key, size):
+        raise NotImplementedError
+
+    def on_get(self, image_key, hit):
+        pass
+
+    def on_remove(self, image_key):
+        raise NotImplementedError
+
+    def victim(self):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUPolicy(ReplacementPolicy):
+    """
+    Least Recently Used (LRU) replacement policy: evict the key that was accessed longest ago.
+    """
+
+    name = 'LRU'
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.order = OrderedDict()
+
+    def on_insert(self, image_key, size):
+        self.order[image_key] = size
+        self.incoming = image_key
+
+    def on_get(self, image_key, hit):
+        if hit:
+            self.order.move_to_end(image_key)
+
+    def on_remove(self, image_key):
+        self.order.pop(image_key, None)
+
+    def victim(self):
+        image_key = next(iter(self.order))
+        if image_key == self.incoming and len(self.order) > 1:
+            self.order.move_to_end(image_key)
+            image_key = next(iter(self.order))
+        del self.order[image_key]
+        return image_key
+
+    def clear(self):
+        self.order.clear()
+
+
+class RandomPolicy(ReplacementPolicy):
+    """
+    Random replacement policy: evict a uniformly random key.
+
+    Description:
+        Keys are kept in a list with a key-to-index map, so a random victim is removed in constant
+        time by swapping it with the last element.
+    """
+
+    name = 'Random'
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.keys = []
+        self.index = {}
+
+    def on_insert(self, image_key, size):
+        self.index[image_key] = len(self.keys)
+        self.keys.append(image_key)
+        self.incoming = image_key
+
+    def on_remove(self, image_key):
+        position = self.index.pop(image_key, None)
+        if position is None:
+            return
+        last = self.keys.pop()
+        if last != image_key:
+            self.keys[position] = last
+            self.index[last] = position
+
+    def victim(self):
+        image_key = self.keys[random.randrange(len(self.keys))]
+        if image_key == self.incoming and len(self.keys) > 1:
+            image_key = self.keys[self.index[image_key] - 1]
+        self.on_remove(image_key)
+        return image_key
+
+    def clear(self):
+        self.keys.clear()
+        self.index.clear()
+
+
+class LFUPolicy(ReplacementPolicy):
+    """
+    Least Frequently Used (LFU) replacement policy: evict the key with the fewest hits.
+
+    Description:
+        Keys are grouped in per-frequency buckets ordered by recency, so a hit moves a key to the next
+        bucket in constant time and ties between equally frequent keys are broken by LRU order.
+    """
+
+    name = 'LFU'
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.frequency = {}
+        self.buckets = {}
+        self.min_frequency = 0
+
+    def _bucket_add(self, image_key, frequency):
+        self.frequency[image_key] = frequency
+        self.buckets.setdefault(frequency, OrderedDict())[image_key] = None
+
+    def _bucket_remove(self, image_key):
+        frequency = self.frequency.pop(image_key)
+        bucket = self.buckets[frequency]
+        del bucket[image_key]
+        if not bucket:
+            del self.buckets[frequency]
+        return frequency
+
+    def on_insert(self, image_key, size):
+        self._bucket_add(image_key, 1)
+        self.min_frequency = 1
+        self.incoming = image_key
+
+    def on_get(self, image_key, hit):
+        if hit and image_key in self.frequency:
+            frequency = self._bucket_remove(image_key)
+            self._bucket_add(image_key, frequency + 1)
+            if frequency == self.min_frequency and frequency not in self.buckets:
+                self.min_frequency = frequency + 1
+
+    def on_remove(self, image_key):
+        if image_key in self.frequency:
+            self._bucket_remove(image_key)
+
+    def victim(self):
+        if self.min_frequency not in self.buckets:
+            self.min_frequency = min(self.buckets)
+        bucket = self.buckets[self.min_frequency]
+        image_key = next(iter(bucket))
+        if image_key == self.incoming and len(self.frequency) > 1:
+            if len(bucket) > 1:
+                bucket.move_to_end(image_key)
+                image_key = next(iter(bucket))
+            else:
+                image_key = next(iter(self.buckets[min(f for f in self.buckets if f != self.min_frequency)]))
+        self._bucket_remove(image_key)
+        return image_key
+
+    def clear(self):
+        self.frequency.clear()
+        self.buckets.clear()
+        self.min_frequency = 0
+
+
+class ARCPolicy(ReplacementPolicy):
+    """
+    Adaptive Replacement Cache (ARC) policy, measured in bytes.
+
+    Description:
+        T1 holds keys seen once recently and T2 keys seen at least twice. B1 and B2 remember the
+        keys (and sizes) recently evicted from T1 and T2. A re-insert of a key found in B1 grows the
+        byte target p for T1, one found in B2 shrinks it, so the split between recency and frequency
+        adapts to the workload. A single scan only churns T1 and cannot flush the hot keys in T2.
+    """
+
+    name = 'ARC'
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.t1, self.t2, self.b1, self.b2 = OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict()
+        self.t1_size = self.t2_size = self.b1_size = self.b2_size = 0
+        self.p = 0
+
+    def on_insert(self, image_key, size):
+        capacity = self.cache.capacity
+        if image_key in self.b1:
+            delta = size * max(1, self.b2_size / max(self.b1_size, 1))
+            self.p = min(capacity, self.p + delta)
+            self.b1_size -= self.b1.pop(image_key)
+            self.t2[image_key] = size
+            self.t2_size += size
+        elif image_key in self.b2:
+            delta = size * max(1, self.b1_size / max(self.b2_size, 1))
+            self.p = max(0, self.p - delta)
+            self.b2_size -= self.b2.pop(image_key)
+            self.t2[image_key] = size
+            self.t2_size += size
+        else:
+            self.t1[image_key] = size
+            self.t1_size += size
+        self.incoming = image_key
+
+    def on_get(self, image_key, hit):
+        if not hit:
+            return
+        if image_key in self.t1:
+            size = self.t1.pop(image_key)
+            self.t1_size -= size
+            self.t2[image_key] = size
+            self.t2_size += size
+        elif image_key in self.t2:
+            self.t2.move_to_end(image_key)
+
+    def on_remove(self, image_key):
+        if image_key in self.t1:
+            self.t1_size -= self.t1.pop(image_key)
+        elif image_key in self.t2:
+            self.t2_size -= self.t2.pop(image_key)
+
+    def victim(self):
+        t1_size = self.t1_size - self.t1.get(self.incoming, 0)
+        t1_has_victim = len(self.t1) > (1 if self.incoming in self.t1 else 0)
+        if t1_has_victim and (t1_size > self.p or not self.t2):
+            image_key, size = self.t1.popitem(last=False)
+            if image_key == self.incoming:
+                self.t1[image_key] = size
+                image_key, size = self.t1.popitem(last=False)
+            self.t1_size -= size
+            self.b1[image_key] = size
+            self.b1_size += size
+        elif self.t2:
+            image_key, size = self.t2.popitem(last=False)
+            self.t2_size -= size
+            self.b2[image_key] = size
+            self.b2_size += size
+        else:
+            image_key, size = self.t1.popitem(last=False)
+            self.t1_size -= size
+        capacity = self.cache.capacity
+        while self.b1 and self.b1_size > capacity:
+            self.b1_size -= self.b1.popitem(last=False)[1]
+        while self.b2 and self.b2_size > capacity:
+            self.b2_size -= self.b2.popitem(last=False)[1]
+        return image_key
+
+    def clear(self):
+        for segment in (self.t1, self.t2, self.b1, self.b2):
+            segment.clear()
+        self.t1_size = self.t2_size = self.b1_size = self.b2_size = 0
+        self.p = 0
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of recent access frequencies used by the TinyLFU admission filter.
+
+    Description:
+        Four rows of saturating counters (max 15) estimate how often a key was requested. After
+        10 * width increments every counter is halved, so the estimate favours recent popularity.
+    """
+
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+    def __init__(self, width):
+        self.width = 1 << min(24, max(4, (int(width) - 1).bit_length()))
+        self.mask = self.width - 1
+        self.rows = [bytearray(self.width) for _ in self.SEEDS]
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def _indexes(self, image_key):
+        h = hash(image_key) & 0xFFFFFFFFFFFFFFFF
+        return [((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 40 & self.mask for seed in self.SEEDS]
+
+    def increment(self, image_key):
+        for row, index in zip(self.rows, self._indexes(image_key)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def estimate(self, image_key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(image_key)))
+
+    def reset(self):
+        """Halve every counter to age out old popularity."""
+        for row in self.rows:
+            row[:] = bytes(count >> 1 for count in row)
+        self.additions //= 2
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = bytes(self.width)
+        self.additions = 0
+
+
+class WTinyLFUPolicy(ReplacementPolicy):
+    """
+    Window TinyLFU (W-TinyLFU) policy: a small LRU window in front of a frequency-filtered SLRU.
+
+    Description:
+        New keys enter an LRU window holding memcacheConfig['windowRatio'] of the capacity. When the
+        window overflows, its oldest key becomes a candidate for the main segmented LRU (probation
+        and protected). The candidate is only admitted if its sketch frequency beats the summed
+        frequency of every main-segment victim needed to make room for its bytes; otherwise the
+        candidate itself is evicted. A large, rarely requested image therefore loses to the many
+        small images it would displace, while a hot one still gets in.
+    """
+
+    name = 'W-TinyLFU'
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.window, self.probation, self.protected = OrderedDict(), OrderedDict(), OrderedDict()
+        self.window_size = self.probation_size = self.protected_size = 0
+        self.sketch = FrequencySketch(config.memcacheConfig.get('sketchWidth', 65536))
+
+    @property
+    def window_capacity(self):
+        return self.cache.capacity * config.memcacheConfig.get('windowRatio', 0.01)
+
+    @property
+    def protected_capacity(self):
+        return (self.cache.capacity - self.window_capacity) * 0.8
+
+    def on_insert(self, image_key, size):
+        self.window[image_key] = size
+        self.window_size += size
+        self.incoming = image_key
+
+    def on_get(self, image_key, hit):
+        self.sketch.increment(image_key)
+        if not hit:
+            return
+        if image_key in self.window:
+            self.window.move_to_end(image_key)
+        elif image_key in self.probation:
+            size = self.probation.pop(image_key)
+            self.probation_size -= size
+            self.protected[image_key] = size
+            self.protected_size += size
+            while self.protected_size > self.protected_capacity and len(self.protected) > 1:
+                demoted, demoted_size = self.protected.popitem(last=False)
+                self.protected_size -= demoted_size
+                self.probation[demoted] = demoted_size
+                self.probation_size += demoted_size
+        elif image_key in self.protected:
+            self.protected.move_to_end(image_key)
+
+    def on_remove(self, image_key):
+        if image_key in self.window:
+            self.window_size -= self.window.pop(image_key)
+        elif image_key in self.probation:
+            self.probation_size -= self.probation.pop(image_key)
+        elif image_key in self.protected:
+            self.protected_size -= self.protected.pop(image_key)
+
+    def _main_victims(self):
+        """Yield main-segment keys in eviction order: probation LRU first, then protected LRU."""
+        yield from self.probation.items()
+        yield from self.protected.items()
+
+    def _evict_main(self):
+        if self.probation:
+            image_key, size = self.probation.popitem(last=False)
+            self.probation_size -= size
+        else:
+            image_key, size = self.protected.popitem(last=False)
+            self.protected_size -= size
+        return image_key
+
+    def victim(self):
+        main_capacity = self.cache.capacity - self.window_capacity
+        while True:
+            main_empty = not self.probation and not self.protected
+            if not self.window or (self.window_size <= self.window_capacity and not main_empty):
+                return self._evict_main()
+            candidate, size = self.window.popitem(last=False)
+            self.window_size -= size
+            main_size = self.probation_size + self.protected_size
+            if main_empty or main_size + size <= main_capacity:
+                self.probation[candidate] = size
+                self.probation_size += size
+                continue
+            # size-aware duel: the candidate must beat every victim it would displace together
+            needed = main_size + size - main_capacity
+            victims_frequency = 0
+            for image_key, victim_size in self._main_victims():
+                victims_frequency += self.sketch.estimate(image_key)
+                needed -= victim_size
+                if needed <= 0:
+                    break
+            if self.sketch.estimate(candidate) > victims_frequency:
+                self.probation[candidate] = size
+                self.probation_size += size
+                return self._evict_main()
+            return candidate
+
+    def clear(self):
+        for segment in (self.window, self.probation, self.protected):
+            segment.clear()
+        self.window_size = self.probation_size = self.protected_size = 0
+        self.sketch.clear()
+
+
+POLICIES = {policy.name: policy for policy in (LRUPolicy, RandomPolicy, LFUPolicy, ARCPolicy, WTinyLFUPolicy)}
+
+
+"""///CACHE STORAGE///"""
+
+
+# Bytes charged per entry on top of the payload and the key string: the (value, size) tuple and its
+# int, the dict slot in MemCache.entries and the node the replacement policy keeps for the key.
+ENTRY_OVERHEAD = 256
+
+
+def entrySize(image_key, payload):
+    """
+    Number of bytes an entry occupies in memory.
+
     Parameters:
-        image_key (str): The key to be invalidated in the memcache.
+        image_key (str): The key of the entry.
+        payload (bytes or memoryview): The raw image data.
 
     Returns:
-        bool: True if the key is deleted from the memcache, otherwise False.
+        int: The payload bytes plus the Python object headers of the payload and key and ENTRY_OVERHEAD.
 
     Description:
-        This function removes a key from the memcache if it exists. It is used to invalidate
-        a key when it is no longer needed or to free up space in the cache.
+        sys.getsizeof of a bytes object already includes its data, while for a memoryview it only covers
+        the view object, so the viewed bytes are added separately.
     """
-    try:
-        if image_key in config.memcache:
-            config.total_image_size = config.total_image_size - sys.getsizeof(config.memcache[image_key]['content'])
-            config.memcache.pop(image_key, None)
+    size = sys.getsizeof(payload) + sys.getsizeof(image_key) + ENTRY_OVERHEAD
+    if isinstance(payload, memoryview):
+        size = size + payload.nbytes
+    return size
+
+
+class CacheStats:
+    """
+    Counters, latency histograms and a per-minute window for one memcache shard.
+
+    Description:
+        The stats are updated by MemCache and ShardedMemCache while they hold the shard lock, so
+        they need no locking of their own. ShardedMemCache.stats merges the shards into one report.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.rejected = 0
+        self.evictions = Counter()
+        self.bytes_admitted = 0
+        self.bytes_evicted = 0
+        self.expired = 0
+        self.bytes_expired = 0
+        self.get_latency = Histogram()
+        self.put_latency = Histogram()
+        self.window = RollingWindow(config.memcacheConfig.get('statsWindowMinutes', 60))
+
+
+class MemCache:
+    """
+    Byte-bounded image cache with constant-time get, put, touch and evict.
+
+    Description:
+        Entries are kept in a dict and the order in which they are evicted is delegated to a
+        replacement policy from POLICIES, selected by memcacheConfig['policy'] (unknown names fall
+        back to random replacement). Changing the configured policy rebuilds the policy state from
+        the cached keys on the next put. The total size of the cached images is tracked
+        incrementally, so no operation has to walk the whole cache.
+
+        Entries may carry a time to live. Their deadlines are kept in a min-heap, so a lookup of an
+        expired key misses and removes it, and sweep() drops expired entries oldest deadline first
+        without scanning the cache.
+
+        A MemCache is not thread-safe on its own; ShardedMemCache wraps several of them, each
+        holding 1 / shard_count of the capacity and guarded by its own lock.
+    """
+
+    def __init__(self, shard_count=1):
+        self.shard_count = shard_count
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.total_size = 0
+        # image_key -> expiry deadline (time.monotonic()), and a heap of (deadline, image_key) that may
+        # hold stale pairs for keys replaced or removed since; they are skipped when popped
+        self.expires = {}
+        self.expiry_heap = []
+        # image_key -> [hit count, time.time() of the last put or hit], used to rank entries for snapshots
+        self.accesses = {}
+        self.stats = CacheStats()
+        self.policy_name = None
+        self.policy = None
+        self._sync_policy()
+
+    @property
+    def capacity(self):
+        """int: The capacity of this cache in bytes, read from config.memcacheConfig on every call."""
+        return config.memcacheConfig['capacity'] * 1048576 // self.shard_count
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, image_key):
+        return image_key in self.entries
+
+    def _sync_policy(self):
+        """Switch to the policy named in memcacheConfig['policy'] if it has changed."""
+        name = config.memcacheConfig['policy']
+        if name == self.policy_name:
+            return
+        self.policy_name = name
+        self.policy = POLICIES.get(name, RandomPolicy)(self)
+        for image_key, (value, size) in self.entries.items():
+            self.policy.on_insert(image_key, size)
+        self.policy.incoming = None
+
+    def _expired(self, image_key):
+        """Remove image_key if its time to live has run out. Returns True if it was removed."""
+        deadline = self.expires.get(image_key)
+        if deadline is None or deadline > time.monotonic():
+            return False
+        self._expire(image_key)
         return True
-    except Exception as e:
-        # Log the exception and return False
-        logging.error(f"Error in subInvalidateKey: {e}")
-        return False
 
+    def _expire(self, image_key):
+        size = self.entries[image_key][1]
+        self.invalidate(image_key)
+        self.stats.expired += 1
+        self.stats.bytes_expired += size
+        self.stats.window.add('expired')
 
-"""REPLACEMENT POLICY"""
+    def get(self, image_key):
+        """Return the cached content for image_key and record the access with the policy, or None."""
+        self._expired(image_key)
+        entry = self.entries.get(image_key)
+        self.policy.on_get(image_key, entry is not None)
+        if entry is None:
+            self.stats.misses += 1
+            self.stats.window.add('misses')
+            return None
+        self.stats.hits += 1
+        self.stats.window.add('hits')
+        access = self.accesses[image_key]
+        access[0] += 1
+        access[1] = time.time()
+        return entry[0]
+
+    def touch(self, image_key):
+        """Record a hit on image_key without reading it. Returns False if the key is not cached."""
+        if self._expired(image_key) or image_key not in self.entries:
+            return False
+        self.policy.on_get(image_key, True)
+        access = self.accesses[image_key]
+        access[0] += 1
+        access[1] = time.time()
+        return True
+
+    def put(self, image_key, value, size, ttl=None):
+        """
+        Insert or replace image_key, evicting entries until the cache fits its capacity again.
+
+        Parameters:
+            ttl (float): Seconds until the entry expires, or None (or 0) to keep it until it is evicted.
+
+        Returns:
+            bool: True if the entry is cached afterwards, False if the policy did not admit it.
+        """
+        self._sync_policy()
+        self.invalidate(image_key)
+        self.stats.puts += 1
+        if size > self.capacity or not self.policy.admit(image_key, size):
+            self.stats.rejected += 1
+            return False
+        self.entries[image_key] = (value, size)
+        self.accesses[image_key] = [0, time.time()]
+        self.total_size = self.total_size + size
+        self.policy.on_insert(image_key, size)
+        if ttl:
+            deadline = time.monotonic() + ttl
+            self.expires[image_key] = deadline
+            heapq.heappush(self.expiry_heap, (deadline, image_key))
+            if len(self.expiry_heap) > 2 * len(self.expires) + 64:
+                # drop the stale pairs left behind by replaced and removed keys
+                self.expiry_heap = [(deadline, key) for key, deadline in self.expires.items()]
+                heapq.heapify(self.expiry_heap)
+        while self.total_size > self.capacity and self.entries:
+            victim, victim_size = self._evict()
+            if victim != image_key:
+                self._count_eviction(victim_size)
+        if image_key not in self.entries:
+            self.stats.rejected += 1
+            return False
+        self.stats.bytes_admitted += size
+        self.stats.window.add('bytes_admitted', size)
+        return True
 
+    def _evict(self):
+        image_key = self.policy.victim()
+        value, size = self.entries.pop(image_key)
+        self.expires.pop(image_key, None)
+        self.accesses.pop(image_key, None)
+        self.total_size = self.total_size - size
+        return image_key, size
 
-def dictLRU():
+    def _count_eviction(self, size):
+        self.stats.evictions[self.policy.name] += 1
+        self.stats.bytes_evicted += size
+        self.stats.window.add('evictions')
+        self.stats.window.add('bytes_evicted', size)
+
+    def evict(self):
+        """Remove one entry chosen by the configured replacement policy and return its key."""
+        image_key, size = self._evict()
+        self._count_eviction(size)
+        return image_key
+
+    def invalidate(self, image_key):
+        """Remove image_key if it is cached. Returns True if an entry was removed."""
+        entry = self.entries.pop(image_key, None)
+        if entry is None:
+            return False
+        self.expires.pop(image_key, None)
+        self.accesses.pop(image_key, None)
+        self.policy.on_remove(image_key)
+        self.total_size = self.total_size - entry[1]
+        return True
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        self.entries.clear()
+        self.expires.clear()
+        self.expiry_heap.clear()
+        self.accesses.clear()
+        self.policy.clear()
+        self.total_size = 0
+
+    def hot_entries(self):
+        """
+        List every entry with the metadata a snapshot keeps.
+
+        Returns:
+            list: (image_key, value, hit count, last access time, expiry time or 0) tuples, where the
+            times are time.time() values so they stay meaningful in another process.
+        """
+        offset = time.time() - time.monotonic()
+        return [(image_key, value, self.accesses[image_key][0], self.accesses[image_key][1],
+                 self.expires[image_key] + offset if image_key in self.expires else 0)
+                for image_key, (value, size) in self.entries.items()]
+
+    def sweep(self, limit, watermark=1.0):
+        """
+        Do up to `limit` units of background maintenance.
+
+        Parameters:
+            limit (int): The most entries to expire or evict in this call.
+            watermark (float): Fraction of the capacity to evict down to once no expired entries remain.
+
+        Returns:
+            int: The number of entries removed; 0 once there is nothing left to do.
+
+        Description:
+            Expired entries are removed first, then entries chosen by the replacement policy until the
+            cache is at or below watermark * capacity. Keeping that headroom lets a later put store its
+            entry without evicting inline.
+        """
+        removed = 0
+        now = time.monotonic()
+        while removed < limit and self.expiry_heap and self.expiry_heap[0][0] <= now:
+            deadline, image_key = heapq.heappop(self.expiry_heap)
+            if self.expires.get(image_key) == deadline:
+                self._expire(image_key)
+                removed += 1
+        while removed < limit and self.entries and self.total_size > self.capacity * watermark:
+            self.evict()
+            removed += 1
+        return removed
+
+
+class ShardedMemCache:
     """
-    Least Recently Used (LRU) replacement policy: Remove the "oldest" key from memcache.
+    Thread-safe memcache split into lock-striped MemCache shards.
 
     Description:
-        This function implements the LRU replacement policy to remove the "oldest" key from
-        the memcache based on the timestamp associated with each key. The LRU policy removes
-        the least recently used key to make space for new keys when the cache capacity is full.
+        Each key is mapped to one shard by its hash, and every operation only holds that shard's
+        lock, so concurrent requests for different keys rarely wait on each other. Each shard has
+        its own replacement policy state and an equal share of the capacity, so the size invariant
+        (total_size <= capacity) holds per shard and therefore for the whole cache.
+    """
+
+    def __init__(self, shard_count):
+        self.shards = [MemCache(shard_count) for _ in range(shard_count)]
+
+    def shard(self, image_key):
+        """Return the shard responsible for image_key."""
+        return self.shards[hash(image_key) % len(self.shards)]
+
+    @property
+    def capacity(self):
+        return sum(shard.capacity for shard in self.shards)
+
+    @property
+    def max_item_size(self):
+        """The largest entry admitted: maxItemRatio of the capacity of one shard."""
+        return self.shards[0].capacity * config.memcacheConfig.get('maxItemRatio', 1)
+
+    @property
+    def total_size(self):
+        return sum(shard.total_size for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, image_key):
+        return image_key in self.shard(image_key)
+
+    def get(self, image_key):
+        start = time.perf_counter()
+        shard = self.shard(image_key)
+        with shard.lock:
+            value = shard.get(image_key)
+            shard.stats.get_latency.observe(time.perf_counter() - start)
+            return value
+
+    def touch(self, image_key):
+        shard = self.shard(image_key)
+        with shard.lock:
+            return shard.touch(image_key)
+
+    def put(self, image_key, value, size, ttl=None):
+        start = time.perf_counter()
+        shard = self.shard(image_key)
+        with shard.lock:
+            stored = shard.put(image_key, value, size, ttl)
+            shard.stats.put_latency.observe(time.perf_counter() - start)
+            return stored
+
+    def invalidate(self, image_key):
+        shard = self.shard(image_key)
+        with shard.lock:
+            return shard.invalidate(image_key)
+
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.clear()
+
+    def hot_entries(self):
+        """Return MemCache.hot_entries of every shard, hottest (most hits, then most recent) first."""
+        entries = []
+        for shard in self.shards:
+            with shard.lock:
+                entries.extend(shard.hot_entries())
+        entries.sort(key=lambda entry: (entry[2], entry[3]), reverse=True)
+        return entries
+
+    def sweep(self, limit, watermark=1.0):
+        """Run MemCache.sweep on every shard, holding each shard's lock for at most `limit` removals."""
+        removed = 0
+        for shard in self.shards:
+            with shard.lock:
+                removed += shard.sweep(limit, watermark)
+        return removed
+
+    def stats(self):
+        """
+        Merge the statistics of every shard.
+
+        Returns:
+            tuple: See mergeStats.
+        """
+        # shard locks are always taken in the same order, and other operations hold only one
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.lock)
+            return mergeStats([(shard.stats, len(shard.entries), shard.total_size, shard.capacity)
+                               for shard in self.shards])
+
+
+def mergeStats(parts):
     """
-    OldTimeStamp = min([d['time'] for d in config.memcache.values()])
-    oldestKey = ""
-    for image_key in config.memcache.keys():
-        if config.memcache[image_key]['time'] == OldTimeStamp:
-            oldestKey = image_key  # find oldest key
-    # image size deducted
-    config.total_image_size = config.total_image_size - sys.getsizeof(config.memcache[oldestKey]['content'])
-    del config.memcache[oldestKey]  # delete oldest key
+    Combine the statistics of several caches (shards) into one report.
 
+    Parameters:
+        parts (list): (CacheStats, entry count, size in bytes, capacity in bytes) tuples. The caller must
+            hold whatever locks guard them.
 
-def dictRandom():
+    Returns:
+        tuple: (report, get_latency, put_latency, evictions) where report is a JSON-serialisable
+        dict, the latencies are merged Histograms and evictions is a Counter per policy name.
     """
-    Random replacement policy: Remove a key randomly from memcache.
+    report = Counter()
+    evictions = Counter()
+    get_latency, put_latency = Histogram(), Histogram()
+    window = {}
+    for stats, entries, size, capacity in parts:
+        report.update({'hits': stats.hits, 'misses': stats.misses, 'puts': stats.puts,
+                       'rejected': stats.rejected, 'bytes_admitted': stats.bytes_admitted,
+                       'bytes_evicted': stats.bytes_evicted, 'expired': stats.expired,
+                       'bytes_expired': stats.bytes_expired, 'entries': entries,
+                       'size_bytes': size, 'capacity_bytes': capacity})
+        evictions.update(stats.evictions)
+        get_latency.merge(stats.get_latency)
+        put_latency.merge(stats.put_latency)
+        stats.window.merge_into(window)
+    report = dict(report)
+    lookups = report.get('hits', 0) + report.get('misses', 0)
+    report['hit_ratio'] = report.get('hits', 0) / lookups if lookups else 0.0
+    report['backend'] = config.memcacheConfig.get('backend', 'local')
+    report['policy'] = config.memcacheConfig['policy']
+    report['shards'] = len(parts)
+    report['evictions'] = dict(evictions)
+    report['latency_seconds'] = {'get': get_latency.snapshot(), 'put': put_latency.snapshot()}
+    report['per_minute'] = window_snapshot(window, config.memcacheConfig.get('statsWindowMinutes', 60))
+    return report, get_latency, put_latency, evictions
+
+
+def createMemCache():
+    """
+    Build the memcache backend selected by memcacheConfig['backend'].
+
+    Returns:
+        ShardedMemCache, SharedMemCache or NodePoolCache: 'local' (the default) keeps the cache in this
+        process; 'shared' keeps it in a memory-mapped file shared by every front-end process on the host;
+        'pool' spreads it over the cache nodes listed in memcacheConfig['nodes'].
+    """
+    backend = config.memcacheConfig.get('backend', 'local')
+    if backend == 'pool':
+        from FrontEnd.cachenode import NodePoolCache
+        return NodePoolCache(config.memcacheConfig.get('nodes', []),
+                             config.memcacheConfig.get('virtualNodes', 160),
+                             config.memcacheConfig.get('nodeTimeout', 1.0),
+                             config.memcacheConfig.get('nodeStatsTTL', 1.0))
+    if backend == 'shared':
+        from FrontEnd.shmcache import SharedMemCache, defaultSharedPath
+        return SharedMemCache(defaultSharedPath(),
+                              config.memcacheConfig['capacity'] * 1048576,
+                              config.memcacheConfig.get('sharedSlots', 65536))
+    return ShardedMemCache(config.memcacheConfig.get('shards', 16))
+
+
+memcache = createMemCache()
+# the snapshot being loaded at startup (see FrontEnd.snapshot.WarmSnapshot), or None once it is loaded
+warmSnapshot = None
+# the snapshot file the periodic snapshots append to (see FrontEnd.snapshot.SnapshotLog), or None
+snapshotLog = None
+
+
+def snapshotChanged(image_key):
+    """Tell the snapshot being loaded and the snapshot log that the cached image of a key changed."""
+    if warmSnapshot is not None:
+        warmSnapshot.discard(image_key)
+    if snapshotLog is not None:
+        snapshotLog.changed(image_key)
+
+
+"""///BACKGROUND SWEEPER///"""
+
+
+sweeper = None
+sweeper_lock = threading.Lock()
+
+
+def sweepLoop(stop):
+    """
+    Body of the sweeper thread: sweep the memcache every memcacheConfig['sweepInterval'] seconds.
+
+    Parameters:
+        stop (threading.Event): Set to end the loop.
 
     Description:
-        This function implements the random replacement policy to remove a key randomly from
-        the memcache when the cache capacity is full. It randomly selects a key and deletes it
-        to make space for new keys.
+        Each pass repeats memcache.sweep in batches of memcacheConfig['sweepBatch'] entries until nothing
+        is left to expire or evict, so a shard lock is never held for more than one batch at a time and
+        requests for the same shard only wait for that batch.
     """
-    keys = list(config.memcache.keys())
-    keyIndex = random.randint(0, len(keys) - 1)
-    # image size deducted
-    config.total_image_size = config.total_image_size - sys.getsizeof(config.memcache[keys[keyIndex]]['content'])
-    del config.memcache[keys[keyIndex]]  # delete the random key
+    while not stop.wait(config.memcacheConfig.get('sweepInterval', 1.0)):
+        try:
+            while not stop.is_set() and memcache.sweep(config.memcacheConfig.get('sweepBatch', 64),
+                                                      config.memcacheConfig.get('sweepWatermark', 0.9)):
+                time.sleep(0)
+        except Exception as e:
+            logging.error(f"Error in memcache sweeper: {e}")
 
 
-"""///CAPACITY CONTROL///"""
+def startSweeper():
+    """
+    Start the background sweeper thread if it is not running yet.
+
+    Returns:
+        threading.Event: Set it to stop the sweeper.
+    """
+    global sweeper
+    with sweeper_lock:
+        if sweeper is None or not sweeper[0].is_alive():
+            stop = threading.Event()
+            thread = threading.Thread(target=sweepLoop, args=(stop,), name='memcache-sweeper', daemon=True)
+            thread.start()
+            sweeper = (thread, stop)
+        return sweeper[1]
 
 
-def fitCapacity(extraSize):
+"""///ACCESS TRACE///"""
+
+
+trace_lock = threading.Lock()
+# (path, file, csv writer) of the open trace, or None
+trace = None
+
+
+def recordAccess(op, image_key, size):
     """
-    Ensure the memcache capacity is not exceeded by deleting keys based on the selected policy.
+    Append one cache access to the trace file named by memcacheConfig['tracePath'], if it is set.
 
     Parameters:
-        extraSize (int): The size of the new data to be added to the memcache.
+        op (str): 'GET' or 'PUT'.
+        image_key (str): The key accessed.
+        size (int): The payload size in bytes, 0 for a GET that missed.
 
     Description:
-        This function checks if adding new data to the memcache will exceed the cache capacity.
-        If it does, it removes keys from the memcache based on the selected replacement policy
-        (either LRU or random) until enough space is available for the new data.
+        Each access is one CSV row: time.time(), op, key and size. benchmarks/bench_traces.py replays
+        such traces against every replacement policy.
     """
-    while (extraSize + config.total_image_size) > config.memcacheConfig['capacity'] * 1048576 and bool(config.memcache):
-        # capacity full
-        if config.memcacheConfig['policy'] == "LRU":
-            dictLRU()
-        else:
-            dictRandom()
+    global trace
+    path = config.memcacheConfig.get('tracePath')
+    if not path:
+        return
+    with trace_lock:
+        if trace is None or trace[0] != path:
+            if trace is not None:
+                trace[1].close()
+            file = open(path, 'a', newline='', buffering=65536)
+            trace = (path, file, csv.writer(file))
+        trace[2].writerow((f"{time.time():.6f}", op, image_key, size))
+
+
+def closeTrace():
+    """Flush and close the trace file; the next recorded access opens it again."""
+    global trace
+    with trace_lock:
+        if trace is not None:
+            trace[1].close()
+            trace = None
+
+
+"""///VERSIONED WRITES///"""
+
+
+# key -> highest version written to or invalidated in the memcache, for the versionsKept most recent keys
+versions = OrderedDict()
+versions_lock = threading.Lock()
+# a versioned put or invalidation holds the stripe of its key from the version check to the cache update
+version_stripes = [threading.Lock() for _ in range(64)]
+# versioned puts refused because a newer version of the key had been written or invalidated
+stale_puts = 0
+
+
+def versionStripe(image_key):
+    """The lock serialising the versioned writes of image_key."""
+    return version_stripes[hash(image_key) % len(version_stripes)]
+
+
+def advanceVersion(image_key, version):
+    """
+    Record a version of a key unless a newer one is recorded already.
+
+    Parameters:
+        image_key (str): The memcache key.
+        version (int): The version of the image about to be cached or invalidated.
+
+    Returns:
+        bool: False if a newer version of the key was recorded, otherwise True.
+
+    Description:
+        Versions are kept for the most recent memcacheConfig['versionsKept'] keys of this process, so
+        they guard the threads and coroutines of one front end against each other. A key whose version
+        has been forgotten accepts any version again.
+    """
+    with versions_lock:
+        if versions.get(image_key, version) > version:
+            return False
+        versions[image_key] = version
+        versions.move_to_end(image_key)
+        while len(versions) > config.memcacheConfig.get('versionsKept', 65536):
+            versions.popitem(last=False)
+        return True
+
+
+"""///FUNCTION INVALIDATE KEY FOR MEMCACHE///"""
+
+
+def subInvalidateKey(image_key, version=None):
+    """
+    Delete a key from the memcache if it exists.
+    
+    Parameters:
+        image_key (str): The key to be invalidated in the memcache.
+        version (int): The version of the image that replaced the cached one, if the key is versioned.
+            Puts of older versions are refused afterwards (see subPUT).
+
+    Returns:
+        bool: True if the key is deleted from the memcache, otherwise False.
+
+    Description:
+        This function removes a key from the memcache if it exists. It is used to invalidate
+        a key when it is no longer needed or to free up space in the cache.
+    """
+    try:
+        snapshotChanged(image_key)
+        if version is not None:
+            # a newer version has been cached or invalidated already, and must not be dropped for this one
+            with versionStripe(image_key):
+                if advanceVersion(image_key, version):
+                    memcache.invalidate(image_key)
+            return True
+        memcache.invalidate(image_key)
+        return True
+    except Exception as e:
+        # Log the exception and return False
+        logging.error(f"Error in subInvalidateKey: {e}")
+        return False
+
+
+def subInvalidateKeys(image_keys, key_versions=None):
+    """
+    Delete many keys from the memcache in one pass.
+
+    Parameters:
+        image_keys (iterable of str): The keys to be invalidated in the memcache.
+        key_versions (dict): key -> the version that replaced the cached image, for the versioned keys.
+
+    Returns:
+        bool: True if every key is deleted from the memcache, otherwise False.
+
+    Description:
+        The bulk form of subInvalidateKey, for writes that replace many images at once. Every key is
+        tried even when one fails, so a single unavailable cache node leaves only its own keys behind.
+    """
+    invalidated = True
+    for image_key in image_keys:
+        try:
+            snapshotChanged(image_key)
+            if key_versions and image_key in key_versions:
+                with versionStripe(image_key):
+                    if advanceVersion(image_key, key_versions[image_key]):
+                        memcache.invalidate(image_key)
+            else:
+                memcache.invalidate(image_key)
+        except Exception as e:
+            logging.error(f"Error in subInvalidateKeys for {image_key}: {e}")
+            invalidated = False
+    return invalidated
 
 
 """///FUNCTION PUT KEY FOR MEMCACHE"""
 
 
-def subPUT(image_key, value):
+def subPUT(image_key, value, ttl=None, version=None):
     """
     Add a key-value pair to the memcache while ensuring the capacity is not exceeded.
 
     Parameters:
         image_key (str): The key associated with the image data.
-        value (str): The base64-encoded image data.
+        value (bytes or memoryview): The raw image data. A bytearray is copied to bytes so later changes
+            to it cannot alter the cached image.
+        ttl (float): Seconds after which the entry expires. None uses memcacheConfig['ttl']; 0 keeps the
+            entry until it is evicted or invalidated.
+        version (int): The version of the image, for keys written by more than one writer. The put is
+            refused if a newer version of the key has been put or invalidated (see advanceVersion).
 
     Returns:
         bool: True if the key-value pair is successfully added to the memcache, otherwise False.
@@ -113,20 +1118,34 @@ def subPUT(image_key, value):
     Description:
         This function adds a key-value pair to the memcache while ensuring that the cache capacity
         is not exceeded. If the image data size exceeds the cache capacity, the function returns False.
-        Otherwise, it adds the key-value pair to the cache using the specified replacement policy (LRU or random).
+        Otherwise, it adds the key-value pair to the cache and evicts keys chosen by the replacement policy
+        configured in memcacheConfig['policy'] until the cache fits again. The policy may also refuse to
+        admit the new entry (see ReplacementPolicy.admit and WTinyLFUPolicy), in which case False is returned.
     """
+    global stale_puts
     try:
         if not value:
             return False
 
-        image_size = sys.getsizeof(value)
-        if image_size > config.memcacheConfig['capacity'] * 1048576:
-            return False
+        if isinstance(value, bytearray):
+            value = bytes(value)
+        elif not isinstance(value, (bytes, memoryview)):
+            raise TypeError(f"memcache values must be bytes or memoryview, not {type(value).__name__}")
 
-        fitCapacity(image_size)
-        config.memcache[image_key] = {'content': value, 'time': datetime.datetime.now()}
-        config.total_image_size = config.total_image_size + image_size
-        return True
+        image_size = entrySize(image_key, value)
+        if ttl is None:
+            ttl = config.memcacheConfig.get('ttl')
+        snapshotChanged(image_key)
+        recordAccess('PUT', image_key, value.nbytes if isinstance(value, memoryview) else len(value))
+
+        if version is None:
+            return memcache.put(image_key, value, image_size, ttl)
+        with versionStripe(image_key):
+            if advanceVersion(image_key, version):
+                return memcache.put(image_key, value, image_size, ttl)
+        with versions_lock:
+            stale_puts += 1
+        return False
     except Exception as e:
         # Log the exception and return False
         logging.error(f"Error in subPUT: {e}")
@@ -138,30 +1157,66 @@ def subPUT(image_key, value):
 
 def subGET(image_key):
     """
-    Retrieve image data from the memcache and update its timestamp.
+    Retrieve image data from the memcache and mark it as most recently used.
 
     Parameters:
         image_key (str): The key associated with the image data.
 
     Returns:
-        str or False: The base64-encoded image data if the key exists in the memcache, otherwise False.
+        bytes or False: The raw image data if the key exists in the memcache, otherwise False.
 
     Description:
         This function retrieves the image data from the memcache using the provided key. If the key exists,
-        it updates the timestamp of the key to indicate that it has been accessed recently. If the key is not
-        found in the memcache, the function returns False, indicating a cache miss.
+        it is moved to the most recently used end of the cache. While a startup snapshot is still being
+        loaded, a miss is looked up in the snapshot as well. If the key is not found, the function returns
+        False, indicating a cache miss.
     """
     try:
-        if image_key in config.memcache.keys():
-            config.memcache[image_key]['time'] = datetime.datetime.now()
-            return config.memcache[image_key]['content']
-        else:
+        content = memcache.get(image_key)
+        if content is None and warmSnapshot is not None:
+            content = warmSnapshot.get(image_key)
+        recordAccess('GET', image_key, 0 if content is None else len(content))
+        if content is None:
             return False
+        return content
     except Exception as e:
         # Log the exception and return False
         logging.error(f"Error in subGET: {e}")
         return False
 
+def maxItemSize():
+    """
+    Size in bytes of the largest image the memcache admits.
+
+    Returns:
+        float: memcacheConfig['maxItemRatio'] of the capacity of one shard of the memcache. The shared
+        backend is a single shard, and the cache nodes are assumed to run with this configuration.
+    """
+    return memcache.max_item_size
+
+
+def subTOUCH(image_key):
+    """
+    Check whether an image is cached, without reading it, and mark it as most recently used.
+
+    Parameters:
+        image_key (str): The key associated with the image data.
+
+    Returns:
+        bool: True if the key is cached, otherwise False.
+
+    Description:
+        For pages that only link to the image, such as the one of the '/key' route: a hit records the
+        access with the replacement policy like subGET, but no image data is copied or sent over the
+        network.
+    """
+    try:
+        return bool(memcache.touch(image_key))
+    except Exception as e:
+        logging.error(f"Error in subTOUCH: {e}")
+        return False
+
+
 """///FUNCTION CLEAN KEY AND CONTENT FOR MEMCACHE///"""
 
 
@@ -177,10 +1232,44 @@ def subCLEAR():
         image size in the cache to zero. It is used when a user wants to clear all cached images and data.
     """
     try:
-        config.total_image_size = 0
-        config.memcache.clear()
+        if warmSnapshot is not None:
+            warmSnapshot.discard_all()
+        if snapshotLog is not None:
+            snapshotLog.changed_all()
+        memcache.clear()
+        # the tables are usually cleared too, and the versions of the keys written anew start over
+        with versions_lock:
+            versions.clear()
         return True
     except Exception as e:
         # Log the exception and return False
         logging.error(f"Error in subCLEAR: {e}")
         return False
+
+
+"""///FUNCTION STATISTICS FOR MEMCACHE///"""
+
+
+def subSTATS(output_format='json'):
+    """
+    Report the memcache statistics.
+
+    Parameters:
+        output_format (str): 'json' for a dict, or 'prometheus' for the Prometheus text format.
+
+    Returns:
+        dict or str: Hits, misses, hit ratio, puts and rejected puts, puts refused as stale, evictions per
+        policy, bytes admitted and evicted, entry count, size, GET/PUT latency histograms and per-minute
+        counters.
+    """
+    report, get_latency, put_latency, evictions = memcache.stats()
+    report['stale_puts'] = stale_puts
+    if output_format != 'prometheus':
+        return report
+    counters = {name: report.get(name, 0) for name in ('hits', 'misses', 'puts', 'rejected', 'stale_puts',
+                                                        'bytes_admitted', 'bytes_evicted', 'expired',
+                                                        'bytes_expired')}
+    counters['evictions'] = {(('policy', policy),): count for policy, count in evictions.items()}
+    gauges = {name: report.get(name, 0) for name in ('entries', 'size_bytes', 'capacity_bytes', 'hit_ratio')}
+    histograms = {'get_latency_seconds': get_latency, 'put_latency_seconds': put_latency}
+    return prometheus_text('memcache', counters, gauges, histograms)
@@ -0,0 +1,128 @@
+import bisect
+import time
+from collections import Counter, deque
+
+# Upper bounds (in seconds) of the latency histogram buckets, from 10 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Fixed-bucket histogram of observed values, in the layout Prometheus expects.
+
+    The histogram is not thread-safe; callers update it while holding the lock of the object it
+    belongs to and read it through snapshot() or merge().
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record one observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        """Add the observations of another histogram with the same buckets."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 < q <= 1) as the upper bound of the bucket that contains it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        """Return the histogram as a JSON-serialisable dict with cumulative bucket counts."""
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative.append([bound, seen])
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative,
+        }
+
+
+class RollingWindow:
+    """Named counters bucketed per minute, keeping only the most recent `minutes` minutes."""
+
+    def __init__(self, minutes=60):
+        self.buckets = deque(maxlen=minutes)
+
+    def add(self, name, amount=1, now=None):
+        minute = int((time.time() if now is None else now) // 60)
+        if not self.buckets or self.buckets[-1][0] != minute:
+            self.buckets.append((minute, Counter()))
+        self.buckets[-1][1][name] += amount
+
+    def merge_into(self, totals):
+        """Add this window's counters to totals, a dict mapping minute -> Counter."""
+        for minute, counts in self.buckets:
+            totals.setdefault(minute, Counter()).update(counts)
+
+
+def window_snapshot(totals, minutes=60, now=None):
+    """Turn merged per-minute counters into a list of dicts, oldest first, for the last `minutes` minutes."""
+    current = int((time.time() if now is None else now) // 60)
+    rows = []
+    for minute in sorted(totals):
+        if minute > current - minutes:
+            row = {'minute': time.strftime('%Y-%m-%dT%H:%M:00Z', time.gmtime(minute * 60))}
+            row.update(totals[minute])
+            rows.append(row)
+    return rows
+
+
+def prometheus_text(prefix, counters, gauges, histograms):
+    """Render metrics in the Prometheus text exposition format.
+
+    Args:
+        prefix (str): Prefix added to every metric name, e.g. 'memcache'.
+        counters (dict): name -> value, or name -> {((label, label_value), ...): value} for labelled counters.
+        gauges (dict): name -> value.
+        histograms (dict): name -> Histogram.
+
+    Returns:
+        str: The metrics, one sample per line.
+    """
+    lines = []
+    for name, value in counters.items():
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        if isinstance(value, dict):
+            for labels, sample in value.items():
+                label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+                lines.append(f"{prefix}_{name}_total{{{label_text}}} {sample}")
+        else:
+            lines.append(f"{prefix}_{name}_total {value}")
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    for name, histogram in histograms.items():
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        seen = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            seen += count
+            lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {seen}')
+        lines.append(f'{prefix}_{name}_bucket{{le="+Inf"}} {histogram.count}')
+        lines.append(f"{prefix}_{name}_sum {histogram.sum}")
+        lines.append(f"{prefix}_{name}_count {histogram.count}")
+    return '\n'.join(lines) + '\n'
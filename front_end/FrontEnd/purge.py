@@ -0,0 +1,233 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import BotoCoreError, ClientError
+from FrontEnd.config import purgeConfig
+
+"""
+Background purge of the image data: every item of the DynamoDB tables and every object of the S3 bucket.
+
+Each table is read with a parallel scan of purgeConfig['segments'] segments, every segment deleting the
+keys of its pages through a batch_writer as it goes, up to purgeConfig['workers'] segments at once. The
+bucket is listed 1000 keys a page, and every page is deleted with one delete_objects call on a pool of its
+own, up to purgeConfig['deleteWorkers'] at once, so the deletes do not queue behind the scans. A purge does
+not stop uploads made while it runs, which may or may not be purged.
+
+One purge runs at a time. A purge requested while one runs is answered by the running job if that job
+deletes at least the same tables and bucket, and refused with PurgeBusy otherwise.
+"""
+
+# S3 keys deleted by one delete_objects call, the most S3 accepts
+DELETE_BATCH = 1000
+
+jobs_lock = threading.Lock()
+# job id -> PurgeJob, oldest first
+jobs = OrderedDict()
+
+
+class PurgeBusy(Exception):
+    """
+    Raised by startPurge when the running purge does not cover the one requested.
+
+    Parameters:
+        job (PurgeJob): The running job.
+    """
+
+    def __init__(self, job):
+        super().__init__(f"purge {job.id} is running and does not cover the one requested")
+        self.job = job
+
+
+class PurgeJob:
+    """
+    The progress of one purge, updated by its worker threads.
+
+    Parameters:
+        tables (dict): DynamoDB Table -> the name of its partition key.
+        s3_client: The S3 client, or None to leave the bucket alone.
+        bucket_name (str): The bucket to empty.
+        on_done (callable): Called with the job once everything is deleted, e.g. to clear the memcache.
+    """
+
+    def __init__(self, tables, s3_client=None, bucket_name=None, on_done=None):
+        self.id = uuid.uuid4().hex
+        self.tables = tables
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.state = 'running'
+        self.started = time.time()
+        self.finished = None
+        self.segments = purgeConfig['segments']
+        self.progress = {each_table.name: {'segments_done': 0, 'deleted': 0} for each_table in tables}
+        self.objects_deleted = 0
+        self.errors = []
+
+    def covers(self, tables, s3_client=None, bucket_name=None):
+        """Return whether this job deletes everything a purge of these tables and bucket would."""
+        if not {each_table.name for each_table in tables} <= set(self.progress):
+            return False
+        return s3_client is None or (self.s3_client is not None and self.bucket_name == bucket_name)
+
+    def add(self, table_name=None, deleted=0, segment_done=False, objects_deleted=0, error=None):
+        with self.lock:
+            if table_name is not None:
+                self.progress[table_name]['deleted'] += deleted
+                self.progress[table_name]['segments_done'] += segment_done
+            self.objects_deleted += objects_deleted
+            if error is not None:
+                self.errors.append(error)
+
+    def snapshot(self):
+        """Return the progress of the job as a JSON-serialisable dict."""
+        with self.lock:
+            end = self.finished or time.time()
+            return {'id': self.id, 'state': self.state, 'started': self.started, 'finished': self.finished,
+                    'seconds': round(end - self.started, 3),
+                    'tables': {name: dict(progress, segments=self.segments)
+                               for name, progress in self.progress.items()},
+                    'objects_deleted': self.objects_deleted, 'errors': list(self.errors)}
+
+
+def purgeSegment(job, each_table, key_name, segment):
+    """
+    Delete every item of one parallel scan segment of a table, a page at a time.
+
+    Parameters:
+        job (PurgeJob): The job to report progress to.
+        each_table: The DynamoDB Table.
+        key_name (str): The name of its partition key, the only attribute read.
+        segment (int): The segment, out of job.segments.
+
+    Returns:
+        int: The number of items deleted.
+    """
+    deleted = 0
+    scan_kwargs = {'Segment': segment, 'TotalSegments': job.segments, 'ProjectionExpression': key_name}
+    while True:
+        page = each_table.scan(**scan_kwargs)
+        with each_table.batch_writer() as batch:
+            for item in page['Items']:
+                batch.delete_item(Key={key_name: item[key_name]})
+        deleted += len(page['Items'])
+        job.add(each_table.name, len(page['Items']))
+        if 'LastEvaluatedKey' not in page:
+            break
+        scan_kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+    job.add(each_table.name, segment_done=True)
+    return deleted
+
+
+def deleteObjects(job, keys):
+    """
+    Delete up to DELETE_BATCH objects of the bucket of a job with one delete_objects call.
+
+    Returns:
+        int: The number of objects deleted; the keys S3 could not delete are recorded as errors.
+    """
+    response = job.s3_client.delete_objects(Bucket=job.bucket_name,
+                                            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    failed = response.get('Errors', [])
+    for error in failed:
+        job.add(error=f"{error.get('Key')}: {error.get('Code')}")
+    job.add(objects_deleted=len(keys) - len(failed))
+    return len(keys) - len(failed)
+
+
+def runPurge(job):
+    """
+    Run a purge to the end: the table segments and the bucket deletes on a thread pool each.
+
+    Parameters:
+        job (PurgeJob): The job, in the 'running' state.
+
+    Returns:
+        PurgeJob: The job, 'done' or 'failed'.
+    """
+    delete_workers = purgeConfig['deleteWorkers']
+    with ThreadPoolExecutor(max_workers=purgeConfig['workers'], thread_name_prefix=f"purge-{job.id[:8]}") as executor, \
+            ThreadPoolExecutor(max_workers=delete_workers, thread_name_prefix=f"purge-s3-{job.id[:8]}") as deletes:
+        futures = [executor.submit(purgeSegment, job, each_table, key_name, segment)
+                   for each_table, key_name in job.tables.items() for segment in range(job.segments)]
+        pending = set()
+        try:
+            if job.s3_client is not None:
+                pages = job.s3_client.get_paginator('list_objects_v2').paginate(
+                    Bucket=job.bucket_name, PaginationConfig={'PageSize': DELETE_BATCH})
+                for page in pages:
+                    keys = [each['Key'] for each in page.get('Contents', [])]
+                    if keys:
+                        pending.add(deletes.submit(deleteObjects, job, keys))
+                    # list no further ahead than the deletes can keep up with
+                    if len(pending) >= delete_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        futures.extend(done)
+        except (ClientError, BotoCoreError) as e:
+            job.add(error=f"listing {job.bucket_name}: {e}")
+        for future in futures + list(pending):
+            try:
+                future.result()
+            except Exception as e:
+                # whatever went wrong, the job has to finish, or no purge could be started again
+                job.add(error=str(e))
+    if job.on_done is not None:
+        try:
+            job.on_done(job)
+        except Exception as e:
+            job.add(error=f"on_done: {e}")
+    with job.lock:
+        job.state = 'failed' if job.errors else 'done'
+        job.finished = time.time()
+    logging.info(f"Purge {job.id} {job.state} in {job.finished - job.started:.1f} s: {job.progress}, "
+                 f"{job.objects_deleted} objects, {len(job.errors)} errors")
+    return job
+
+
+def startPurge(tables, s3_client=None, bucket_name=None, on_done=None, background=True):
+    """
+    Start a purge in a background thread, or run it to the end, unless one is already running.
+
+    Parameters:
+        tables (dict): DynamoDB Table -> the name of its partition key.
+        s3_client: The S3 client, or None to leave the bucket alone.
+        bucket_name (str): The bucket to empty.
+        on_done (callable): Called with the job once everything is deleted.
+        background (bool): False to run the purge in the calling thread, where nothing runs once the
+            response is returned, e.g. on Lambda.
+
+    Returns:
+        PurgeJob: The new job, finished unless background, or the running one if it covers the same tables
+        and bucket. Raises
+        PurgeBusy if a running job does not, e.g. a purge of the bucket requested while only the tables
+        are being purged.
+    """
+    with jobs_lock:
+        for job in jobs.values():
+            if job.state == 'running':
+                if not job.covers(tables, s3_client, bucket_name):
+                    raise PurgeBusy(job)
+                return job
+        job = PurgeJob(tables, s3_client, bucket_name, on_done)
+        jobs[job.id] = job
+        while len(jobs) > purgeConfig['keepJobs']:
+            jobs.popitem(last=False)
+    if not background:
+        return runPurge(job)
+    threading.Thread(target=runPurge, args=(job,), name=f"purge-{job.id[:8]}", daemon=True).start()
+    return job
+
+
+def purgeStatus(job_id):
+    """
+    Return the progress of a purge.
+
+    Returns:
+        dict or None: PurgeJob.snapshot, or None if the job is unknown or forgotten.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+    return None if job is None else job.snapshot()
@@ -0,0 +1,61 @@
+import io
+import logging
+from PIL import Image, ImageOps
+
+# name -> (largest width and height in pixels, JPEG quality) of each rendition made on upload
+RENDITIONS = {
+    'thumbnail': ((320, 320), 80),
+    'preview': ((1280, 1280), 85),
+}
+
+
+def renditionPath(image_path, name):
+    """
+    S3 key of a rendition, stored next to the original under renditions/<name>/.
+
+    Parameters:
+        image_path (str): The S3 key of the original image.
+        name (str): A key of RENDITIONS.
+
+    Returns:
+        str: The S3 key of the rendition, always a JPEG.
+    """
+    return f"renditions/{name}/{image_path}.jpg"
+
+
+def makeRenditions(source):
+    """
+    Make the downscaled JPEG renditions of an image.
+
+    Parameters:
+        source (bytes or file object): The original image. A file object is read from its current position.
+
+    Returns:
+        dict: name -> JPEG bytes for every entry of RENDITIONS, or an empty dict if Pillow cannot
+        read the image (e.g. camera RAW or Photoshop files), in which case the original is shown.
+
+    Description:
+        Each rendition keeps the aspect ratio and is at most as large as its bounding box; smaller
+        images are not upscaled. JPEG sources are decoded at a reduced scale (Image.draft), so making
+        a thumbnail of a large photo does not decode it at full resolution. The EXIF orientation is
+        applied, since the renditions carry no EXIF data.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as original:
+            largest = max(size for size, quality in RENDITIONS.values())
+            original.draft('RGB', largest)
+            image = ImageOps.exif_transpose(original)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            renditions = {}
+            for name, (size, quality) in sorted(RENDITIONS.items(), key=lambda item: item[1][0], reverse=True):
+                image.thumbnail(size, Image.Resampling.LANCZOS)
+                output = io.BytesIO()
+                image.save(output, 'JPEG', quality=quality, optimize=True)
+                renditions[name] = output.getvalue()
+            return renditions
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.info(f"No renditions made: {e}")
+        return {}
@@ -0,0 +1,390 @@
+import os
+import mmap
+import time
+import struct
+import zlib
+import weakref
+import threading
+import tempfile
+from contextlib import contextmanager
+from FrontEnd import config
+from FrontEnd.memcache import CacheStats
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - the shared backend needs POSIX file locks
+    fcntl = None
+
+"""
+Layout of the shared cache file (all integers little-endian):
+
+    header   4096 bytes   magic, version, slot count, arena size, head, tail, shared counters and sweep cursor
+    index    slot_count * SLOT_SIZE bytes, an open-addressing hash table of the cached keys
+    arena    arena_size bytes, a circular log of records [magic, slot, length, payload]
+
+Records are appended at `head` and evicted from `tail` in insertion (FIFO) order. A slot may carry an
+expiry time (time.time(), 0 for none); expired slots miss and are removed by sweep(), which the processes
+take turns at: it walks the index a slice at a time from a cursor they share. head and tail are
+logical positions that only grow; the physical offset in the arena is position % arena_size. A record
+never wraps around the end of the arena: when it would, a padding record fills the rest of the arena.
+"""
+
+MAGIC = b'FEMCACHE'
+VERSION = 3
+HEADER_SIZE = 4096
+# magic, version, slot count, arena size, head, tail, entries, used bytes, evictions, tombstones, sweep cursor,
+# time.time() when the sweep cursor last wrapped around
+HEADER = struct.Struct('<8sIIQQQQQQQQd')
+
+SLOT_SIZE = 256
+# state, key length, key hash, record position, payload length, expiry time
+SLOT = struct.Struct('<BxHIQQd')
+KEY_MAX = SLOT_SIZE - SLOT.size
+EMPTY, USED, TOMBSTONE = 0, 1, 2
+
+RECORD_ALIGN = 16
+RECORD_MAGIC = 0x52454344
+PAD_MAGIC = 0x50414444
+# magic, slot index, record length (header + payload, aligned)
+RECORD = struct.Struct('<IIQ')
+
+
+def _align(size):
+    return (size + RECORD_ALIGN - 1) // RECORD_ALIGN * RECORD_ALIGN
+
+
+# every open SharedMemCache, whose lock is reopened in a forked child (see SharedMemCache._after_fork)
+open_caches = weakref.WeakSet()
+
+
+def _reopenLocks():
+    for cache in list(open_caches):
+        cache._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reopenLocks)
+
+
+class SharedMemCache:
+    """
+    Memcache backend shared by every front-end process on a host.
+
+    Description:
+        Entries live in one memory-mapped file (by default under /dev/shm) holding a shared hash
+        index and a circular arena, so all worker processes see the same entries and one capacity
+        limit, and an image is stored once per host instead of once per process. Access is
+        serialised across processes with an flock on the file and across the threads of one
+        process with a threading.Lock. flock locks an open file description, which a forked child
+        shares with its parent, so a child (e.g. a worker forked from a preloaded app) opens the file
+        again for its locks. Eviction is FIFO over the arena; memcacheConfig['policy']
+        only applies to the in-process backend.
+
+        Hit/miss counters and latency histograms are kept per process; entry count, size and
+        evictions come from the shared header and cover the whole host.
+    """
+
+    def __init__(self, path, capacity, slot_count):
+        if fcntl is None:
+            raise RuntimeError("The shared memcache backend needs POSIX file locking (fcntl)")
+        self.path = path
+        self.lock = threading.Lock()
+        self.local_stats = CacheStats()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # the descriptor flocked by this process: self.fd, or one opened anew after a fork
+        self.lock_fd = self.fd
+        arena_size = capacity // RECORD_ALIGN * RECORD_ALIGN
+        with self._locked(fcntl.LOCK_EX):
+            if os.fstat(self.fd).st_size < HEADER_SIZE or os.pread(self.fd, len(MAGIC), 0) != MAGIC:
+                os.ftruncate(self.fd, HEADER_SIZE + slot_count * SLOT_SIZE + arena_size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION, slot_count, arena_size, 0, 0, 0, 0, 0, 0, 0, 0.0), 0)
+            header = HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+        if header[1] != VERSION:
+            raise RuntimeError(f"{path} holds a shared memcache of version {header[1]}, expected {VERSION}")
+        self.slot_count, self.arena_size = header[2], header[3]
+        self.arena_offset = HEADER_SIZE + self.slot_count * SLOT_SIZE
+        self.map = mmap.mmap(self.fd, self.arena_offset + self.arena_size)
+        open_caches.add(self)
+
+    def _after_fork(self):
+        """In a forked child, lock through a file description of its own, and a thread lock nobody holds."""
+        self.lock = threading.Lock()
+        if self.lock_fd != self.fd:
+            os.close(self.lock_fd)
+        self.lock_fd = os.open(self.path, os.O_RDWR)
+
+    @contextmanager
+    def _locked(self, operation):
+        with self.lock:
+            fcntl.flock(self.lock_fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    # header fields 4..11 are head, tail, entries, used bytes, evictions, tombstones, sweep cursor and the
+    # time of the last full sweep
+    def _header(self):
+        return list(HEADER.unpack_from(self.map, 0))
+
+    def _store_header(self, header):
+        HEADER.pack_into(self.map, 0, *header)
+
+    def _slot(self, index):
+        return SLOT.unpack_from(self.map, HEADER_SIZE + index * SLOT_SIZE)
+
+    def _set_slot(self, index, state, key=b'', key_hash=0, position=0, length=0, expires=0.0):
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        SLOT.pack_into(self.map, offset, state, len(key), key_hash, position, length, expires)
+        if key:
+            self.map[offset + SLOT.size:offset + SLOT.size + len(key)] = key
+
+    def _find(self, key, key_hash):
+        """Return (slot index of key or None, first free slot index on the probe path or None)."""
+        free = None
+        index = key_hash % self.slot_count
+        for _ in range(self.slot_count):
+            state, key_length, slot_hash, position, length, expires = self._slot(index)
+            if state == EMPTY:
+                return None, free if free is not None else index
+            if state == TOMBSTONE:
+                if free is None:
+                    free = index
+            elif slot_hash == key_hash and key_length == len(key):
+                offset = HEADER_SIZE + index * SLOT_SIZE + SLOT.size
+                if self.map[offset:offset + key_length] == key:
+                    return index, free
+            index = (index + 1) % self.slot_count
+        return None, free
+
+    def _remove_slot(self, index, header):
+        state, key_length, key_hash, position, length, expires = self._slot(index)
+        self._set_slot(index, TOMBSTONE)
+        header[6] -= 1
+        header[7] -= _align(RECORD.size + length)
+        header[9] += 1
+
+    def _evict_tail(self, header):
+        """Drop the oldest record in the arena. Returns the number of payload bytes evicted."""
+        tail = header[5]
+        offset = self.arena_offset + tail % self.arena_size
+        magic, slot_index, record_length = RECORD.unpack_from(self.map, offset)
+        header[5] = tail + record_length
+        if magic != RECORD_MAGIC:
+            return 0
+        state, key_length, key_hash, position, length, expires = self._slot(slot_index)
+        if state == USED and position == tail:
+            self._remove_slot(slot_index, header)
+            header[8] += 1
+            return record_length
+        return 0
+
+    def _compact_index(self, header):
+        """Rehash the live slots to drop accumulated tombstones."""
+        live = []
+        for index in range(self.slot_count):
+            state, key_length, key_hash, position, length, expires = self._slot(index)
+            if state == USED:
+                offset = HEADER_SIZE + index * SLOT_SIZE + SLOT.size
+                live.append((bytes(self.map[offset:offset + key_length]), key_hash, position, length, expires))
+        self.map[HEADER_SIZE:self.arena_offset] = bytes(self.arena_offset - HEADER_SIZE)
+        for key, key_hash, position, length, expires in live:
+            slot_index = self._find(key, key_hash)[1]
+            self._set_slot(slot_index, USED, key, key_hash, position, length, expires)
+            offset = self.arena_offset + position % self.arena_size
+            RECORD.pack_into(self.map, offset, RECORD_MAGIC, slot_index, _align(RECORD.size + length))
+        header[9] = 0
+
+    @property
+    def capacity(self):
+        return self.arena_size
+
+    @property
+    def max_item_size(self):
+        """The largest record admitted: maxItemRatio of the arena, the one shard of this backend."""
+        return self.arena_size * config.memcacheConfig.get('maxItemRatio', 1)
+
+    @property
+    def total_size(self):
+        with self._locked(fcntl.LOCK_SH):
+            return self._header()[7]
+
+    def __len__(self):
+        with self._locked(fcntl.LOCK_SH):
+            return self._header()[6]
+
+    def __contains__(self, image_key):
+        key = image_key.encode('utf-8')
+        with self._locked(fcntl.LOCK_SH):
+            return self._find(key, zlib.crc32(key))[0] is not None
+
+    def get(self, image_key):
+        start = time.perf_counter()
+        key = image_key.encode('utf-8')
+        with self._locked(fcntl.LOCK_SH):
+            index = self._find(key, zlib.crc32(key))[0]
+            value = None
+            if index is not None:
+                state, key_length, key_hash, position, length, expires = self._slot(index)
+                if not expires or expires > time.time():
+                    offset = self.arena_offset + position % self.arena_size + RECORD.size
+                    value = self.map[offset:offset + length]
+            # the per-process stats are guarded by self.lock, which is held here
+            if value is None:
+                self.local_stats.misses += 1
+                self.local_stats.window.add('misses')
+            else:
+                self.local_stats.hits += 1
+                self.local_stats.window.add('hits')
+            self.local_stats.get_latency.observe(time.perf_counter() - start)
+            return value
+
+    def touch(self, image_key):
+        return image_key in self
+
+    def put(self, image_key, value, size, ttl=None):
+        """
+        Append value to the arena and index it under image_key, evicting the oldest records as needed.
+
+        The size argument is ignored: the shared arena charges the real record size (payload plus a
+        16-byte header, rounded up to 16 bytes). ttl is in seconds; None or 0 means no expiry.
+        """
+        start = time.perf_counter()
+        key = image_key.encode('utf-8')
+        payload = memoryview(value)
+        record_length = _align(RECORD.size + payload.nbytes)
+        with self._locked(fcntl.LOCK_EX):
+            self.local_stats.puts += 1
+            if len(key) > KEY_MAX or record_length > self.arena_size or record_length > self.max_item_size:
+                self.local_stats.rejected += 1
+                return False
+            header = self._header()
+            key_hash = zlib.crc32(key)
+            index = self._find(key, key_hash)[0]
+            if index is not None:
+                self._remove_slot(index, header)
+            if header[6] + header[9] + 1 > self.slot_count * 0.75:
+                self._compact_index(header)
+            while header[6] + 1 > self.slot_count * 0.75:
+                self._count_eviction(self._evict_tail(header))
+
+            # skip to the start of the arena if the record would run past its end
+            padding = 0
+            if header[4] % self.arena_size + record_length > self.arena_size:
+                padding = self.arena_size - header[4] % self.arena_size
+            while header[4] + padding + record_length - header[5] > self.arena_size:
+                if header[5] == header[4]:
+                    # the arena is empty, restart at its beginning
+                    header[4] = header[5] = header[4] + padding
+                    padding = 0
+                    continue
+                self._count_eviction(self._evict_tail(header))
+            if padding:
+                RECORD.pack_into(self.map, self.arena_offset + header[4] % self.arena_size, PAD_MAGIC, 0, padding)
+                header[4] += padding
+
+            position = header[4]
+            slot_index = self._find(key, key_hash)[1]
+            offset = self.arena_offset + position % self.arena_size
+            RECORD.pack_into(self.map, offset, RECORD_MAGIC, slot_index, record_length)
+            self.map[offset + RECORD.size:offset + RECORD.size + payload.nbytes] = payload.cast('B')
+            expires = time.time() + ttl if ttl else 0.0
+            self._set_slot(slot_index, USED, key, key_hash, position, payload.nbytes, expires)
+            header[4] += record_length
+            header[6] += 1
+            header[7] += record_length
+            self._store_header(header)
+            self.local_stats.bytes_admitted += record_length
+            self.local_stats.window.add('bytes_admitted', record_length)
+            self.local_stats.put_latency.observe(time.perf_counter() - start)
+            return True
+
+    def _count_eviction(self, size):
+        if size:
+            self.local_stats.evictions['FIFO'] += 1
+            self.local_stats.bytes_evicted += size
+            self.local_stats.window.add('evictions')
+            self.local_stats.window.add('bytes_evicted', size)
+
+    def invalidate(self, image_key):
+        key = image_key.encode('utf-8')
+        with self._locked(fcntl.LOCK_EX):
+            index = self._find(key, zlib.crc32(key))[0]
+            if index is None:
+                return False
+            header = self._header()
+            self._remove_slot(index, header)
+            self._store_header(header)
+            return True
+
+    def clear(self):
+        with self._locked(fcntl.LOCK_EX):
+            self.map[HEADER_SIZE:self.arena_offset] = bytes(self.arena_offset - HEADER_SIZE)
+            header = self._header()
+            header[4:12] = [0, 0, 0, 0, 0, 0, 0, 0.0]
+            self._store_header(header)
+
+    def sweep(self, limit, watermark=1.0):
+        """
+        Expire entries in the next limit * 16 index slots, then evict from the tail of the arena down to
+        watermark * capacity, at most `limit` records per call.
+
+        The cursor of the index scan is kept in the shared header, so the sweepers of all processes
+        continue each other's scan instead of each walking the whole index, and a new scan is only
+        started once memcacheConfig['sweepInterval'] seconds have passed since the last one completed.
+        The lock is released after every slice.
+
+        Returns:
+            int: The number of entries removed, plus one while the scan of the index has not wrapped
+            around; 0 once a full pass is done and nothing is left to evict.
+        """
+        removed = 0
+        now = time.time()
+        with self._locked(fcntl.LOCK_EX):
+            header = self._header()
+            cursor = header[10]
+            if cursor or now - header[11] >= config.memcacheConfig.get('sweepInterval', 1.0):
+                end = min(cursor + limit * 16, self.slot_count)
+                for index in range(cursor, end):
+                    state, key_length, key_hash, position, length, expires = self._slot(index)
+                    if state == USED and expires and expires <= now:
+                        self._remove_slot(index, header)
+                        self.local_stats.expired += 1
+                        self.local_stats.bytes_expired += _align(RECORD.size + length)
+                        self.local_stats.window.add('expired')
+                        removed += 1
+                header[10] = end % self.slot_count
+                if not header[10]:
+                    header[11] = now
+            evicted = 0
+            while evicted < limit and header[4] != header[5] and header[4] - header[5] > self.arena_size * watermark:
+                self._count_eviction(self._evict_tail(header))
+                evicted += 1
+            self._store_header(header)
+        return removed + evicted + (1 if header[10] else 0)
+
+    def stats(self):
+        """Return the same (report, get_latency, put_latency, evictions) tuple as ShardedMemCache.stats."""
+        from FrontEnd.memcache import mergeStats
+        with self._locked(fcntl.LOCK_SH):
+            header = self._header()
+            report = mergeStats([(self.local_stats, header[6], header[7], self.arena_size)])
+        report[0]['policy'] = 'FIFO'
+        report[0]['host_evictions'] = header[8]
+        return report
+
+    def close(self):
+        open_caches.discard(self)
+        self.map.close()
+        if self.lock_fd != self.fd:
+            os.close(self.lock_fd)
+        os.close(self.fd)
+
+
+def defaultSharedPath():
+    """The shared cache file: memcacheConfig['sharedPath'], or a file in /dev/shm (or the temp dir)."""
+    path = config.memcacheConfig.get('sharedPath')
+    if path:
+        return path
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'frontend-memcache')
@@ -0,0 +1,430 @@
+import os
+import mmap
+import time
+import zlib
+import atexit
+import struct
+import logging
+import tempfile
+import threading
+import contextlib
+from FrontEnd import config
+from FrontEnd import memcache
+from FrontEnd.memcache import entrySize
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - without POSIX file locks only one process may snapshot a file
+    fcntl = None
+
+"""
+Layout of a memcache snapshot file (all integers little-endian):
+
+    magic     8 bytes, b'FESNAP02'
+    records   header, key (utf-8), payload
+
+A record header holds the record kind, key length, payload length, CRC-32 of the payload, hit count, time
+of the last access and expiry time (time.time() values, 0 for no expiry). An IMAGE record holds one cached
+image. An ORDER record has no key; its payload lists the keys of the snapshot, hottest first, each as its
+length, hit count and the key itself.
+
+The file is a log: every periodic snapshot only appends the images cached since the last one, then an
+ORDER record, and fsyncs what it appended. The last complete ORDER record is the snapshot, and the last
+IMAGE record of every key it lists holds that key's image, so a snapshot cut short by a crash leaves the
+previous one intact. Once the file holds more than snapshotCompactRatio times the bytes the last snapshot
+lists, the next snapshot compacts it: writes only those to a temporary file that replaces the log.
+
+The processes of a server share the file, so a snapshot is appended or compacted holding an exclusive
+flock on the file named like it plus '.lock', and every record is appended with a single write.
+"""
+
+MAGIC = b'FESNAP02'
+# record kind, key length, payload length, payload crc32, hit count, last access time, expiry time
+RECORD = struct.Struct('<BHIIIdd')
+IMAGE = 0
+ORDER = 1
+# key length and hit count of each key of an ORDER record
+ORDER_ENTRY = struct.Struct('<HI')
+# hit counts replayed into the replacement policy on load are capped, like the TinyLFU sketch counters
+MAX_REPLAYED_HITS = 15
+
+write_lock = threading.Lock()
+
+
+def defaultSnapshotPath():
+    """The snapshot file: memcacheConfig['snapshotPath'], or a file in the temp dir."""
+    path = config.memcacheConfig.get('snapshotPath')
+    if path:
+        return path
+    return os.path.join(tempfile.gettempdir(), 'frontend-memcache.snapshot')
+
+
+@contextlib.contextmanager
+def lockedSnapshot(path):
+    """
+    Hold the exclusive lock of a snapshot file, so processes append to and compact it one at a time.
+
+    Parameters:
+        path (str): The snapshot file; the lock is taken on path + '.lock', which is never replaced.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
+
+
+class SnapshotLog:
+    """
+    The snapshot file the memcache of this process is periodically written to.
+
+    Description:
+        The memcache reports every key it puts, invalidates or clears through changed() and
+        changed_all(), so write() knows which cached images the file already holds and appends only the
+        others. It compacts the file instead on its first write, after subCLEAR, once the file has grown
+        past snapshotCompactRatio times the snapshot, or when another process has replaced the file,
+        since the images this process appended are then gone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # keys whose cached image is in the file
+        self.logged = set()
+        # keys changed while write() runs, or None between writes
+        self.changing = None
+        # incremented by changed_all
+        self.generation = 0
+        self.compact = True
+        # (st_dev, st_ino) of the file as last written
+        self.identity = None
+
+    def changed(self, image_key):
+        """Note that the cached image of image_key is not the one in the file any more."""
+        with self.lock:
+            self.logged.discard(image_key)
+            if self.changing is not None:
+                self.changing.add(image_key)
+
+    def changed_all(self):
+        """Note that the memcache was cleared."""
+        with self.lock:
+            self.logged.clear()
+            self.generation += 1
+            self.compact = True
+
+    def _identity(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def write(self, cache=None, max_bytes=None):
+        """
+        Write the hottest entries of the memcache to the snapshot file.
+
+        Parameters:
+            cache (ShardedMemCache): The cache to snapshot, by default the memcache of this process.
+            max_bytes (int): The most payload and record bytes the snapshot lists, by default
+                memcacheConfig['snapshotMB'].
+
+        Returns:
+            tuple: (the number of entries in the snapshot, the number of images written).
+        """
+        cache = memcache.memcache if cache is None else cache
+        if max_bytes is None:
+            max_bytes = config.memcacheConfig.get('snapshotMB', 512) * 1048576
+        now = time.time()
+        # the file is checked for replacement by another process under its lock, so it cannot be replaced
+        # between the check and the append
+        with write_lock, lockedSnapshot(self.path):
+            with self.lock:
+                self.changing = set()
+                generation = self.generation
+                compact = self.compact or self.identity is None or self.identity != self._identity()
+                logged = set() if compact else set(self.logged)
+            try:
+                listed, written, order, size = self._write_records(cache, max_bytes, now, compact, logged)
+            except BaseException:
+                with self.lock:
+                    self.changing = None
+                    self.compact = True
+                raise
+            with self.lock:
+                if generation == self.generation:
+                    self.logged = ((logged & listed.keys()) | written) - self.changing
+                self.changing = None
+                live = len(MAGIC) + sum(RECORD.size + size for size in listed.values()) + RECORD.size + len(order)
+                self.compact = size > config.memcacheConfig.get('snapshotCompactRatio', 2) * live
+                self.identity = self._identity()
+        return len(listed), len(written)
+
+    def _write_records(self, cache, max_bytes, now, compact, logged):
+        """
+        Append a snapshot to the file, or write a compacted file that replaces it. Call with write_lock and
+        the file lock held.
+
+        Returns:
+            tuple: (key -> key and payload bytes of every entry listed, the keys whose image was written,
+            the ORDER payload, the size of the file).
+        """
+        listed = {}
+        written = set()
+        order = []
+        total = 0
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary if compact else self.path, 'wb' if compact else 'ab') as file:
+            if compact:
+                file.write(MAGIC)
+            for image_key, value, hits, last_access, expires in cache.hot_entries():
+                if expires and expires <= now:
+                    continue
+                key = image_key.encode('utf-8')
+                payload = memoryview(value).cast('B')
+                total += RECORD.size + len(key) + payload.nbytes
+                if total > max_bytes:
+                    break
+                if image_key not in logged:
+                    file.write(b''.join((RECORD.pack(IMAGE, len(key), payload.nbytes, zlib.crc32(payload), hits,
+                                                     last_access, expires), key, payload)))
+                    written.add(image_key)
+                listed[image_key] = len(key) + payload.nbytes
+                order.append(ORDER_ENTRY.pack(len(key), hits) + key)
+            order = b''.join(order)
+            file.write(RECORD.pack(ORDER, 0, len(order), zlib.crc32(order), 0, now, 0) + order)
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        if compact:
+            os.replace(temporary, self.path)
+        return listed, written, order, size
+
+
+def writeSnapshot(path, cache=None, max_bytes=None):
+    """
+    Write the hottest entries of the memcache to a new snapshot file.
+
+    Parameters:
+        path (str): The snapshot file, replaced atomically.
+        cache (ShardedMemCache): The cache to snapshot, by default the memcache of this process.
+        max_bytes (int): The most payload and record bytes to write, by default memcacheConfig['snapshotMB'].
+
+    Returns:
+        int: The number of entries written.
+    """
+    return SnapshotLog(path).write(cache, max_bytes)[0]
+
+
+class WarmSnapshot:
+    """
+    A snapshot file being loaded into the memcache at startup.
+
+    Description:
+        open() maps the file read-only and reads only the record headers and the last ORDER record to
+        index it, so the images themselves are not read until they are needed. load() then copies the hottest entries that fit
+        in the cache into the memcache, coldest of them first so the hottest end up most recently used,
+        and replays their hit counts into the replacement policy.
+
+        Until loading finishes, subGET calls get() on a miss, which serves the entry straight from the
+        map and caches it. subPUT, subInvalidateKey and subCLEAR discard the snapshot copy of their key,
+        so an image from the snapshot never replaces a newer one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+        self.index = {}
+        # keys discarded before the index was published, and whether subCLEAR ran meanwhile
+        self.discarded = set()
+        self.cleared = False
+        self.loaded = 0
+        self.served = 0
+
+    def open(self):
+        """Map the file and index the entries of its last snapshot. Returns False if there is no valid snapshot."""
+        with open(self.path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size <= len(MAGIC):
+                return False
+            snapshot_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if snapshot_map[:len(MAGIC)] != MAGIC:
+            snapshot_map.close()
+            return False
+        # key -> the last image record of the key, and the payload of the last complete ORDER record
+        images = {}
+        order = None
+        offset = len(MAGIC)
+        while offset + RECORD.size <= len(snapshot_map):
+            kind, key_length, length, crc, hits, last_access, expires = RECORD.unpack_from(snapshot_map, offset)
+            start = offset + RECORD.size + key_length
+            if start + length > len(snapshot_map):
+                break
+            if kind == IMAGE:
+                image_key = snapshot_map[offset + RECORD.size:start].decode('utf-8')
+                images[image_key] = (start, length, crc, expires)
+            elif kind == ORDER and zlib.crc32(snapshot_map[start:start + length]) == crc:
+                order = snapshot_map[start:start + length]
+            offset = start + length
+        if order is None:
+            snapshot_map.close()
+            return False
+        index = {}
+        now = time.time()
+        offset = 0
+        while offset < len(order):
+            key_length, hits = ORDER_ENTRY.unpack_from(order, offset)
+            offset += ORDER_ENTRY.size
+            image_key = order[offset:offset + key_length].decode('utf-8')
+            offset += key_length
+            if image_key in images:
+                start, length, crc, expires = images[image_key]
+                if not expires or expires > now:
+                    index[image_key] = (start, length, crc, hits, expires)
+        with self.lock:
+            if self.cleared:
+                index.clear()
+            for image_key in self.discarded:
+                index.pop(image_key, None)
+            self.map = snapshot_map
+            self.index = index
+        return True
+
+    def _restore(self, image_key):
+        """Move one entry from the snapshot into the memcache. Call with self.lock held."""
+        entry = self.index.pop(image_key, None)
+        if entry is None:
+            return None
+        start, length, crc, hits, expires = entry
+        payload = self.map[start:start + length]
+        if zlib.crc32(payload) != crc:
+            logging.error(f"Corrupt memcache snapshot record for {image_key} in {self.path}")
+            return None
+        ttl = 0
+        if expires:
+            ttl = expires - time.time()
+            if ttl <= 0:
+                return None
+        cache = memcache.memcache
+        if cache.put(image_key, payload, entrySize(image_key, payload), ttl):
+            for _ in range(min(hits, MAX_REPLAYED_HITS)):
+                cache.touch(image_key)
+        return payload
+
+    def get(self, image_key):
+        """Return the snapshot copy of image_key and cache it, or None."""
+        with self.lock:
+            payload = self._restore(image_key)
+            if payload is not None:
+                self.served += 1
+            return payload
+
+    def discard(self, image_key):
+        """Forget the snapshot copy of image_key."""
+        with self.lock:
+            self.index.pop(image_key, None)
+            if self.map is None:
+                self.discarded.add(image_key)
+
+    def discard_all(self):
+        """Forget every snapshot entry."""
+        with self.lock:
+            self.index.clear()
+            self.cleared = True
+
+    def load(self):
+        """
+        Load the snapshot into the memcache, then release the file.
+
+        Returns:
+            int: The number of entries loaded.
+        """
+        try:
+            if self.map is None and not self.open():
+                return 0
+            budget = memcache.memcache.capacity * config.memcacheConfig.get('sweepWatermark', 0.9)
+            selected = []
+            with self.lock:
+                # the index follows the ORDER record, hottest first
+                for image_key, (start, length, crc, hits, expires) in self.index.items():
+                    budget -= entrySize(image_key, b'') + length
+                    if budget < 0:
+                        break
+                    selected.append(image_key)
+            for image_key in reversed(selected):
+                with self.lock:
+                    if self._restore(image_key) is not None:
+                        self.loaded += 1
+            logging.info(f"Loaded {self.loaded} memcache entries from {self.path}")
+            return self.loaded
+        except (OSError, ValueError, struct.error) as e:
+            logging.error(f"Could not load memcache snapshot {self.path}: {e}")
+            return self.loaded
+        finally:
+            with self.lock:
+                self.index.clear()
+                if self.map is not None:
+                    self.map.close()
+                    self.map = None
+            if memcache.warmSnapshot is self:
+                memcache.warmSnapshot = None
+
+
+def warmStart(path=None):
+    """
+    Start loading a snapshot into the memcache in a background thread.
+
+    Returns:
+        threading.Thread or None: The loading thread, or None if there is no snapshot file.
+    """
+    path = path or defaultSnapshotPath()
+    if not os.path.exists(path):
+        return None
+    snapshot = WarmSnapshot(path)
+    memcache.warmSnapshot = snapshot
+    thread = threading.Thread(target=snapshot.load, name='memcache-warm-start', daemon=True)
+    thread.start()
+    return thread
+
+
+def saveSnapshot(log):
+    """Write a snapshot to a SnapshotLog unless one is still being loaded. Errors are logged, not raised."""
+    if memcache.warmSnapshot is not None:
+        return
+    try:
+        count, written = log.write()
+        logging.info(f"Wrote a snapshot of {count} memcache entries to {log.path}, {written} of them anew")
+    except (OSError, ValueError, struct.error) as e:
+        logging.error(f"Could not write memcache snapshot {log.path}: {e}")
+
+
+def startSnapshots():
+    """
+    Warm the memcache from the last snapshot, then snapshot it every memcacheConfig['snapshotInterval']
+    seconds and at exit, appending to the snapshot file (see SnapshotLog).
+
+    Returns:
+        threading.Event or None: Set it to stop the periodic snapshots; None if snapshots are disabled
+        (snapshotInterval 0) or the backend is not the in-process cache.
+    """
+    interval = config.memcacheConfig.get('snapshotInterval', 300)
+    if not interval or config.memcacheConfig.get('backend', 'local') != 'local':
+        return None
+    path = defaultSnapshotPath()
+    warmStart(path)
+    log = SnapshotLog(path)
+    memcache.snapshotLog = log
+    stop = threading.Event()
+
+    def snapshotLoop():
+        while not stop.wait(interval):
+            saveSnapshot(log)
+
+    threading.Thread(target=snapshotLoop, name='memcache-snapshot', daemon=True).start()
+    atexit.register(saveSnapshot, log)
+    return stop
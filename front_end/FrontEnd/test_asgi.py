@@ -0,0 +1,233 @@
+import io
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+from FrontEnd import webapp, main, asgi, backend_client
+from FrontEnd.backend_client import BackendClient
+from FrontEnd.memcache import subGET, subPUT
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(24)
+
+
+class FakeS3Response:
+    """A streamed httpx response of a presigned S3 GET."""
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {'Content-Length': str(len(content)), 'ETag': '"s3-etag"',
+                        'Content-Type': 'image/png', **(headers or {})}
+        self.closed = False
+
+    async def aread(self):
+        return self.content
+
+    async def aiter_bytes(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeHTTP:
+    """An httpx.AsyncClient serving presigned S3 URLs from a dict of objects."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+        self.puts = []
+
+    def build_request(self, method, url, headers=None):
+        return url, headers or {}
+
+    async def send(self, request, stream=False):
+        url, headers = request
+        self.requests.append(request)
+        key = url.split('/', 3)[3]
+        if key not in self.objects:
+            return FakeS3Response(b'', 404)
+        content = self.objects[key]
+        if 'Range' in headers:
+            first, last = headers['Range'].split('=')[1].split('-')
+            part = content[int(first):int(last) + 1]
+            return FakeS3Response(part, 206, {'Content-Range': f"bytes {first}-{last}/{len(content)}"})
+        return FakeS3Response(content)
+
+    async def put(self, url, content):
+        self.puts.append((url.split('/', 3)[3], content))
+        return Mock(status_code=200)
+
+
+def call(path, method='GET', headers=None, body=b'', query=b''):
+    """Send one request through the ASGI app. Returns (status, headers, body)."""
+    async def run():
+        messages = []
+        requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            return requests.pop(0) if requests else {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'http_version': '1.1',
+                 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]}
+        await asgi.app(scope, receive, send)
+        if asgi.background:
+            await asyncio.wait(set(asgi.background))
+        return messages
+
+    messages = asyncio.run(run())
+    response_headers = {name.decode(): value.decode() for name, value in messages[0]['headers']}
+    return messages[0]['status'], response_headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class TestASGI(unittest.TestCase):
+    """
+    Test the coroutine routes and the Flask fallback of the ASGI mode.
+    """
+
+    def setUp(self):
+        """
+        Serve from a fake S3 behind presigned URLs, a mock images table and a mock async back-end client.
+        """
+        self.table = Mock()
+        self.table.get_item.side_effect = lambda Key: (
+            {'Item': {'image_key': Key['image_key'], 'image_path': 'objects/' + Key['image_key']}}
+            if Key['image_key'].startswith('asgi-') else {})
+        self.s3_client = Mock()
+        self.s3_client.generate_presigned_url.side_effect = \
+            lambda operation, Params, ExpiresIn: f"https://s3/{Params['Key']}"
+        self.http = FakeHTTP({'objects/asgi-small': PNG, 'objects/asgi-large': bytes(range(200))})
+        self.edit_client = Mock()
+        self.edit_client.edit_image = AsyncMock(return_value=(PNG, {}))
+        for target, name, value in ((webapp, 'before_first_request_funcs', []), (main, 'table', self.table),
+                                    (main, 's3_client', self.s3_client), (asgi, 'http', self.http),
+                                    (asgi, 'async_client', self.edit_client)):
+            patcher = patch.object(target, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_image_from_memcache(self):
+        """
+        A cached image is served without S3, with an ETag that revalidates to 304.
+        """
+        subPUT('asgi-cached', PNG)
+        status, headers, body = call('/image/asgi-cached')
+        self.assertEqual((status, body, headers['content-type']), (200, PNG, 'image/png'))
+        status, headers, body = call('/image/asgi-cached', headers={'If-None-Match': headers['etag']})
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(self.http.requests, [])
+
+    def test_image_from_s3(self):
+        """
+        An image missing from the memcache is fetched through a presigned URL and cached.
+        """
+        status, headers, body = call('/image/asgi-small')
+        self.assertEqual((status, body), (200, PNG))
+        self.assertEqual(bytes(subGET('asgi-small')), PNG)
+        self.assertEqual(call('/image/unknown')[0], 404)
+
+    def test_node_cache_off_the_loop(self):
+        """
+        With the cache nodes as the backend, the memcache is read and written, and edit results stored,
+        from the thread pool.
+        """
+        calls = []
+
+        async def runSync(function, *args, **kwargs):
+            calls.append(getattr(function, '__name__', None))
+            return function(*args, **kwargs)
+
+        self.http.objects['objects/asgi-pooled'] = PNG
+        boundary, form = encode_multipart({'file': FileStorage(io.BytesIO(b'original'), filename='a.png'),
+                                           'degree': '90'})
+        with patch.dict(asgi.memcacheConfig, backend='pool'), patch.object(asgi, 'runSync', runSync):
+            status, headers, body = call('/image/asgi-pooled')
+            self.assertEqual((status, body), (200, PNG))
+            self.assertIn('subGET', calls)
+            self.assertIn('subPUT', calls)
+            calls.clear()
+            with patch.object(main, 'stash_results', wraps=main.stash_results) as stash_results:
+                stash_results.__name__ = 'stash_results'
+                status, headers, page = call('/image_rotate', 'POST',
+                                             {'Content-Type': f'multipart/form-data; boundary={boundary}'}, form)
+        self.assertEqual(status, 200)
+        self.assertEqual(calls, ['stash_results'])
+        stash_results.assert_called_once()
+
+    def test_large_image_streamed(self):
+        """
+        An image too large for the memcache is streamed with the S3 ETag, and a Range request passed on.
+        """
+        with patch.object(main, 'max_buffered_size', return_value=16), patch.object(main, 'IMAGE_CHUNK_SIZE', 64):
+            status, headers, body = call('/image/asgi-large')
+            self.assertEqual((status, body, headers['etag']), (200, bytes(range(200)), '"s3-etag"'))
+            status, headers, body = call('/image/asgi-large', headers={'Range': 'bytes=10-19'})
+        self.assertEqual((status, body, headers['content-range']), (206, bytes(range(10, 20)), 'bytes 10-19/200'))
+        self.assertEqual(self.http.requests[-1][1], {'Range': 'bytes=10-19'})
+        self.assertFalse(subGET('asgi-large'))
+
+    def test_edit(self):
+        """
+        An edit is sent to the back end and rendered; the upload is saved to S3 in the background.
+        """
+        boundary, body = encode_multipart({'file': FileStorage(io.BytesIO(b'original'), filename='a.png'),
+                                           'degree': '90'})
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        status, response_headers, page = call('/image_rotate', 'POST', headers, body)
+        self.assertEqual(status, 200)
+        self.assertIn(b'/result/', page)
+        self.edit_client.edit_image.assert_awaited_once_with('/rotate_image', b'original', degree=90)
+        self.assertEqual(self.http.puts, [('image/a.png', b'original')])
+
+        boundary, body = encode_multipart({'file': FileStorage(io.BytesIO(b'original'), filename='a.png')})
+        status, response_headers, page = call('/image_rotate', 'POST',
+                                              {'Content-Type': f'multipart/form-data; boundary={boundary}'}, body)
+        self.assertEqual(status, 302)
+        self.assertIn('failure', response_headers['location'])
+
+    def test_fallback(self):
+        """
+        Routes without a coroutine are served by the Flask app.
+        """
+        status, headers, body = call('/backend/stats')
+        self.assertEqual((status, headers['content-type']), (200, 'application/json'))
+        self.assertEqual(call('/no-such-page')[0], 404)
+
+
+
+@unittest.skipIf(asgi.httpx is None, "the ASGI mode needs httpx")
+class TestAsyncBackendClient(unittest.TestCase):
+    """
+    Test the retries of the async back-end client against a mock httpx transport.
+    """
+
+    def test_retry_on_other_backend(self):
+        httpx = asgi.httpx
+        answers = {'http://a': httpx.Response(503), 'http://b': httpx.Response(
+            200, content=PNG, headers={'Content-Type': 'image/png', 'X-Edit-Protocol': 'binary'})}
+
+        def handler(request):
+            return answers[f"{request.url.scheme}://{request.url.host}"]
+
+        async def edit():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+                return await asgi.AsyncBackendClient(sync, http).edit_image('/rotate_image', b'image', degree=90)
+
+        with patch.dict(backend_client.backendConfig, retryBackoff=0):
+            sync = BackendClient()
+            self.addCleanup(sync.executor.shutdown)
+            sync.pool.set_endpoints(['http://a', 'http://b'])
+            # busy, so the first attempt goes to the failing back end
+            sync.pool.backends['http://b'].outstanding = 1
+            self.assertEqual(asyncio.run(edit()), (PNG, {}))
+        self.assertEqual(sync.stats()['retries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+import json
+import time
+import base64
+import unittest
+from unittest.mock import Mock, patch
+import requests
+from FrontEnd import backend_client
+from FrontEnd.backend_client import BackendClient, BackendPool, editImage, headerName, HEDGE_MIN_SAMPLES
+
+
+def response(content=b'', headers=None, json_body=None, status_code=200):
+    """A mock requests.Response."""
+    mock = Mock(content=content, headers=headers or {}, status_code=status_code)
+    mock.json.side_effect = lambda: dict(json_body)
+    return mock
+
+
+class TestEditProtocol(unittest.TestCase):
+    """
+    Test the negotiated binary/JSON format of the back-end edit requests.
+    """
+
+    def setUp(self):
+        """
+        Start with no known back ends and a mock session.post.
+        """
+        patcher = patch.dict(backend_client.protocols, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(backend_client.client, 'pool', BackendPool(['http://back']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(backend_client.client.session, 'post')
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_header_names(self):
+        self.assertEqual(headerName('kernel_size'), 'X-Edit-Kernel-Size')
+        self.assertEqual(headerName('degree'), 'X-Edit-Degree')
+
+    def test_binary(self):
+        """
+        The image is sent as the body and the parameters as headers; results come back in headers.
+        """
+        self.post.return_value = response(b'png', {'Content-Type': 'image/png', 'X-Edit-Protocol': 'binary',
+                                                   'X-Edit-Label-List': json.dumps(['Cat'])})
+        content, results = editImage('/get_label', b'image', image_field='image', degree=90)
+        self.assertEqual((content, results), (b'png', {'label_list': ['Cat']}))
+        args, kwargs = self.post.call_args
+        self.assertEqual(args, ('http://back/get_label',))
+        self.assertEqual(kwargs['data'], b'image')
+        self.assertEqual(kwargs['headers']['X-Edit-Degree'], '90')
+        self.assertEqual(kwargs['headers']['Content-Type'], 'application/octet-stream')
+
+    def test_json_fallback(self):
+        """
+        A back end without the protocol header gets the request again as JSON, and only JSON afterwards.
+        """
+        old_backend = response(headers={'Content-Type': 'application/json'}, json_body={'error': 'bad request'})
+        json_response = response(headers={'Content-Type': 'application/json'},
+                                 json_body={'image_string': base64.b64encode(b'png').decode('utf-8')})
+        self.post.side_effect = [old_backend, json_response, json_response]
+        self.assertEqual(editImage('/rotate_image', b'image', degree=90), (b'png', {}))
+        self.assertFalse(backend_client.speaksBinary('http://back'))
+        self.assertEqual(self.post.call_args.kwargs['json'],
+                         {'degree': 90, 'image_path': base64.b64encode(b'image').decode('utf-8')})
+        editImage('/rotate_image', b'image', degree=90)
+        self.assertEqual(self.post.call_count, 3)
+        self.assertIn('json', self.post.call_args.kwargs)
+
+    def test_binary_tried_again_later(self):
+        """
+        A back end sent JSON after a response without the protocol header is tried in binary again later.
+        """
+        backend_client.protocols['http://back'] = time.monotonic() - 1
+        self.post.return_value = response(b'png', {'Content-Type': 'image/png', 'X-Edit-Protocol': 'binary'})
+        self.assertEqual(editImage('/rotate_image', b'image', degree=90), (b'png', {}))
+        self.assertEqual(self.post.call_args.kwargs['data'], b'image')
+        self.assertIs(backend_client.protocols['http://back'], True)
+
+    def test_proxy_error_keeps_binary(self):
+        """
+        A 502 without the protocol header, e.g. from a proxy, does not switch the back end to JSON.
+        """
+        self.post.return_value = response(b'Bad Gateway', {'Content-Type': 'text/html'}, status_code=502)
+        self.post.return_value.raise_for_status.side_effect = requests.HTTPError('502 Bad Gateway')
+        with patch.dict(backend_client.backendConfig, retries=0), self.assertRaises(requests.HTTPError):
+            editImage('/rotate_image', b'image', degree=90)
+        self.assertTrue(backend_client.speaksBinary('http://back'))
+        self.assertEqual(self.post.call_count, 1)
+
+
+
+class TestBackendClient(unittest.TestCase):
+    """
+    Test the timeouts, retries and hedging of the pooled back-end client.
+    """
+
+    def setUp(self):
+        """
+        Use a fresh client of two back ends with a mock session.post and no backoff between retries.
+        """
+        patcher = patch.dict(backend_client.backendConfig, retryBackoff=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = BackendClient()
+        self.client.pool.set_endpoints(['http://a', 'http://b'])
+        self.addCleanup(self.client.executor.shutdown)
+        patcher = patch.object(self.client.session, 'post')
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_endpoint_timeouts(self):
+        self.post.return_value = response()
+        self.client.post('/get_label', lambda url: {})
+        self.client.post('/rotate_image', lambda url: {})
+        config = backend_client.backendConfig
+        timeouts = [call.kwargs['timeout'] for call in self.post.call_args_list]
+        self.assertEqual(timeouts, [(config['connectTimeout'], config['timeouts']['/get_label']),
+                                    (config['connectTimeout'], config['timeouts']['default'])])
+
+    def test_retries(self):
+        """
+        Connection errors and 503s are retried on the other back end; other errors are returned at once.
+        """
+        ok = response(b'png')
+        self.post.side_effect = [requests.ConnectionError(), response(status_code=503), ok]
+        self.assertIs(self.client.post('/rotate_image', lambda url: {}), ok)
+        urls = [call.args[0] for call in self.post.call_args_list]
+        self.assertEqual(len(set(urls[:2])), 2)
+        self.assertEqual(self.client.stats()['retries'], 2)
+
+        bad_request = response(status_code=400)
+        self.post.side_effect = [bad_request]
+        self.assertIs(self.client.post('/rotate_image', lambda url: {}), bad_request)
+
+    def test_retries_exhausted(self):
+        self.post.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            self.client.post('/rotate_image', lambda url: {})
+        self.assertEqual(self.post.call_count, backend_client.backendConfig['retries'] + 1)
+        stats = self.client.stats()
+        self.assertEqual((stats['failures'], stats['outstanding']), (1, 0))
+
+    def test_hedge(self):
+        """
+        Once the latency of an endpoint is known, a request slower than its quantile is sent twice.
+        """
+        self.post.return_value = response()
+        for _ in range(HEDGE_MIN_SAMPLES):
+            self.client.post('/rotate_image', lambda url: {})
+        self.client.counters['requests'] = 100
+        slow, fast = response(b'slow'), response(b'fast')
+
+        def post(url, **kwargs):
+            if self.post.call_count == HEDGE_MIN_SAMPLES + 1:
+                time.sleep(0.5)
+                return slow
+            return fast
+        self.post.side_effect = post
+        self.assertIs(self.client.post('/rotate_image', lambda url: {}), fast)
+        self.assertEqual(len({call.args[0] for call in self.post.call_args_list[-2:]}), 2)
+        stats = self.client.stats()
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+
+    def test_hedge_budget(self):
+        """
+        No request is hedged once hedges reach hedgeRatio of all requests.
+        """
+        self.post.return_value = response()
+        for _ in range(HEDGE_MIN_SAMPLES):
+            self.client.post('/rotate_image', lambda url: {})
+        self.assertIsNotNone(self.client.hedge_delay('/rotate_image'))
+        self.client.counters['hedges'] = HEDGE_MIN_SAMPLES
+        self.assertIsNone(self.client.hedge_delay('/rotate_image'))
+        self.assertIsNone(self.client.hedge_delay('/get_label'))
+
+    def test_prometheus_stats(self):
+        self.post.return_value = response()
+        self.client.post('/rotate_image', lambda url: {})
+        text = self.client.stats('prometheus')
+        self.assertIn('backend_requests_total 1', text)
+        self.assertIn('backend_outstanding_requests 0', text)
+        self.assertIn('backend_request_seconds_count 1', text)
+        self.assertIn('backend_healthy_backends 2', text)
+
+
+
+class TestBackendPool(unittest.TestCase):
+    """
+    Test the balancing, health checks and outlier ejection of the back-end pool.
+    """
+
+    def setUp(self):
+        self.pool = BackendPool(['http://a', 'http://b', 'http://c', 'http://d'])
+
+    def test_least_outstanding(self):
+        """
+        Requests go to the back ends with the fewest requests in flight, spreading over idle ones.
+        """
+        first = [self.pool.acquire() for _ in range(4)]
+        self.assertEqual({backend.url for backend in first}, set(self.pool.urls()))
+        self.pool.release(first[0], False)
+        self.assertIs(self.pool.acquire(), first[0])
+
+    def test_power_of_two_choices(self):
+        busy = self.pool.backends['http://a']
+        busy.outstanding = 100
+        with patch.dict(backend_client.backendConfig, balancer='p2c'):
+            picks = [self.pool.acquire() for _ in range(50)]
+        self.assertNotIn(busy, picks)
+
+    def test_exclude(self):
+        """
+        Back ends a request was already sent to are avoided while others are available.
+        """
+        tried = {'http://a', 'http://b', 'http://c'}
+        self.assertEqual(self.pool.acquire(tried).url, 'http://d')
+        self.assertIn(self.pool.acquire(set(self.pool.urls())).url, self.pool.urls())
+
+    def test_ejection(self):
+        """
+        A back end is ejected after ejectAfter failures in a row, but never more than maxEjectedRatio of them.
+        """
+        failing = [self.pool.backends[url] for url in ('http://a', 'http://b', 'http://c')]
+        for backend in failing:
+            for _ in range(backend_client.backendConfig['ejectAfter']):
+                backend.outstanding += 1
+                self.pool.release(backend, True)
+        snapshot = self.pool.snapshot()
+        self.assertEqual([snapshot[url]['ejected'] for url in self.pool.urls()], [True, True, False, False])
+        self.assertEqual({self.pool.acquire().url for _ in range(4)}, {'http://c', 'http://d'})
+
+    def test_health_checks(self):
+        """
+        A back end takes no requests after unhealthyAfter failed checks, and again after a passed one.
+        """
+        for url in ('http://a', 'http://b', 'http://c'):
+            for _ in range(backend_client.backendConfig['unhealthyAfter']):
+                self.pool.record_check(url, False)
+        self.assertEqual({self.pool.acquire().url for _ in range(4)}, {'http://d'})
+        self.pool.record_check('http://a', True)
+        self.assertTrue(self.pool.snapshot()['http://a']['healthy'])
+
+    def test_all_down(self):
+        """
+        With no back end available, requests still go to all of them.
+        """
+        for url in self.pool.urls():
+            for _ in range(backend_client.backendConfig['unhealthyAfter']):
+                self.pool.record_check(url, False)
+        self.assertEqual(len({self.pool.acquire().url for _ in range(4)}), 4)
+        with self.assertRaises(requests.ConnectionError):
+            BackendPool().acquire()
+
+
+if __name__ == '__main__':
+    unittest.main()
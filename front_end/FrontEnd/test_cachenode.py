@@ -0,0 +1,143 @@
+import unittest
+import multiprocessing
+from unittest.mock import patch
+from FrontEnd import config
+from FrontEnd import memcache
+from FrontEnd.cachenode import CacheNodeServer, CacheNodeClient, HashRing, NodePoolCache, OP_EXISTS, OP_TOUCH, OP_STATS
+from FrontEnd.memcache import subPUT, subGET, subInvalidateKey, subCLEAR, subSTATS
+
+
+def serveNode(connection):
+    """
+    Run a cache node on a free local port and report the port through connection.
+    """
+    config.memcacheConfig.update({'capacity': 8, 'policy': 'LRU', 'backend': 'local'})
+    memcache.memcache = memcache.ShardedMemCache(4)
+    server = CacheNodeServer(('127.0.0.1', 0))
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+class TestHashRing(unittest.TestCase):
+    """
+    Test suite for the consistent-hash ring.
+    """
+
+    def test_adding_a_node_moves_about_one_nth_of_the_keys(self):
+        """
+        Adding a fifth node only moves keys to that node, and about a fifth of them.
+        """
+        keys = ['key%d' % i for i in range(20000)]
+        ring = HashRing(['node%d' % i for i in range(4)])
+        before = {image_key: ring.node(image_key) for image_key in keys}
+        ring.add('node4')
+        moved = [image_key for image_key in keys if ring.node(image_key) != before[image_key]]
+        self.assertTrue(all(ring.node(image_key) == 'node4' for image_key in moved))
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 5, delta=0.05)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        """
+        Removing a node only remaps the keys that node owned.
+        """
+        keys = ['key%d' % i for i in range(5000)]
+        ring = HashRing(['node%d' % i for i in range(4)])
+        before = {image_key: ring.node(image_key) for image_key in keys}
+        ring.remove('node2')
+        for image_key in keys:
+            if before[image_key] != 'node2':
+                self.assertEqual(ring.node(image_key), before[image_key])
+
+
+class TestNodePool(unittest.TestCase):
+    """
+    Test the pool backend against three cache node processes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Start three local cache node processes.
+        """
+        context = multiprocessing.get_context('fork')
+        cls.processes = []
+        cls.nodes = []
+        for _ in range(3):
+            parent, child = context.Pipe()
+            process = context.Process(target=serveNode, args=(child,), daemon=True)
+            process.start()
+            cls.processes.append(process)
+            cls.nodes.append('127.0.0.1:%d' % parent.recv())
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Stop the cache node processes.
+        """
+        for process in cls.processes:
+            process.terminate()
+            process.join()
+
+    def setUp(self):
+        """
+        Route the sub* functions through a client pool over the three nodes.
+        """
+        self.saved_cache = memcache.memcache
+        memcache.memcache = NodePoolCache(self.nodes)
+        subCLEAR()
+
+    def tearDown(self):
+        """
+        Restore the in-process memcache.
+        """
+        memcache.memcache = self.saved_cache
+
+    def test_round_trip(self):
+        """
+        Values stored through the pool are spread over the nodes and read back intact.
+        """
+        for i in range(60):
+            self.assertTrue(subPUT('key%d' % i, b'image%d' % i))
+        for i in range(60):
+            self.assertEqual(subGET('key%d' % i), b'image%d' % i)
+        self.assertTrue(subInvalidateKey('key0'))
+        self.assertFalse(subGET('key0'))
+        stats = subSTATS()
+        self.assertEqual(stats['entries'], 59)
+        self.assertEqual(stats['hits'], 60)
+        self.assertTrue(all(report['entries'] > 0 for report in stats['nodes'].values()))
+
+    def test_exists_and_stats_without_values(self):
+        """
+        Membership and touch are answered without sending the image, and the node stats are reused briefly.
+        """
+        subPUT('key1', b'image1')
+        pool = memcache.memcache
+        calls = []
+        request = CacheNodeClient.request
+
+        def recordingRequest(client, op, *args):
+            status, payload = request(client, op, *args)
+            calls.append((op, len(payload)))
+            return status, payload
+
+        with patch.object(CacheNodeClient, 'request', recordingRequest):
+            self.assertIn('key1', pool)
+            self.assertNotIn('key2', pool)
+            self.assertTrue(pool.touch('key1'))
+            self.assertEqual(calls, [(OP_EXISTS, 0), (OP_EXISTS, 0), (OP_TOUCH, 0)])
+            calls.clear()
+            self.assertEqual((len(pool), len(pool)), (1, 1))
+            self.assertEqual([op for op, length in calls], [OP_STATS] * len(self.nodes))
+
+    def test_unreachable_node_is_a_miss(self):
+        """
+        A key owned by a node that is down misses instead of raising.
+        """
+        pool = NodePoolCache(['127.0.0.1:1'], timeout=0.2)
+        memcache.memcache = pool
+        self.assertFalse(subGET('key1'))
+        self.assertFalse(subPUT('key1', b'image1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
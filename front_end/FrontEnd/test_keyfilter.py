@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import patch
+from FrontEnd import keyfilter
+from FrontEnd.keyfilter import mayExist, recordMissing, addKeys, keyFilterStats
+
+
+class TestKeyFilter(unittest.TestCase):
+    """
+    Test the negative cache of unknown image keys.
+    """
+
+    def setUp(self):
+        """
+        Start every test with an empty cache and zeroed counters.
+        """
+        for name, value in (('missing', keyfilter.OrderedDict()), ('checks', 0), ('rejected', 0),
+                            ('lookups_missed', 0)):
+            patcher = patch.object(keyfilter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.dict(keyfilter.keyFilterConfig, enabled=True, ttl=10, maxKeys=3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_recorded_keys_rejected(self):
+        """
+        A key is rejected only after it was found missing, and looked up again once written.
+        """
+        self.assertTrue(mayExist('unknown'))
+        recordMissing('unknown')
+        self.assertFalse(mayExist('unknown'))
+        self.assertTrue(mayExist('other'))
+        addKeys(['unknown'])
+        self.assertTrue(mayExist('unknown'))
+
+    def test_entries_expire(self):
+        """
+        A key is looked up again once its entry is older than the TTL.
+        """
+        with patch.object(keyfilter.time, 'monotonic', return_value=100.0):
+            recordMissing('unknown')
+        with patch.object(keyfilter.time, 'monotonic', return_value=109.0):
+            self.assertFalse(mayExist('unknown'))
+        with patch.object(keyfilter.time, 'monotonic', return_value=110.0):
+            self.assertTrue(mayExist('unknown'))
+        self.assertNotIn('unknown', keyfilter.missing)
+
+    def test_bounded(self):
+        """
+        Past maxKeys the least recently missed keys are forgotten.
+        """
+        for image_key in ('a', 'b', 'c', 'a', 'd'):
+            recordMissing(image_key)
+        self.assertEqual(list(keyfilter.missing), ['c', 'a', 'd'])
+        self.assertTrue(mayExist('b'))
+
+    def test_disabled(self):
+        """
+        With the cache disabled every key is looked up.
+        """
+        keyfilter.keyFilterConfig['enabled'] = False
+        recordMissing('unknown')
+        self.assertTrue(mayExist('unknown'))
+        self.assertEqual(len(keyfilter.missing), 0)
+
+    def test_stats(self):
+        """
+        Rejected lookups and lookups of missing keys that reached the table give the false positive rate.
+        """
+        self.assertTrue(mayExist('unknown'))
+        recordMissing('unknown')
+        self.assertFalse(mayExist('unknown'))
+        self.assertFalse(mayExist('unknown'))
+        report = keyFilterStats()
+        self.assertEqual((report['checks'], report['rejected'], report['lookups_missed']), (3, 2, 1))
+        self.assertAlmostEqual(report['false_positive_rate'], 1 / 3)
+        self.assertEqual((report['keys'], report['enabled']), (1, True))
+        text = keyFilterStats('prometheus')
+        self.assertIn('keyfilter_rejected_total 2', text)
+        self.assertIn('keyfilter_false_positive_rate ', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
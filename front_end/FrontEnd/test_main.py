@@ -1,8 +1,21 @@
+import io
+import time
+import base64
+import hashlib
 import unittest
 import logging
-from unittest.mock import Mock, patch
+import threading
+from unittest.mock import MagicMock, Mock, patch
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask
 from FrontEnd import webapp  # Replace 'your_module' with the actual module name
+from FrontEnd import main
+from FrontEnd import backend_client
+from FrontEnd import purge
+from FrontEnd import keyfilter
+from FrontEnd.purge import PurgeJob
+from botocore.exceptions import ClientError
+from PIL import Image
 
 logging.basicConfig(level=logging.INFO)  # Set logging level to INFO
 
@@ -73,5 +86,845 @@ class TestApp(unittest.TestCase):
             response = self.client.post('/key', data={'key': 'key1'})
             self.assertEqual(response.status_code, 200)  # Check if the response is successful
 
+class TestMemcacheStatsRoute(unittest.TestCase):
+    """
+    Test the '/memcache/stats' route on the real web application.
+    """
+
+    def setUp(self):
+        """
+        Use the FrontEnd app without its AWS start-up hook.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = webapp.test_client()
+
+    def test_stats_json(self):
+        """
+        The stats are returned as JSON by default.
+        """
+        response = self.client.get('/memcache/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hit_ratio', response.get_json())
+
+    def test_stats_prometheus(self):
+        """
+        ?format=prometheus returns the Prometheus text format.
+        """
+        response = self.client.get('/memcache/stats?format=prometheus')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn(b'memcache_hits_total', response.data)
+
+
+
+class FakeTable:
+    """
+    In-memory stand-in for the DynamoDB 'images' table that honours Limit and ExclusiveStartKey.
+    """
+
+    def __init__(self, count):
+        self.items = [{'image_key': 'key%02d' % i, 'image_path': 'path%02d' % i} for i in range(count)]
+        self.scans = []
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, Select=None, ProjectionExpression=None):
+        self.scans.append({'Limit': Limit, 'Select': Select, 'ProjectionExpression': ProjectionExpression})
+        start = 0
+        if ExclusiveStartKey is not None:
+            start = [item['image_key'] for item in self.items].index(ExclusiveStartKey['image_key']) + 1
+        end = len(self.items) if Limit is None else start + Limit
+        page = self.items[start:end]
+        response = {'Count': len(page), 'Items': [] if Select == 'COUNT' else page}
+        if end < len(self.items):
+            response['LastEvaluatedKey'] = {'image_key': page[-1]['image_key']}
+        return response
+
+    def get_item(self, Key):
+        for item in self.items:
+            if item['image_key'] == Key['image_key']:
+                return {'Item': item}
+        return {}
+
+
+class FakeBody:
+    """
+    Stand-in for the StreamingBody of an S3 GetObject response.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def read(self):
+        return self.data
+
+    def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeS3:
+    """
+    Stand-in for the S3 client: every object holds its own key, and Range requests are answered like S3.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests.append((Key, Range))
+        data = self.objects.get(Key, Key.encode())
+        if Key.startswith('missing'):
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        response = {'ETag': '"s3-%s"' % Key, 'ContentLength': len(data)}
+        if Range:
+            first, last = (int(bound) for bound in Range[len('bytes='):].split('-'))
+            response['ContentRange'] = 'bytes %d-%d/%d' % (first, last, len(data))
+            data = data[first:last + 1]
+            response['ContentLength'] = len(data)
+        response['Body'] = FakeBody(data)
+        return response
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[Key] = Body
+
+
+class TestGallery(unittest.TestCase):
+    """
+    Test the paginated '/image_gallery' route.
+    """
+
+    def setUp(self):
+        """
+        Serve the gallery from a 10-item fake table and a fake S3 bucket.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.table = FakeTable(10)
+        self.s3_client = FakeS3()
+        self.objects_table = FakeObjectsTable()
+        for name, value in (('table', self.table), ('s3_client', self.s3_client),
+                            ('objects_table', self.objects_table)):
+            patcher = patch.object(main, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.invalidate_gallery()
+        self.addCleanup(main.invalidate_gallery)
+        self.client = webapp.test_client()
+
+    def test_pages_only_scan_their_items(self):
+        """
+        Each page scans only its own items, a later page is found through its cursor, and no image is downloaded.
+        """
+        self.assertEqual([image['image_key'] for image in main.get_images(1, 4)], ['key00', 'key01', 'key02', 'key03'])
+        self.table.scans.clear()
+        images = main.get_images(2, 4)
+        self.assertEqual([image['image_key'] for image in images], ['key04', 'key05', 'key06', 'key07'])
+        self.assertEqual(self.table.scans, [{'Limit': 4, 'Select': None, 'ProjectionExpression': None}])
+        self.assertEqual(main.get_images(9, 4), [])
+        self.assertEqual(self.s3_client.requests, [])
+
+    def test_unvisited_page_reads_keys_only(self):
+        """
+        Jumping straight to page 3 pages forward over the keys only.
+        """
+        self.assertEqual([image['image_key'] for image in main.get_images(3, 4)], ['key08', 'key09'])
+        self.assertEqual([scan['ProjectionExpression'] for scan in self.table.scans], ['image_key', 'image_key', None])
+
+    def test_page_links_images(self):
+        """
+        The page references its images through the /image route, with thumbnails by default.
+        """
+        response = self.client.get('/image_gallery')
+        self.assertIn(b'src="/image/key00?rendition=thumbnail"', response.data)
+        self.assertNotIn(b'base64', response.data)
+        response = self.client.get('/image_gallery?rendition=original')
+        self.assertIn(b'src="/image/key00?rendition=original"', response.data)
+        self.assertEqual(self.s3_client.requests, [])
+
+    def test_image_path_update(self):
+        """
+        Replacing an image sets the new rendition paths and removes the ones it does not have.
+        """
+        update = main.image_path_update('userImages/a.raw', {'preview_path': 'renditions/preview/a'})
+        self.assertEqual(update['UpdateExpression'], "set image_path = :p, preview_path = :preview remove thumbnail_path")
+        self.assertEqual(update['ExpressionAttributeValues'], {':p': 'userImages/a.raw', ':preview': 'renditions/preview/a'})
+
+    def test_count_is_cached(self):
+        """
+        The route reports the total from a COUNT scan that is reused across requests.
+        """
+        for page in (1, 2, 3):
+            response = self.client.get('/image_gallery?page=%d' % page)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(scan['Select'] == 'COUNT' for scan in self.table.scans), 1)
+        self.assertEqual(main.count_images(), 10)
+
+    def test_count_kept_in_counter(self):
+        """
+        Once counted, the total is read from the counter item that new keys increment, without a scan,
+        until a purge deletes the counter.
+        """
+        self.assertEqual(main.count_images(), 10)
+        main.count_new_images(2)
+        main.invalidate_gallery()
+        self.table.scans.clear()
+        self.assertEqual(main.count_images(), 12)
+        self.assertEqual(self.table.scans, [])
+        main.tables_purged(None)
+        self.assertEqual(main.count_images(), 10)
+        self.assertEqual(sum(scan['Select'] == 'COUNT' for scan in self.table.scans), 1)
+
+
+class TestImageRoute(unittest.TestCase):
+    """
+    Test the '/image/<image_key>' and '/result/<token>' routes.
+    """
+
+    PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 4
+
+    def setUp(self):
+        """
+        Serve images from a fake table and S3 bucket, with an empty memcache.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.table = FakeTable(3)
+        self.s3_client = FakeS3()
+        self.s3_client.objects['path00'] = self.PNG
+        for name, value in (('table', self.table), ('s3_client', self.s3_client)):
+            patcher = patch.object(main, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.subCLEAR()
+        self.addCleanup(main.subCLEAR)
+        self.client = webapp.test_client()
+
+    def test_served_from_s3_then_memcache(self):
+        """
+        The first request reads the image from S3 and caches it; later ones are served from the memcache
+        with the same ETag.
+        """
+        first = self.client.get('/image/key00')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data, self.PNG)
+        self.assertEqual(first.content_type, 'image/png')
+        self.assertEqual(first.headers['Cache-Control'], main.IMAGE_CACHE_CONTROL)
+        second = self.client.get('/image/key00')
+        self.assertEqual(second.data, self.PNG)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(self.s3_client.requests, [('path00', None)])
+
+    def test_stale_read_not_cached(self):
+        """
+        An image read through an item older than the last version written is served but not cached.
+        """
+        self.table.items[0]['version'] = 1
+        main.subInvalidateKey('key00', 2)
+        self.assertEqual(self.client.get('/image/key00').data, self.PNG)
+        self.assertFalse(main.subGET('key00'))
+        self.table.items[0]['version'] = 2
+        self.client.get('/image/key00')
+        self.assertEqual(main.subGET('key00'), self.PNG)
+
+    def test_unknown_key_filtered(self):
+        """
+        A key DynamoDB just reported missing is answered without another lookup by both the '/image' and
+        the '/key' route, until it is written.
+        """
+        with patch.object(keyfilter, 'missing', keyfilter.OrderedDict()), \
+                patch.object(self.table, 'get_item', Mock(wraps=self.table.get_item)), \
+                patch.object(main, 'dynamodb', Mock(), create=True):
+            self.assertEqual(self.client.get('/image/unknown').status_code, 404)
+            self.assertEqual(self.table.get_item.call_count, 1)
+            self.assertEqual(self.client.get('/image/unknown').status_code, 404)
+            self.assertIn('Unknown', self.client.post('/key', data={'key': 'unknown'}).location)
+            self.assertEqual(self.table.get_item.call_count, 1)
+            main.dynamodb.meta.client.get_item.assert_not_called()
+            keyfilter.addKeys(['unknown'])
+            self.assertEqual(self.client.get('/image/unknown').status_code, 404)
+            self.assertEqual(self.table.get_item.call_count, 2)
+            self.assertEqual(self.client.get('/image/key00').status_code, 200)
+
+    def test_cached_key_not_looked_up(self):
+        """
+        The '/key' route answers a cached image without asking DynamoDB.
+        """
+        main.subPUT('key-cached', self.PNG)
+        with patch.object(main, 'dynamodb', Mock(), create=True):
+            response = self.client.post('/key', data={'key': 'key-cached'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'/image/key-cached', response.data)
+            main.dynamodb.meta.client.get_item.assert_not_called()
+
+    def test_conditional_and_range(self):
+        """
+        A matching If-None-Match gets 304 without a body, and a Range request gets 206 with those bytes.
+        """
+        etag = self.client.get('/image/key00').headers['ETag']
+        response = self.client.get('/image/key00', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = self.client.get('/image/key00', headers={'Range': 'bytes=8-15'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.PNG[8:16])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 8-15/%d' % len(self.PNG))
+
+    def test_large_object_is_streamed(self):
+        """
+        An object too big for the memcache is streamed from S3 with its S3 ETag, never cached, and
+        Range requests for it are passed on to S3.
+        """
+        with patch.object(main, 'max_buffered_size', return_value=16):
+            response = self.client.get('/image/key00')
+            self.assertEqual(response.data, self.PNG)
+            self.assertEqual(response.headers['ETag'], '"s3-path00"')
+            self.assertEqual(response.content_length, len(self.PNG))
+            response = self.client.get('/image/key00', headers={'If-None-Match': '"s3-path00"'})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get('/image/key00', headers={'Range': 'bytes=0-7'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, self.PNG[:8])
+        self.assertFalse(main.subGET('key00'))
+        self.assertEqual(self.s3_client.requests[-1], ('path00', 'bytes=0-7'))
+
+    def test_renditions(self):
+        """
+        ?rendition= serves the rendition if the image has one, and the original otherwise.
+        """
+        self.table.items[0]['thumbnail_path'] = 'thumb00'
+        self.assertEqual(self.client.get('/image/key00?rendition=thumbnail').data, b'thumb00')
+        self.assertEqual(self.client.get('/image/key00?rendition=thumbnail').data, b'thumb00')
+        self.assertEqual(self.client.get('/image/key01?rendition=thumbnail').data, b'path01')
+        self.assertEqual(self.client.get('/image/key00').data, self.PNG)
+        self.assertEqual([key for key, byte_range in self.s3_client.requests], ['thumb00', 'path01', 'path00'])
+
+    def test_missing(self):
+        """
+        An unknown key or a missing S3 object is a 404.
+        """
+        self.assertEqual(self.client.get('/image/nokey').status_code, 404)
+        self.table.items[1]['image_path'] = 'missing01'
+        self.assertEqual(self.client.get('/image/key01').status_code, 404)
+
+    def test_edit_result(self):
+        """
+        Edited images are stashed in the memcache and stored in S3, and served by token.
+        """
+        with patch.object(main, 'DEFER_WORK', False):
+            token = main.stash_result(self.PNG)
+        self.assertEqual(self.s3_client.objects[main.result_path(token)], self.PNG)
+        response = self.client.get('/result/' + token)
+        self.assertEqual(response.data, self.PNG)
+        self.assertEqual(response.content_type, 'image/png')
+        self.assertEqual(self.s3_client.requests, [])
+        self.assertEqual(self.client.get('/result/unknown').status_code, 404)
+        self.assertEqual(self.client.get('/result/' + 'missing'.ljust(32, '0')).status_code, 404)
+
+    def test_edit_results_bounded(self):
+        """
+        Stashed results take at most their share of the memcache: the oldest are dropped for new ones and
+        then served from S3, and one larger than the share is only stored in S3.
+        """
+        share = 2.5 * len(self.PNG) / (main.memcacheConfig['capacity'] * 1048576)
+        with patch.object(main, 'EDIT_RESULT_SHARE', share), patch.object(main, 'stashed_results', main.OrderedDict()), \
+                patch.object(main, 'DEFER_WORK', False):
+            tokens = [main.stash_result(self.PNG) for _ in range(3)]
+            self.assertEqual(list(main.stashed_results), tokens[1:])
+            self.assertEqual(self.client.get('/result/' + tokens[2]).data, self.PNG)
+            self.assertEqual(self.s3_client.requests, [])
+            self.assertEqual(self.client.get('/result/' + tokens[0]).data, self.PNG)
+            self.assertEqual(self.s3_client.requests, [(main.result_path(tokens[0]), None)])
+            token = main.stash_result(self.PNG * 3)
+            self.assertNotIn(token, main.stashed_results)
+            self.assertEqual(self.client.get('/result/' + token).data, self.PNG * 3)
+
+    def test_saved_result_outlives_memcache(self):
+        """
+        The save form still saves an edited image once the memcache dropped it.
+        """
+        with patch.object(main, 'DEFER_WORK', False):
+            token = main.stash_result(self.PNG)
+        main.subInvalidateKey(main.result_cache_key(token))
+        with patch.object(main, 'acquire_object', return_value={'path': 'objects/x'}) as acquire_object, \
+                patch.object(main, 'store_image', return_value=True):
+            response = self.client.post('/save_image', data={'key': 'saved', 'token': token})
+        self.assertIn(b'successfully', response.data)
+        self.assertEqual(acquire_object.call_args.args[1], self.PNG)
+
+    def test_save_reports_invalidation_failure(self):
+        """
+        The save form fails like an upload when the memcache copy of the key could not be replaced.
+        """
+        with patch.object(main, 'acquire_object', return_value={'path': 'objects/x'}), \
+                patch.object(main, 'store_image', return_value=False):
+            response = self.client.post('/save_image', data={'key': 'saved', 'image': base64.b64encode(self.PNG)})
+        self.assertIn('Invalidate', response.location)
+
+
+
+class FakeObjectsTable:
+    """
+    In-memory stand-in for the DynamoDB 'objects' table, for the update expressions main.py uses.
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def get_item(self, Key):
+        record = self.records.get(Key['object_path'])
+        return {} if record is None else {'Item': dict(record)}
+
+    def put_item(self, Item, ConditionExpression=None):
+        if ConditionExpression == "attribute_not_exists(object_path)" and Item['object_path'] in self.records:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        self.records[Item['object_path']] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None,
+                    ReturnValues='NONE'):
+        path = Key['object_path']
+        if ConditionExpression == "attribute_exists(object_path)" and path not in self.records:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        record = self.records.setdefault(path, {'object_path': path})
+        if UpdateExpression.startswith("add "):
+            attribute, value = UpdateExpression[len("add "):].split(" ")
+            record[attribute] = record.get(attribute, 0) + ExpressionAttributeValues[value]
+        else:
+            for assignment in UpdateExpression[len("set "):].split(", "):
+                attribute, value = assignment.split(" = ")
+                record[attribute] = ExpressionAttributeValues[value]
+        return {'Attributes': dict(record)}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+        if ConditionExpression is not None and \
+                self.records[Key['object_path']]['refs'] > ExpressionAttributeValues[':zero']:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'DeleteItem')
+        self.records.pop(Key['object_path'], None)
+
+
+class TestContentAddressing(unittest.TestCase):
+    """
+    Test the content-addressed, reference-counted storage of uploaded images.
+    """
+
+    def setUp(self):
+        """
+        Store objects in a fake 'objects' table and a mock S3 client.
+        """
+        self.objects_table = FakeObjectsTable()
+        self.s3_client = Mock()
+        for name, value in (('objects_table', self.objects_table), ('s3_client', self.s3_client)):
+            patcher = patch.object(main, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        output = io.BytesIO()
+        Image.new('RGB', (64, 48), 'red').save(output, 'PNG')
+        self.image = output.getvalue()
+        self.digest = hashlib.sha256(self.image).hexdigest()
+
+    def deleted(self):
+        return sorted(call.kwargs['Key'] for call in self.s3_client.delete_object.call_args_list)
+
+    def test_upload_is_hashed_while_parsed(self):
+        """
+        Uploaded files are hashed as the request body is parsed, without reading them again.
+        """
+        with webapp.test_request_context('/upload', method='POST',
+                                         data={'key': 'a', 'file': (io.BytesIO(self.image), 'a.png')}):
+            image_file = main.request.files['file']
+            self.assertIsInstance(image_file.stream, main.DigestFile)
+            self.assertEqual(main.content_digest(image_file), self.digest)
+            self.assertEqual(image_file.read(), self.image)
+
+    def test_identical_images_share_one_object(self):
+        """
+        The second upload of the same bytes only adds a reference; the object and its renditions are
+        deleted with the last reference.
+        """
+        first = main.acquire_object(self.digest, io.BytesIO(self.image))
+        second = main.acquire_object(self.digest, self.image)
+        self.assertEqual(first, second)
+        self.assertEqual(first['image_path'], 'objects/' + self.digest)
+        self.assertEqual(set(first), {'image_path', 'thumbnail_path', 'preview_path'})
+        self.s3_client.upload_fileobj.assert_called_once()
+        self.assertEqual(self.s3_client.upload_fileobj.call_args.kwargs['ExtraArgs'], {'ContentType': 'image/png'})
+        self.s3_client.put_object.assert_called()
+        self.assertFalse(main.release_object(dict(first, image_key='a')))
+        self.assertEqual(self.deleted(), [])
+        self.assertTrue(main.release_object(dict(second, image_key='b')))
+        self.assertEqual(self.deleted(), sorted(first.values()))
+        self.assertEqual(self.objects_table.records, {})
+
+    def test_unstored_object_stored_again(self):
+        """
+        An upload that finds the object referenced but not yet marked stored stores it as well, and the
+        failure of the first upload then deletes nothing.
+        """
+        path = 'objects/' + self.digest
+        self.objects_table.records[path] = {'object_path': path, 'refs': 1}
+        attributes = main.acquire_object(self.digest, self.image)
+        self.assertEqual(self.s3_client.put_object.call_args.kwargs['Key'], path)
+        self.assertTrue(self.objects_table.records[path]['stored'])
+        self.assertFalse(main.release_object({'image_path': path}))
+        self.assertEqual(self.deleted(), [])
+        self.assertEqual(self.objects_table.records[path]['refs'], 1)
+        self.assertEqual(attributes['image_path'], path)
+
+    def test_release_without_record_keeps_object(self):
+        """
+        A content-addressed object whose record is gone was already released, and is not deleted again.
+        """
+        self.assertFalse(main.release_object({'image_path': 'objects/' + self.digest}))
+        self.assertEqual(self.deleted(), [])
+
+    def test_failed_upload_releases_reference(self):
+        """
+        If the image cannot be stored, the reference taken for it is dropped again.
+        """
+        self.s3_client.put_object.side_effect = ClientError({'Error': {'Code': '500'}}, 'PutObject')
+        with self.assertRaises(ClientError):
+            main.acquire_object(self.digest, self.image)
+        self.assertEqual(self.objects_table.records, {})
+
+    def test_release_legacy_object(self):
+        """
+        Images stored before content addressing have no reference count and are deleted outright.
+        """
+        self.assertTrue(main.release_object({'image_key': 'a', 'image_path': 'userImages/a.jpg',
+                                             'thumbnail_path': 'renditions/thumbnail/userImages/a.jpg.jpg'}))
+        self.assertEqual(self.deleted(), ['renditions/thumbnail/userImages/a.jpg.jpg', 'userImages/a.jpg'])
+
+
+
+class TestStoreImage(unittest.TestCase):
+    """
+    Test the single-upsert write path of '/upload' and '/save_image'.
+    """
+
+    def setUp(self):
+        """
+        Write to mock 'images' and S3 clients and a fake 'objects' table, releasing on a one-thread pool.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.table = Mock()
+        self.table.update_item.return_value = {}
+        self.dynamodb = Mock()
+        self.cleanup_pool = ThreadPoolExecutor(max_workers=1)
+        self.release_object = Mock(return_value=True)
+        for name, value in (('table', self.table), ('objects_table', FakeObjectsTable()), ('s3_client', Mock()),
+                            ('dynamodb', self.dynamodb), ('cleanup_pool', self.cleanup_pool),
+                            ('release_object', self.release_object)):
+            patcher = patch.object(main, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = webapp.test_client()
+
+    def test_upload_is_one_upsert(self):
+        """
+        An upload writes its item with one update_item and no get_item or describe_table.
+        """
+        response = self.client.post('/upload', data={'key': 'k', 'file': (io.BytesIO(b'raw bytes'), 'a.raw')})
+        self.assertIn('/success', response.location)
+        self.table.update_item.assert_called_once()
+        self.assertEqual(self.table.update_item.call_args.kwargs['ReturnValues'], 'ALL_OLD')
+        self.assertEqual(self.dynamodb.mock_calls, [])
+        self.table.get_item.assert_not_called()
+
+    def test_new_key_counted(self):
+        """
+        Writing a new key increments the image counter; replacing the image of a key does not.
+        """
+        main.objects_table.records[main.IMAGE_COUNT_KEY] = {'object_path': main.IMAGE_COUNT_KEY, 'images': 3}
+        main.store_image('k', {'image_path': 'objects/new'})
+        self.table.update_item.return_value = {'Attributes': {'image_key': 'k', 'image_path': 'objects/new'}}
+        main.store_image('k', {'image_path': 'objects/newer'})
+        self.assertEqual(main.objects_table.records[main.IMAGE_COUNT_KEY]['images'], 4)
+
+    def test_miss_during_write_forgotten(self):
+        """
+        A lookup that found the key missing before the write, and records it while the write is in
+        flight, does not keep the key in the negative cache once the write returns.
+        """
+        def update_item(**kwargs):
+            keyfilter.recordMissing('k')
+            return {}
+
+        self.table.update_item.side_effect = update_item
+        with patch.object(keyfilter, 'missing', keyfilter.OrderedDict()):
+            main.store_image('k', {'image_path': 'objects/new'})
+            self.assertTrue(keyfilter.mayExist('k'))
+
+    def test_upload_writes_through(self):
+        """
+        The uploaded image is cached under its key with the version the upsert wrote, and a read that
+        looked up the previous version cannot cache its older image over it.
+        """
+        self.addCleanup(main.subCLEAR)
+        self.table.update_item.return_value = {'Attributes': {'image_key': 'k', 'image_path': 'objects/old',
+                                                              'version': 4}}
+        self.client.post('/upload', data={'key': 'k', 'file': (io.BytesIO(b'raw bytes'), 'a.raw')})
+        self.assertIn("add version :one", self.table.update_item.call_args.kwargs['UpdateExpression'])
+        self.assertEqual(main.subGET('k'), b'raw bytes')
+        # the bytes cached are the bytes stored, not a second read of the upload
+        self.assertEqual(main.s3_client.put_object.call_args.kwargs['Body'], b'raw bytes')
+        main.s3_client.upload_fileobj.assert_not_called()
+        self.assertFalse(main.subPUT('k', b'old image', version=4))
+        self.assertEqual(main.subGET('k'), b'raw bytes')
+
+        with patch.dict(main.memcacheConfig, writeMode='invalidate'):
+            self.client.post('/upload', data={'key': 'k', 'file': (io.BytesIO(b'new bytes'), 'a.raw')})
+        self.assertFalse(main.subGET('k'))
+
+    def test_save_image_writes_through(self):
+        """
+        The saved edit replaces the cached image of the key.
+        """
+        self.addCleanup(main.subCLEAR)
+        main.subPUT('k', b'old image')
+        response = self.client.post('/save_image', data={'key': 'k', 'image': base64.b64encode(b'edited')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(main.subGET('k'), b'edited')
+
+    def test_replaced_image_released_in_background(self):
+        """
+        The item a write replaces is released on the cleanup pool, and the key's cached images are dropped.
+        """
+        old = {'image_key': 'k', 'image_path': 'objects/old'}
+        self.table.update_item.return_value = {'Attributes': old}
+        main.subPUT('k', b'old image')
+        self.assertTrue(main.store_image('k', {'image_path': 'objects/new'}))
+        self.cleanup_pool.shutdown(wait=True)
+        self.release_object.assert_called_once_with(old)
+        self.assertFalse(main.subGET('k'))
+
+    def test_replaced_image_released_before_response_on_lambda(self):
+        """
+        Where the container is frozen after the response, the replaced item is released before it.
+        """
+        old = {'image_key': 'k', 'image_path': 'objects/old'}
+        self.table.update_item.return_value = {'Attributes': old}
+        self.cleanup_pool.shutdown(wait=True)
+        with patch.object(main, 'DEFER_WORK', False):
+            main.store_image('k', {'image_path': 'objects/new'})
+        self.release_object.assert_called_once_with(old)
+
+    def test_failed_write_releases_new_image(self):
+        """
+        If the item cannot be written, the reference to the new image is dropped at once.
+        """
+        self.table.update_item.side_effect = ClientError({'Error': {'Code': '500'}}, 'UpdateItem')
+        with self.assertRaises(ClientError):
+            main.store_image('k', {'image_path': 'objects/new'})
+        self.release_object.assert_called_once_with({'image_path': 'objects/new'})
+
+
+
+class TestBulkUpload(unittest.TestCase):
+    """
+    Test the batched write path of '/upload/bulk'.
+    """
+
+    def setUp(self):
+        """
+        Store in a fake 'objects' table and a mock S3 client, and write to a mock 'images' table whose
+        batch_writer records its puts.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.puts = []
+        self.table = MagicMock()
+        self.table.name = 'images'
+        self.table.batch_writer.return_value.__enter__.return_value.put_item.side_effect = \
+            lambda Item: self.puts.append(Item)
+        self.dynamodb = Mock()
+        self.dynamodb.batch_get_item.return_value = {
+            'Responses': {'images': [{'image_key': 'old', 'image_path': 'objects/old'}]}}
+        self.s3_client = Mock()
+        self.cleanup_pool = ThreadPoolExecutor(max_workers=1)
+        self.release_object = Mock(return_value=True)
+        for name, value in (('table', self.table), ('objects_table', FakeObjectsTable()),
+                            ('s3_client', self.s3_client), ('dynamodb', self.dynamodb),
+                            ('cleanup_pool', self.cleanup_pool), ('release_object', self.release_object)):
+            patcher = patch.object(main, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = webapp.test_client()
+
+    def post(self, items):
+        return self.client.post('/upload/bulk', data={
+            'key': [image_key for image_key, _, _ in items],
+            'file': [(io.BytesIO(data), filename) for _, data, filename in items]})
+
+    def test_items_written_in_one_batch(self):
+        """
+        Valid items are stored and written together; invalid ones are reported without stopping the rest.
+        """
+        main.subPUT('old', b'old image')
+        response = self.post([('new', b'new bytes', 'a.raw'), ('old', b'old bytes', 'b.raw'),
+                              ('bad', b'text', 'c.txt'), ('new', b'again', 'd.raw')])
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual((body['uploaded'], body['failed']), (2, 2))
+        self.assertEqual([result['status'] for result in body['results']], ['uploaded', 'uploaded', 'failed', 'failed'])
+        self.assertEqual(body['results'][0]['image_path'], 'objects/' + hashlib.sha256(b'new bytes').hexdigest())
+        self.assertEqual([result.get('error') for result in body['results'][2:]],
+                         ["Image file type not supported", "Duplicate key"])
+        self.assertEqual(sorted(item['image_key'] for item in self.puts), ['new', 'old'])
+        self.table.update_item.assert_not_called()
+        self.dynamodb.batch_get_item.assert_called_once()
+        self.cleanup_pool.shutdown(wait=True)
+        self.release_object.assert_called_once_with({'image_key': 'old', 'image_path': 'objects/old'})
+        self.assertFalse(main.subGET('old'))
+
+    def test_malformed_request(self):
+        """
+        Keys and files that do not pair up are rejected before anything is stored.
+        """
+        response = self.client.post('/upload/bulk', data={'key': ['a', 'b'], 'file': (io.BytesIO(b'x'), 'a.raw')})
+        self.assertEqual(response.status_code, 400)
+        self.s3_client.upload_fileobj.assert_not_called()
+
+    def test_failed_write_keeps_references(self):
+        """
+        If the batch cannot be written, every stored item fails and no image is released.
+        """
+        self.table.batch_writer.return_value.__exit__.side_effect = \
+            ClientError({'Error': {'Code': '500'}}, 'BatchWriteItem')
+        body = self.post([('a', b'a bytes', 'a.raw'), ('b', b'b bytes', 'b.raw')]).get_json()
+        self.assertEqual([result['error'] for result in body['results']], ["DB Update error"] * 2)
+        self.cleanup_pool.shutdown(wait=True)
+        self.release_object.assert_not_called()
+
+
+
+class TestClearData(unittest.TestCase):
+    """
+    Test that '/clear_data' starts a purge job and returns before it is done.
+    """
+
+    def setUp(self):
+        """
+        Start purges of mock tables and a mock S3 client, without running them.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.job = PurgeJob({})
+        self.start_purge = Mock(return_value=self.job)
+        for name, value in (('table', Mock()), ('objects_table', Mock()), ('s3_client', Mock()),
+                            ('startPurge', self.start_purge)):
+            patcher = patch.object(main, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = webapp.test_client()
+
+    def test_returns_job_id(self):
+        """
+        The redirect names the job, whose progress is reported by '/clear_data/<job_id>'.
+        """
+        with patch.dict(purge.jobs, {self.job.id: self.job}):
+            response = self.client.get('/clear_data')
+            self.assertIn('/success', response.location)
+            self.assertIn(self.job.id, response.location)
+            self.assertEqual(self.start_purge.call_args.args[2], main.bucket_name)
+            status = self.client.get(f'/clear_data/{self.job.id}')
+            self.assertEqual((status.status_code, status.get_json()['state']), (200, 'running'))
+        self.assertEqual(self.client.get('/clear_data/unknown').status_code, 404)
+
+    def test_memcache_cleared_when_done(self):
+        """
+        The memcache is cleared by the job once the data is deleted, not when the purge starts.
+        """
+        main.subPUT('purged', b'image')
+        self.client.get('/clear_data')
+        self.assertTrue(main.subGET('purged'))
+        self.start_purge.call_args.kwargs['on_done'](self.job)
+        self.assertFalse(main.subGET('purged'))
+
+    def test_busy_while_tables_purged(self):
+        """
+        Clearing the data while only the tables are being purged is refused with 409, not reported done.
+        """
+        self.start_purge.side_effect = main.PurgeBusy(self.job)
+        response = self.client.get('/clearImageData')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['error']['job_id'], self.job.id)
+        self.assertIn('/failure', self.client.get('/clear_data').location)
+
+
+
+class TestEditRoutes(unittest.TestCase):
+    """
+    Test that the edit routes send the uploaded bytes to the back end without an S3 round trip.
+    """
+
+    def setUp(self):
+        """
+        Edit through a mock back end, saving the uploads to a mock S3 client on a one-thread pool.
+        """
+        patcher = patch.object(webapp, 'before_first_request_funcs', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.s3_client = Mock()
+        self.persist_pool = ThreadPoolExecutor(max_workers=1)
+        self.post = Mock()
+        self.post.return_value.headers = {'Content-Type': 'image/png', 'X-Edit-Protocol': 'binary'}
+        self.post.return_value.content = b'edited'
+        for target, name, value in ((main, 's3_client', self.s3_client), (main, 'persist_pool', self.persist_pool),
+                                    (backend_client.client, 'pool', backend_client.BackendPool(['http://backend'])),
+                                    (backend_client.client.session, 'post', self.post)):
+            patcher = patch.object(target, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = webapp.test_client()
+
+    def test_uploaded_bytes_sent_directly(self):
+        """
+        The back end gets the uploaded bytes, and the copy in S3 is saved in the background.
+        """
+        response = self.client.post('/image_sharpen', data={'file': (io.BytesIO(b'original'), 'a.png')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.post.call_args.kwargs['data'], b'original')
+        self.persist_pool.shutdown(wait=True)
+        self.s3_client.put_object.assert_any_call(Bucket=main.bucket_name, Key='image/a.png', Body=b'original')
+        self.s3_client.get_object.assert_not_called()
+
+    def test_upload_saved_before_response_on_lambda(self):
+        """
+        Where the container is frozen after the response, the copy in S3 is saved before it is returned.
+        """
+        saved = threading.Event()
+        self.s3_client.put_object.side_effect = lambda **kwargs: time.sleep(0.05) or saved.set()
+        with patch.object(main, 'DEFER_WORK', False):
+            response = self.client.post('/image_sharpen', data={'file': (io.BytesIO(b'original'), 'a.png')})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(saved.is_set())
+
+    def test_backend_failure_redirects(self):
+        """
+        A back end that cannot be reached, or answers with a result that cannot be read, sends the user to
+        the failure page instead of failing the request.
+        """
+        self.post.return_value.headers = {'Content-Type': 'application/json'}
+        self.post.return_value.json.side_effect = ValueError("not JSON")
+        response = self.client.post('/image_rotate', data={'file': (io.BytesIO(b'original'), 'a.png'), 'degree': '90'})
+        self.assertIn('failure', response.location)
+        self.post.side_effect = backend_client.requests.ConnectionError("refused")
+        with patch.dict(backend_client.backendConfig, retries=0):
+            response = self.client.post('/detection', data={'file': (io.BytesIO(b'original'), 'a.png')})
+        self.assertIn('failure', response.location)
+
+
+
 if __name__ == '__main__':
     unittest.main()
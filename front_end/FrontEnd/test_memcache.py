@@ -0,0 +1,555 @@
+import os
+import time
+import random
+import tempfile
+import threading
+import unittest
+import fcntl
+import multiprocessing
+from FrontEnd import config
+from FrontEnd import memcache
+from FrontEnd.memcache import subPUT, subGET, subInvalidateKey, subInvalidateKeys, subCLEAR, subSTATS
+from FrontEnd.shmcache import SharedMemCache
+
+
+class MemCacheTestCase(unittest.TestCase):
+    """
+    Base class that gives each test a fresh memcache with `shards` shards.
+    """
+
+    shards = 1
+
+    def setUp(self):
+        """
+        Start every test with an empty 1 MB LRU cache.
+        """
+        self.saved_config = dict(config.memcacheConfig)
+        self.saved_cache = memcache.memcache
+        config.memcacheConfig.update({'capacity': 1, 'policy': 'LRU', 'maxItemRatio': 1})
+        memcache.memcache = memcache.ShardedMemCache(self.shards)
+
+    def tearDown(self):
+        """
+        Restore the memcache and the configuration changed by the test.
+        """
+        memcache.memcache = self.saved_cache
+        config.memcacheConfig.clear()
+        config.memcacheConfig.update(self.saved_config)
+
+
+class TestMemCache(MemCacheTestCase):
+    """
+    Test suite for the front-end memcache.
+    """
+
+    def test_put_and_get(self):
+        """
+        A stored value is returned by subGET and a missing key is a miss.
+        """
+        self.assertTrue(subPUT('key1', b'image1'))
+        self.assertEqual(subGET('key1'), b'image1')
+        self.assertFalse(subGET('missing'))
+
+    def test_lru_eviction(self):
+        """
+        The least recently used key is evicted first once the capacity is reached.
+        """
+        value = b'x' * 300000
+        subPUT('key1', value)
+        subPUT('key2', value)
+        subPUT('key3', value)
+        subGET('key1')
+        subPUT('key4', value)
+        self.assertFalse(subGET('key2'))
+        self.assertEqual(subGET('key1'), value)
+        self.assertEqual(subGET('key4'), value)
+        self.assertLessEqual(memcache.memcache.total_size, memcache.memcache.capacity)
+
+    def test_oversized_value_rejected(self):
+        """
+        A value larger than the whole cache is not stored.
+        """
+        self.assertFalse(subPUT('big', b'x' * 2 * 1048576))
+        self.assertEqual(len(memcache.memcache), 0)
+
+    def test_invalidate_and_clear(self):
+        """
+        Invalidated and cleared keys are removed and their size is released.
+        """
+        subPUT('key1', b'image1')
+        subPUT('key2', b'image2')
+        self.assertTrue(subInvalidateKey('key1'))
+        self.assertFalse(subGET('key1'))
+        self.assertTrue(subInvalidateKey('key1'))
+        subPUT('key1', b'image1')
+        self.assertTrue(subInvalidateKeys(['key1', 'key2', 'key3']))
+        self.assertEqual(len(memcache.memcache), 0)
+        subPUT('key1', b'image1')
+        self.assertTrue(subCLEAR())
+        self.assertEqual(len(memcache.memcache), 0)
+        self.assertEqual(memcache.memcache.total_size, 0)
+
+    def test_replace_updates_size(self):
+        """
+        Re-putting a key replaces its value without double counting its size.
+        """
+        subPUT('key1', b'a' * 1000)
+        size = memcache.memcache.total_size
+        subPUT('key1', b'b' * 1000)
+        self.assertEqual(memcache.memcache.total_size, size)
+        self.assertEqual(subGET('key1'), b'b' * 1000)
+
+    def test_versioned_writes(self):
+        """
+        A put of an older version than the last one put or invalidated is refused and counted.
+        """
+        subCLEAR()
+        stale = memcache.stale_puts
+        self.assertTrue(subPUT('key1', b'v2', version=2))
+        self.assertFalse(subPUT('key1', b'v1', version=1))
+        self.assertEqual(subGET('key1'), b'v2')
+        # an invalidation by an older writer leaves the newer image cached
+        self.assertTrue(subInvalidateKey('key1', 1))
+        self.assertEqual(subGET('key1'), b'v2')
+        self.assertTrue(subInvalidateKeys(['key1'], {'key1': 3}))
+        self.assertFalse(subPUT('key1', b'v2', version=2))
+        self.assertFalse(subGET('key1'))
+        self.assertTrue(subPUT('key1', b'v3', version=3))
+        self.assertEqual(subSTATS()['stale_puts'] - stale, 2)
+        self.assertIn('memcache_stale_puts_total', subSTATS('prometheus'))
+        # the versions start over with the data
+        subCLEAR()
+        self.assertTrue(subPUT('key1', b'v1', version=1))
+
+    def test_max_item_ratio(self):
+        """
+        Items above maxItemRatio of the capacity are not admitted.
+        """
+        config.memcacheConfig['maxItemRatio'] = 0.1
+        self.assertFalse(subPUT('big', b'x' * 200000))
+        self.assertTrue(subPUT('small', b'x' * 50000))
+
+    def test_max_item_ratio_per_shard(self):
+        """
+        The item limit is maxItemRatio of one shard, the same limit maxItemSize reports.
+        """
+        memcache.memcache = memcache.ShardedMemCache(4)
+        config.memcacheConfig['maxItemRatio'] = 0.5
+        self.assertEqual(memcache.maxItemSize(), 1048576 // 4 * 0.5)
+        self.assertFalse(subPUT('big', bytes(300000)))
+        self.assertTrue(subPUT('small', bytes(100000)))
+
+    def test_policies_keep_bookkeeping_consistent(self):
+        """
+        Under a random workload every policy keeps the cache within capacity and evicts only cached keys.
+        """
+        rng = random.Random(7)
+        for name in memcache.POLICIES:
+            config.memcacheConfig['policy'] = name
+            subCLEAR()
+            for _ in range(3000):
+                image_key = 'key%d' % int(rng.paretovariate(1.2))
+                op = rng.random()
+                if op < 0.6:
+                    if not subGET(image_key):
+                        subPUT(image_key, b'x' * rng.randint(1000, 120000))
+                elif op < 0.95:
+                    subPUT(image_key, b'x' * rng.randint(1000, 120000))
+                else:
+                    subInvalidateKey(image_key)
+                cache = memcache.memcache.shards[0]
+                self.assertLessEqual(cache.total_size, cache.capacity, name)
+                self.assertEqual(cache.total_size, sum(size for value, size in cache.entries.values()), name)
+            # evict() raises KeyError if a policy hands back a key that is not cached
+            while len(memcache.memcache):
+                memcache.memcache.shards[0].evict()
+            self.assertEqual(memcache.memcache.total_size, 0, name)
+
+    def test_lfu_keeps_frequent_key(self):
+        """
+        LFU evicts a rarely used key before a frequently used older one.
+        """
+        config.memcacheConfig['policy'] = 'LFU'
+        value = b'x' * 300000
+        subPUT('hot', value)
+        for _ in range(5):
+            subGET('hot')
+        subPUT('cold1', value)
+        subPUT('cold2', value)
+        subPUT('cold3', value)
+        self.assertEqual(subGET('hot'), value)
+        self.assertFalse(subGET('cold1'))
+
+    def test_arc_resists_scan(self):
+        """
+        A one-off scan does not flush keys that ARC has seen twice.
+        """
+        config.memcacheConfig['policy'] = 'ARC'
+        value = b'x' * 100000
+        for i in range(4):
+            subPUT('hot%d' % i, value)
+            subGET('hot%d' % i)
+        for i in range(50):
+            subPUT('scan%d' % i, value)
+        for i in range(4):
+            self.assertEqual(subGET('hot%d' % i), value)
+
+    def test_tinylfu_rejects_large_cold_item(self):
+        """
+        W-TinyLFU does not let one large, never requested image evict many popular small ones.
+        """
+        config.memcacheConfig['policy'] = 'W-TinyLFU'
+        small = b'x' * 20000
+        for i in range(45):
+            subPUT('thumb%d' % i, small)
+        for _ in range(3):
+            for i in range(45):
+                subGET('thumb%d' % i)
+        self.assertFalse(subPUT('raw', b'x' * 700000))
+        self.assertEqual(sum(1 for i in range(45) if subGET('thumb%d' % i)), 45)
+
+    def test_policy_switch_keeps_entries(self):
+        """
+        Changing memcacheConfig['policy'] rebuilds the policy without losing cached keys.
+        """
+        subPUT('key1', b'image1')
+        subPUT('key2', b'image2')
+        config.memcacheConfig['policy'] = 'ARC'
+        subPUT('key3', b'image3')
+        self.assertIsInstance(memcache.memcache.shards[0].policy, memcache.ARCPolicy)
+        for image_key in ('key1', 'key2', 'key3'):
+            self.assertTrue(subGET(image_key))
+
+
+    def test_exact_byte_accounting(self):
+        """
+        Entries are charged their payload bytes plus a fixed per-entry overhead.
+        """
+        payload = bytes(100000)
+        subPUT('key1', payload)
+        self.assertEqual(memcache.memcache.total_size, memcache.entrySize('key1', payload))
+        self.assertLess(memcache.memcache.total_size - len(payload), 1024)
+        view = memoryview(payload)[:50000]
+        subPUT('key2', view)
+        self.assertEqual(subGET('key2'), view)
+        self.assertGreaterEqual(memcache.memcache.total_size, len(payload) + 50000)
+
+    def test_rejects_non_bytes(self):
+        """
+        Only raw bytes are cached; a bytearray is copied so later changes do not leak in.
+        """
+        self.assertFalse(subPUT('key1', 'not bytes'))
+        data = bytearray(b'image')
+        self.assertTrue(subPUT('key2', data))
+        data[0:1] = b'X'
+        self.assertEqual(subGET('key2'), b'image')
+
+
+
+    def test_stats(self):
+        """
+        Hits, misses, evictions, admitted/evicted bytes and latencies are counted.
+        """
+        value = b'x' * 300000
+        for i in range(4):
+            subPUT('key%d' % i, value)
+        subGET('key3')
+        subGET('key0')
+        stats = subSTATS()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], {'LRU': 1})
+        self.assertEqual(stats['bytes_admitted'], 4 * memcache.entrySize('key0', value))
+        self.assertEqual(stats['bytes_evicted'], memcache.entrySize('key0', value))
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['latency_seconds']['get']['count'], 2)
+        self.assertEqual(stats['latency_seconds']['put']['count'], 4)
+        self.assertEqual(stats['per_minute'][-1]['hits'], 1)
+
+    def test_stats_prometheus(self):
+        """
+        The Prometheus rendering exposes counters, gauges and histogram buckets.
+        """
+        subPUT('key1', b'image1')
+        subGET('key1')
+        text = subSTATS('prometheus')
+        self.assertIn('memcache_hits_total 1', text)
+        self.assertIn('memcache_entries 1', text)
+        self.assertIn('memcache_get_latency_seconds_bucket{le="+Inf"} 1', text)
+
+    def test_trace_recording(self):
+        """
+        With tracePath set, every GET and PUT is appended to the trace file.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config.memcacheConfig['tracePath'] = os.path.join(directory.name, 'trace.csv')
+        self.addCleanup(memcache.closeTrace)
+        subGET('key1')
+        subPUT('key1', b'image1')
+        subGET('key1')
+        memcache.closeTrace()
+        with open(config.memcacheConfig['tracePath']) as file:
+            rows = [line.strip().split(',')[1:] for line in file]
+        self.assertEqual(rows, [['GET', 'key1', '0'], ['PUT', 'key1', '6'], ['GET', 'key1', '6']])
+
+    def test_ttl_expiry(self):
+        """
+        Entries expire after their own or the default TTL, and a TTL of 0 never expires.
+        """
+        config.memcacheConfig['ttl'] = 0.05
+        subPUT('default', b'image1')
+        subPUT('short', b'image2', ttl=0.05)
+        subPUT('forever', b'image3', ttl=0)
+        subPUT('long', b'image4', ttl=60)
+        time.sleep(0.1)
+        self.assertFalse(subGET('default'))
+        self.assertFalse(subGET('short'))
+        self.assertEqual(subGET('forever'), b'image3')
+        self.assertEqual(subGET('long'), b'image4')
+        stats = subSTATS()
+        self.assertEqual(stats['expired'], 2)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_sweep_expires_and_makes_headroom(self):
+        """
+        sweep removes expired entries without lookups, then evicts down to the watermark in batches.
+        """
+        shard = memcache.memcache.shards[0]
+        for i in range(10):
+            subPUT('short%d' % i, b'image', ttl=0.01)
+        subPUT('replaced', b'image', ttl=0.01)
+        subPUT('replaced', b'image', ttl=60)
+        time.sleep(0.05)
+        self.assertEqual(memcache.memcache.sweep(4), 4)
+        self.assertEqual(memcache.memcache.sweep(100), 6)
+        self.assertEqual(memcache.memcache.sweep(100), 0)
+        self.assertEqual(list(shard.entries), ['replaced'])
+        self.assertEqual(subSTATS()['expired'], 10)
+
+        value = b'x' * 100000
+        for i in range(10):
+            subPUT('key%d' % i, value)
+        while memcache.memcache.sweep(2, 0.5):
+            pass
+        self.assertLessEqual(shard.total_size, shard.capacity * 0.5)
+        self.assertTrue(subGET('key9'))
+        self.assertFalse(subGET('key0'))
+
+    def test_background_sweeper(self):
+        """
+        The sweeper thread removes expired entries without any request touching them.
+        """
+        config.memcacheConfig['sweepInterval'] = 0.01
+        subPUT('key1', b'image1', ttl=0.01)
+        stop = memcache.startSweeper()
+        self.addCleanup(stop.set)
+        deadline = time.monotonic() + 5
+        while len(memcache.memcache) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(memcache.memcache), 0)
+        self.assertEqual(subSTATS()['expired'], 1)
+
+
+class TestShardedMemCacheThreads(MemCacheTestCase):
+    """
+    Multi-threaded stress test of the lock-striped memcache.
+    """
+
+    shards = 8
+
+    def run_threads(self, thread_count, operations):
+        """
+        Run a mixed GET/PUT/invalidate workload from thread_count threads at once.
+        """
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(operations):
+                    image_key = 'key%d' % rng.randint(0, 400)
+                    op = rng.random()
+                    if op < 0.6:
+                        value = subGET(image_key)
+                        if value:
+                            self.assertEqual(value[:len(image_key)], image_key.encode())
+                    elif op < 0.95:
+                        subPUT(image_key, image_key.encode() + bytes(rng.randint(100, 40000)))
+                    else:
+                        subInvalidateKey(image_key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_size_invariants_under_concurrency(self):
+        """
+        Concurrent updates never push a shard over capacity or let its size counter drift.
+        """
+        for name in memcache.POLICIES:
+            config.memcacheConfig['policy'] = name
+            subCLEAR()
+            self.run_threads(8, 2000)
+            for shard in memcache.memcache.shards:
+                self.assertLessEqual(shard.total_size, shard.capacity, name)
+                self.assertEqual(shard.total_size, sum(size for value, size in shard.entries.values()), name)
+                for image_key in shard.entries:
+                    self.assertIs(memcache.memcache.shard(image_key), shard)
+            self.assertLessEqual(memcache.memcache.total_size, memcache.memcache.capacity)
+
+
+
+def sharedPut(path, image_key, value):
+    """
+    Store a value in the shared memcache from another process.
+    """
+    cache = SharedMemCache(path, 65536, 64)
+    cache.put(image_key, value, len(value))
+    cache.close()
+
+
+def forkedLockTry(cache, results):
+    """
+    Report from a forked child whether it can take the lock of a cache its parent holds.
+    """
+    try:
+        fcntl.flock(cache.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        results.put('blocked')
+    else:
+        results.put('acquired')
+
+
+class TestSharedMemCache(MemCacheTestCase):
+    """
+    Test suite for the shared-memory memcache backend.
+    """
+
+    def setUp(self):
+        """
+        Use a 64 KB shared cache with 64 index slots in a temporary file.
+        """
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'memcache')
+        self.cache = SharedMemCache(self.path, 65536, 64)
+        self.addCleanup(self.cache.close)
+        memcache.memcache = self.cache
+
+    def test_put_get_invalidate(self):
+        """
+        The sub* API works unchanged on the shared backend.
+        """
+        self.assertTrue(subPUT('key1', b'image1'))
+        self.assertTrue(subPUT('key1', b'image1 replaced'))
+        self.assertEqual(subGET('key1'), b'image1 replaced')
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(subInvalidateKey('key1'))
+        self.assertFalse(subGET('key1'))
+        self.assertEqual(self.cache.total_size, 0)
+        self.assertFalse(subPUT('big', bytes(70000)))
+
+    def test_random_workload_never_returns_wrong_value(self):
+        """
+        Under wrap-around, eviction and index compaction a hit always returns the latest value.
+        """
+        rng = random.Random(3)
+        latest = {}
+        for step in range(5000):
+            image_key = 'key%d' % rng.randint(0, 80)
+            op = rng.random()
+            if op < 0.5:
+                value = subGET(image_key)
+                if value:
+                    self.assertEqual(value, latest[image_key])
+            elif op < 0.9:
+                latest[image_key] = ('%s-%d-' % (image_key, step)).encode() + bytes(rng.randint(0, 6000))
+                self.assertTrue(subPUT(image_key, latest[image_key]))
+            else:
+                subInvalidateKey(image_key)
+            self.assertLessEqual(self.cache.total_size, self.cache.capacity)
+        self.assertGreater(subSTATS()['hits'], 0)
+
+    def test_fifo_eviction(self):
+        """
+        When the arena is full the oldest entries are evicted first.
+        """
+        for i in range(8):
+            subPUT('key%d' % i, bytes(10000))
+        self.assertFalse(subGET('key0'))
+        self.assertTrue(subGET('key7'))
+        self.assertGreater(subSTATS()['host_evictions'], 0)
+
+    def test_ttl_and_sweep(self):
+        """
+        Expired entries miss, are removed by sweep, and sweep evicts the oldest records down to the watermark.
+        """
+        subPUT('short', b'image1', ttl=0.01)
+        subPUT('forever', b'image2', ttl=0)
+        time.sleep(0.05)
+        self.assertFalse(subGET('short'))
+        while self.cache.sweep(1):
+            pass
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(subSTATS()['expired'], 1)
+
+        for i in range(6):
+            subPUT('key%d' % i, bytes(10000))
+        while self.cache.sweep(2, 0.5):
+            pass
+        self.assertLessEqual(self.cache.total_size, self.cache.capacity * 0.5)
+        self.assertTrue(subGET('key5'))
+        self.assertFalse(subGET('forever'))
+
+    def test_sweep_shared_between_processes(self):
+        """
+        Processes continue each other's scan of the index, and none starts another right after a full one.
+        """
+        other = SharedMemCache(self.path, 65536, 64)
+        self.addCleanup(other.close)
+        subPUT('short', b'image1', ttl=0.01)
+        time.sleep(0.05)
+        config.memcacheConfig['sweepInterval'] = 60
+        self.cache.sweep(1)
+        self.assertEqual(other._header()[10], 16)
+        while other.sweep(1):
+            pass
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(other.sweep(1), 0)
+        self.assertEqual(self.cache.sweep(1), 0)
+        self.assertEqual(self.cache._header()[10], 0)
+
+    def test_shared_between_processes(self):
+        """
+        An entry stored by one process is visible to another process using the same file.
+        """
+        process = multiprocessing.get_context('fork').Process(target=sharedPut,
+                                                              args=(self.path, 'remote', b'from child'))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(subGET('remote'), b'from child')
+
+    def test_forked_child_is_excluded(self):
+        """
+        A child forked after the cache was opened cannot take the lock its parent holds.
+        """
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        with self.cache._locked(fcntl.LOCK_EX):
+            process = context.Process(target=forkedLockTry, args=(self.cache, results))
+            process.start()
+            process.join()
+        self.assertEqual(results.get(timeout=5), 'blocked')
+
+
+if __name__ == '__main__':
+    unittest.main()
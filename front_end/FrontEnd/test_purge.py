@@ -0,0 +1,212 @@
+import time
+import threading
+import unittest
+from unittest.mock import patch
+from FrontEnd import purge
+from FrontEnd.purge import PurgeJob, PurgeBusy, runPurge, startPurge, purgeStatus
+
+
+class FakeBatch:
+    """
+    batch_writer of a FakeSegmentedTable, deleting at once.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def delete_item(self, Key):
+        with self.table.lock:
+            self.table.items.pop(Key[self.table.key_name])
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeSegmentedTable:
+    """
+    In-memory DynamoDB table answering parallel scans with pages of at most page_size items.
+    """
+
+    def __init__(self, name, key_name, count, page_size=7):
+        self.name = name
+        self.key_name = key_name
+        self.items = {f"{name}{i:04d}": {key_name: f"{name}{i:04d}", 'other': i} for i in range(count)}
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.scans = []
+
+    def scan(self, Segment, TotalSegments, ProjectionExpression, ExclusiveStartKey=None):
+        self.scans.append((Segment, TotalSegments, ProjectionExpression))
+        with self.lock:
+            keys = sorted(key for key in self.items if hash(key) % TotalSegments == Segment)
+        if ExclusiveStartKey is not None:
+            keys = [key for key in keys if key > ExclusiveStartKey[self.key_name]]
+        page = keys[:self.page_size]
+        response = {'Items': [{self.key_name: key} for key in page]}
+        if len(keys) > self.page_size:
+            response['LastEvaluatedKey'] = {self.key_name: page[-1]}
+        return response
+
+    def batch_writer(self):
+        return FakeBatch(self)
+
+
+class FakePaginator:
+    """
+    list_objects_v2 paginator of a FakeS3.
+    """
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, PaginationConfig):
+        keys = sorted(self.s3.objects)
+        size = PaginationConfig['PageSize']
+        for start in range(0, len(keys), size):
+            yield {'Contents': [{'Key': key} for key in keys[start:start + size]]}
+
+
+class FakeS3:
+    """
+    S3 client holding a set of keys, answering list_objects_v2 pages and delete_objects.
+    """
+
+    def __init__(self, count, undeletable=()):
+        self.objects = {f"objects/{i:05d}" for i in range(count)}
+        self.undeletable = set(undeletable)
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        return FakePaginator(self)
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [each['Key'] for each in Delete['Objects']]
+        errors = [{'Key': key, 'Code': 'AccessDenied'} for key in keys if key in self.undeletable]
+        with self.lock:
+            self.batches.append(len(keys))
+            self.objects.difference_update(set(keys) - self.undeletable)
+        return {'Errors': errors} if errors else {}
+
+
+class TestPurge(unittest.TestCase):
+    """
+    Test the background purge of the tables and the bucket.
+    """
+
+    def setUp(self):
+        patcher = patch.dict(purge.purgeConfig, segments=4, workers=4, keepJobs=2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(purge, 'jobs', purge.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_everything_deleted(self):
+        """
+        Every page of every segment is deleted, not only the first, and the bucket 1000 keys per call.
+        """
+        images = FakeSegmentedTable('images', 'image_key', 100)
+        objects = FakeSegmentedTable('objects', 'object_path', 30)
+        s3 = FakeS3(2500)
+        done = []
+        job = runPurge(PurgeJob({images: 'image_key', objects: 'object_path'}, s3, 'bucket', done.append))
+        self.assertEqual((images.items, objects.items, s3.objects), ({}, {}, set()))
+        self.assertEqual(sorted(s3.batches), [500, 1000, 1000])
+        self.assertEqual({scan[:2] for scan in images.scans}, {(segment, 4) for segment in range(4)})
+        self.assertEqual(done, [job])
+        status = job.snapshot()
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual(status['tables']['images'], {'deleted': 100, 'segments_done': 4, 'segments': 4})
+        self.assertEqual(status['objects_deleted'], 2500)
+
+    def test_errors_reported(self):
+        """
+        Keys S3 refuses to delete and failing segments are reported, and the rest is still deleted.
+        """
+        images = FakeSegmentedTable('images', 'image_key', 20)
+        broken = FakeSegmentedTable('objects', 'object_path', 20)
+        broken.scan = lambda **kwargs: {}
+        s3 = FakeS3(10, undeletable=['objects/00003'])
+        status = runPurge(PurgeJob({images: 'image_key', broken: 'object_path'}, s3, 'bucket')).snapshot()
+        self.assertEqual(status['state'], 'failed')
+        self.assertIn('objects/00003: AccessDenied', status['errors'])
+        self.assertEqual(len(status['errors']), 1 + 4)
+        self.assertEqual((images.items, s3.objects), ({}, {'objects/00003'}))
+
+    def test_one_job_at_a_time(self):
+        """
+        A purge started while one runs returns the running one if it covers the same tables and bucket, and
+        is refused otherwise; finished jobs are reported until forgotten.
+        """
+        release = threading.Event()
+        table = FakeSegmentedTable('images', 'image_key', 5)
+        scan = table.scan
+        table.scan = lambda **kwargs: release.wait() and scan(**kwargs)
+        first = startPurge({table: 'image_key'})
+        self.assertIs(startPurge({table: 'image_key'}), first)
+        with self.assertRaises(PurgeBusy) as busy:
+            startPurge({table: 'image_key'}, FakeS3(1), 'bucket')
+        self.assertIs(busy.exception.job, first)
+        with self.assertRaises(PurgeBusy):
+            startPurge({table: 'image_key', FakeSegmentedTable('objects', 'object_path', 0): 'object_path'})
+        self.assertEqual(purgeStatus(first.id)['state'], 'running')
+        release.set()
+        deadline = time.time() + 5
+        while purgeStatus(first.id)['state'] == 'running' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(purgeStatus(first.id)['state'], 'done')
+        for _ in range(2):
+            job = startPurge({FakeSegmentedTable('images', 'image_key', 0): 'image_key'})
+            self.assertIsNot(job, first)
+            while job.state == 'running':
+                time.sleep(0.01)
+        self.assertIsNone(purgeStatus(first.id))
+        self.assertIsNone(purgeStatus('unknown'))
+
+    def test_deletes_beside_scans(self):
+        """
+        The bucket is emptied on a pool of its own while every scan worker is busy.
+        """
+        purge.purgeConfig['workers'] = 1
+        release = threading.Event()
+        table = FakeSegmentedTable('images', 'image_key', 5)
+        scan = table.scan
+        table.scan = lambda **kwargs: release.wait() and scan(**kwargs)
+        s3 = FakeS3(2500)
+        job = startPurge({table: 'image_key'}, s3, 'bucket')
+        deadline = time.time() + 5
+        while s3.objects and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((s3.objects, job.state), (set(), 'running'))
+        release.set()
+        while job.state == 'running' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((job.state, table.items), ('done', {}))
+
+    def test_run_in_calling_thread(self):
+        """
+        A purge that is not run in the background is finished when startPurge returns.
+        """
+        table = FakeSegmentedTable('images', 'image_key', 5)
+        job = startPurge({table: 'image_key'}, FakeS3(10), 'bucket', background=False)
+        self.assertEqual((job.state, table.items, job.objects_deleted), ('done', {}, 10))
+        self.assertEqual(purgeStatus(job.id)['state'], 'done')
+
+    def test_wider_job_covers_narrower(self):
+        """
+        A purge of the tables requested while the tables and the bucket are being purged is that job.
+        """
+        table = FakeSegmentedTable('images', 'image_key', 0)
+        job = PurgeJob({table: 'image_key'}, FakeS3(0), 'bucket')
+        self.assertTrue(job.covers({table: 'image_key'}))
+        self.assertTrue(job.covers({table: 'image_key'}, FakeS3(0), 'bucket'))
+        self.assertFalse(job.covers({table: 'image_key'}, FakeS3(0), 'other'))
+        self.assertFalse(PurgeJob({table: 'image_key'}).covers({table: 'image_key'}, FakeS3(0), 'bucket'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import io
+import unittest
+from PIL import Image
+from FrontEnd.renditions import RENDITIONS, makeRenditions, renditionPath
+
+
+def encodeImage(size, image_format='PNG', mode='RGBA'):
+    """
+    Encode a blank image of the given size.
+    """
+    output = io.BytesIO()
+    Image.new(mode, size, (200, 10, 10)).save(output, image_format)
+    return output.getvalue()
+
+
+class TestRenditions(unittest.TestCase):
+    """
+    Test suite for the gallery renditions.
+    """
+
+    def test_renditions_fit_their_bounds(self):
+        """
+        Each rendition is a JPEG within its bounding box that keeps the aspect ratio.
+        """
+        renditions = makeRenditions(encodeImage((4000, 2000)))
+        self.assertEqual(set(renditions), set(RENDITIONS))
+        for name, data in renditions.items():
+            with Image.open(io.BytesIO(data)) as image:
+                self.assertEqual(image.format, 'JPEG')
+                bound = RENDITIONS[name][0][0]
+                self.assertEqual(image.size, (bound, bound // 2))
+
+    def test_small_images_are_not_upscaled(self):
+        """
+        An image smaller than the thumbnail is re-encoded at its own size, from a file object too.
+        """
+        renditions = makeRenditions(io.BytesIO(encodeImage((100, 50), 'JPEG', 'RGB')))
+        with Image.open(io.BytesIO(renditions['thumbnail'])) as image:
+            self.assertEqual(image.size, (100, 50))
+
+    def test_unreadable_image(self):
+        """
+        Formats Pillow cannot read get no renditions.
+        """
+        self.assertEqual(makeRenditions(b'not an image'), {})
+        self.assertEqual(renditionPath('userImages/a.png', 'thumbnail'), 'renditions/thumbnail/userImages/a.png.jpg')
+
+
+if __name__ == '__main__':
+    unittest.main()
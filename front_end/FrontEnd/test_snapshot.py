@@ -0,0 +1,218 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from FrontEnd import config
+from FrontEnd import memcache
+from FrontEnd.memcache import subPUT, subGET, subInvalidateKey, subCLEAR
+from FrontEnd.snapshot import SnapshotLog, WarmSnapshot, warmStart, writeSnapshot, lockedSnapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    """
+    Test suite for memcache snapshots and warm start.
+    """
+
+    def setUp(self):
+        """
+        Start every test with an empty 1 MB LRU cache and a snapshot path in a temporary directory.
+        """
+        self.saved_config = dict(config.memcacheConfig)
+        self.saved_cache = memcache.memcache
+        config.memcacheConfig.update({'capacity': 1, 'policy': 'LRU', 'maxItemRatio': 1, 'sweepWatermark': 1})
+        memcache.memcache = memcache.ShardedMemCache(1)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'memcache.snapshot')
+
+    def tearDown(self):
+        """
+        Restore the memcache and the configuration changed by the test.
+        """
+        memcache.memcache = self.saved_cache
+        memcache.warmSnapshot = None
+        memcache.snapshotLog = None
+        config.memcacheConfig.clear()
+        config.memcacheConfig.update(self.saved_config)
+
+    def restart(self):
+        """
+        Replace the memcache with an empty one, as a new front-end process would start.
+        """
+        memcache.memcache = memcache.ShardedMemCache(1)
+
+    def test_round_trip_keeps_hotness(self):
+        """
+        A loaded snapshot restores the entries, their hit counts and their recency order.
+        """
+        for i in range(5):
+            subPUT('key%d' % i, b'image%d' % i)
+        for _ in range(3):
+            subGET('key0')
+        subPUT('expired', b'old', ttl=0.01)
+        time.sleep(0.05)
+        self.assertEqual(writeSnapshot(self.path), 5)
+
+        self.restart()
+        self.assertEqual(WarmSnapshot(self.path).load(), 5)
+        shard = memcache.memcache.shards[0]
+        self.assertEqual(shard.accesses['key0'][0], 3)
+        # the hottest entry was loaded last, so it is the most recently used
+        self.assertEqual(next(reversed(shard.policy.order)), 'key0')
+        self.assertEqual(subGET('key3'), b'image3')
+        self.assertFalse(subGET('expired'))
+
+    def test_load_only_takes_what_fits(self):
+        """
+        When the snapshot is bigger than the cache, only the hottest entries are loaded.
+        """
+        config.memcacheConfig['capacity'] = 4
+        for i in range(10):
+            subPUT('key%d' % i, bytes(300000))
+        subGET('key2')
+        writeSnapshot(self.path)
+
+        config.memcacheConfig['capacity'] = 1
+        self.restart()
+        self.assertEqual(WarmSnapshot(self.path).load(), 3)
+        self.assertTrue(subGET('key2'))
+        self.assertEqual(memcache.memcache.stats()[0]['evictions'], {})
+
+    def test_misses_are_served_while_loading(self):
+        """
+        Before the load finishes a miss is served from the snapshot, except for keys written or invalidated since.
+        """
+        for i in range(3):
+            subPUT('key%d' % i, b'old%d' % i)
+        writeSnapshot(self.path)
+
+        self.restart()
+        snapshot = WarmSnapshot(self.path)
+        memcache.warmSnapshot = snapshot
+        subPUT('key0', b'new0')
+        subInvalidateKey('key1')
+        self.assertTrue(snapshot.open())
+        self.assertEqual(subGET('key0'), b'new0')
+        self.assertFalse(subGET('key1'))
+        self.assertEqual(subGET('key2'), b'old2')
+        self.assertEqual(snapshot.served, 1)
+        self.assertEqual(snapshot.load(), 0)
+        self.assertIsNone(memcache.warmSnapshot)
+
+    def test_clear_discards_the_snapshot(self):
+        """
+        subCLEAR while loading drops the snapshot as well.
+        """
+        subPUT('key1', b'image1')
+        writeSnapshot(self.path)
+        self.restart()
+        memcache.warmSnapshot = WarmSnapshot(self.path)
+        subCLEAR()
+        self.assertEqual(memcache.warmSnapshot.load(), 0)
+        self.assertFalse(subGET('key1'))
+
+    def test_warm_start_in_background(self):
+        """
+        warmStart loads the snapshot in a thread and ignores a missing file.
+        """
+        self.assertIsNone(warmStart(self.path))
+        subPUT('key1', b'image1')
+        writeSnapshot(self.path)
+        self.restart()
+        thread = warmStart(self.path)
+        thread.join()
+        self.assertEqual(subGET('key1'), b'image1')
+
+    def test_appends_only_changed_images(self):
+        """
+        A snapshot after the first appends only the images put since, and the last one listed is loaded.
+        """
+        log = SnapshotLog(self.path)
+        memcache.snapshotLog = log
+        config.memcacheConfig['snapshotCompactRatio'] = 10
+        for i in range(3):
+            subPUT('key%d' % i, b'old%d' % i)
+        self.assertEqual(log.write(), (3, 3))
+        subPUT('key1', b'new1')
+        subInvalidateKey('key2')
+        self.assertEqual(log.write(), (2, 1))
+        self.assertEqual(log.write(), (2, 0))
+
+        self.restart()
+        self.assertEqual(WarmSnapshot(self.path).load(), 2)
+        self.assertEqual(subGET('key1'), b'new1')
+        self.assertFalse(subGET('key2'))
+
+    def test_compaction(self):
+        """
+        The file is rewritten with only the current snapshot once it outgrows it, after subCLEAR, and
+        when another process has replaced it.
+        """
+        log = SnapshotLog(self.path)
+        memcache.snapshotLog = log
+        config.memcacheConfig['snapshotCompactRatio'] = 2
+        subPUT('key', bytes(1000))
+        log.write()
+        size = os.path.getsize(self.path)
+        for i in range(2):
+            subPUT('key', bytes([i + 1]) * 1000)
+            self.assertEqual(log.write(), (1, 1))
+        self.assertGreater(os.path.getsize(self.path), 2 * size)
+        self.assertEqual(log.write(), (1, 1))
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        subCLEAR()
+        subPUT('key', bytes(1000))
+        log.write()
+        self.assertEqual(os.path.getsize(self.path), size)
+        writeSnapshot(self.path)
+        self.assertEqual(log.write(), (1, 1))
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_processes_take_turns(self):
+        """
+        A snapshot waits while another process holds the lock of the file, and is written once it is released.
+        """
+        log = SnapshotLog(self.path)
+        other = SnapshotLog(self.path)
+        config.memcacheConfig['snapshotCompactRatio'] = 10
+        subPUT('key', b'first')
+        log.write()
+        size = os.path.getsize(self.path)
+        subPUT('key', b'second')
+        with lockedSnapshot(self.path):
+            writer = threading.Thread(target=other.write)
+            writer.start()
+            writer.join(0.2)
+            self.assertTrue(writer.is_alive())
+            self.assertEqual(os.path.getsize(self.path), size)
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.restart()
+        self.assertEqual(WarmSnapshot(self.path).load(), 1)
+        self.assertEqual(subGET('key'), b'second')
+
+    def test_truncated_and_invalid_files(self):
+        """
+        A snapshot cut short leaves the previous one, and a file without the snapshot header is ignored.
+        """
+        log = SnapshotLog(self.path)
+        subPUT('key1', b'image1')
+        subPUT('key2', b'image2')
+        log.write()
+        subPUT('key3', b'image3')
+        log.write()
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 3)
+        self.restart()
+        self.assertEqual(WarmSnapshot(self.path).load(), 2)
+        self.assertFalse(subGET('key3'))
+
+        with open(self.path, 'wb') as file:
+            file.write(b'not a snapshot file')
+        self.assertEqual(WarmSnapshot(self.path).load(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
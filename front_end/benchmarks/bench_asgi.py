@@ -0,0 +1,173 @@
+"""Load test of the threaded and the ASGI serving modes of the front end.
+
+Serves the front end both ways in this process: the Flask app on the threaded werkzeug server (as
+run.py does), and FrontEnd/asgi.py on uvicorn. It then requests /image/<key> for images that are not
+in the memcache, so every request waits LATENCY seconds on an S3 stand-in, from CLIENTS concurrent
+connections at each level, and reports the requests per second, the p50 and p99 latency, the failed
+requests, and the most threads the process had. The images table is a stand-in too.
+
+Needs the ASGI requirements (httpx and uvicorn, in requirements.txt).
+
+Usage:
+    python benchmarks/bench_asgi.py
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3
+import uvicorn
+from botocore.config import Config as BotoConfig
+from werkzeug.serving import make_server
+from FrontEnd import webapp, asgi
+from FrontEnd import main as frontend
+from FrontEnd.metrics import Histogram
+
+LATENCY = 0.05
+OBJECT = bytes(16384)
+CLIENTS = (50, 200, 800)
+REQUESTS_PER_CLIENT = 4
+
+
+class ImageTable:
+    """Stand-in for the images table: every key has an image in S3 under objects/<key>."""
+
+    def get_item(self, Key):
+        return {'Item': {'image_key': Key['image_key'], 'image_path': 'objects/' + Key['image_key']}}
+
+
+async def answerS3(reader, writer):
+    """Answer every request on a connection with OBJECT after LATENCY seconds, keeping it alive."""
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            await asyncio.sleep(LATENCY)
+            status = b'200 OK' if head.startswith(b'GET') else b'404 Not Found'
+            body = OBJECT if status == b'200 OK' else b''
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: image/png\r\nETag: "bench"\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def startS3():
+    """Start the S3 stand-in on an event loop of its own thread and return its port."""
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(answerS3, '127.0.0.1', 0, backlog=4096))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+def startThreaded():
+    """Serve the Flask app on the threaded werkzeug server; return (port, stop)."""
+    server = make_server('127.0.0.1', 0, webapp, threaded=True)
+    server.socket.listen(4096)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port, server.shutdown
+
+
+def startASGI():
+    """Serve the ASGI app on uvicorn; return (port, stop)."""
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=0, log_level='warning',
+                                           backlog=4096, limit_concurrency=None))
+    server.install_signal_handlers = lambda: None
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return port, stop
+
+
+async def fetch(port, key):
+    """GET /image/<key> on a fresh connection; True if it was answered with 200."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(f"GET /image/{key} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+        response = await reader.read()
+        return response.split(b'\r\n', 1)[0].split(b' ')[1] == b'200'
+    finally:
+        writer.close()
+
+
+async def load(port, clients, prefix):
+    """Send clients * REQUESTS_PER_CLIENT requests, clients at a time. Returns (seconds, latency, failed)."""
+    latency = Histogram()
+    failed = 0
+    semaphore = asyncio.Semaphore(clients)
+
+    async def one(i):
+        nonlocal failed
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = await fetch(port, f"{prefix}-{i}")
+            except (OSError, IndexError):
+                ok = False
+            latency.observe(time.perf_counter() - start)
+            failed += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(clients * REQUESTS_PER_CLIENT)))
+    return time.perf_counter() - start, latency, failed
+
+
+def measure(port, clients, prefix):
+    """Run load() while sampling the thread count. Returns (requests/s, p50, p99, failed, peak threads)."""
+    peak = [threading.active_count()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.005):
+            peak[0] = max(peak[0], threading.active_count())
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        seconds, latency, failed = asyncio.run(load(port, clients, prefix))
+    finally:
+        done.set()
+        sampler.join()
+    return latency.count / seconds, latency.quantile(0.5), latency.quantile(0.99), failed, peak[0]
+
+
+def main():
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    s3_port = startS3()
+    saved = frontend.s3_client, getattr(frontend, 'table', None), webapp.before_first_request_funcs
+    webapp.before_first_request_funcs = []
+    frontend.table = ImageTable()
+    frontend.s3_client = boto3.client('s3', endpoint_url='http://127.0.0.1:%d' % s3_port, region_name='us-east-1',
+                                      aws_access_key_id='bench', aws_secret_access_key='bench',
+                                      config=BotoConfig(max_pool_connections=max(CLIENTS),
+                                                        s3={'addressing_style': 'path'}))
+    print("S3 stand-in latency %d ms, %d KB images, %d requests per client" %
+          (LATENCY * 1000, len(OBJECT) // 1024, REQUESTS_PER_CLIENT))
+    print("%8s %8s %10s %8s %8s %8s %8s" % ("mode", "clients", "req/s", "p50 ms", "p99 ms", "failed", "threads"))
+    try:
+        for mode, start in (('threaded', startThreaded), ('asgi', startASGI)):
+            port, stop = start()
+            try:
+                for clients in CLIENTS:
+                    rate, p50, p99, failed, threads = measure(port, clients, f"{mode}-{clients}")
+                    print("%8s %8d %10.0f %8.0f %8.0f %8d %8d" % (mode, clients, rate, p50 * 1000, p99 * 1000,
+                                                                  failed, threads))
+            finally:
+                stop()
+    finally:
+        frontend.s3_client, frontend.table, webapp.before_first_request_funcs = saved
+
+
+if __name__ == '__main__':
+    main()
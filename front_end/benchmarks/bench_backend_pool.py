@@ -0,0 +1,127 @@
+"""Benchmark of the load-balanced back-end pool in FrontEnd/backend_client.py.
+
+Starts several local stand-ins for back_end/run.py. Each one edits a single image at a time (the
+OpenCV work holds the GIL of a back-end process), which is simulated by WORK seconds under a lock.
+CLIENTS front-end threads send edits through editImage to pools of 1, 2 and 4 back ends with each
+balancer, and the benchmark reports the edits per second and the p99 latency. A last round makes one
+of four back ends answer 503 to show that outlier ejection keeps its failures from slowing the others.
+
+To check the same scaling against real back ends, start several on one host, e.g.
+    python back_end/run.py --port 5001 & python back_end/run.py --port 5002 &
+and set backendConfig['endpoints'] to ['http://127.0.0.1:5001', 'http://127.0.0.1:5002'].
+
+Usage:
+    python benchmarks/bench_backend_pool.py
+"""
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FrontEnd import backend_client
+from FrontEnd.backend_client import BackendPool, editImage
+from FrontEnd.metrics import Histogram
+
+WORK = 0.01
+CLIENTS = 16
+REQUESTS = 400
+IMAGE = bytes(16384)
+
+
+class BackendHandler(BaseHTTPRequestHandler):
+    """Answers every POST with the request image after WORK seconds, one request at a time per server."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.answer(200 if not self.server.failing else 503, b'home', 'text/plain')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.failing:
+            self.answer(503, b'', 'text/plain')
+            return
+        with self.server.worker:
+            time.sleep(WORK)
+        self.answer(200, body, 'image/png')
+
+    def answer(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header(backend_client.PROTOCOL_HEADER, 'binary')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startBackend():
+    """Start a stand-in back end and return its server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BackendHandler)
+    server.daemon_threads = True
+    server.worker = threading.Lock()
+    server.failing = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(urls):
+    """Return (edits per second, p99 seconds, failed edits) of REQUESTS edits from CLIENTS threads."""
+    backend_client.client.pool = BackendPool(urls)
+    latency = Histogram()
+    lock = threading.Lock()
+    failed = []
+
+    def edit(_):
+        start = time.perf_counter()
+        try:
+            editImage('/rotate_image', IMAGE, degree=90)
+        except Exception:
+            failed.append(1)
+        with lock:
+            latency.observe(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=CLIENTS) as clients:
+        start = time.perf_counter()
+        list(clients.map(edit, range(REQUESTS)))
+        elapsed = time.perf_counter() - start
+    return REQUESTS / elapsed, latency.quantile(0.99), len(failed)
+
+
+def main():
+    servers = [startBackend() for _ in range(4)]
+    urls = ['http://127.0.0.1:%d' % server.server_address[1] for server in servers]
+    saved = dict(backend_client.backendConfig), backend_client.client.pool
+    # hedging would hide the balancing; the latency of a queueing back end is not a tail to cut
+    backend_client.backendConfig['hedgeRatio'] = 0
+    print("stand-in back ends edit one image at a time in %d ms; %d clients" % (WORK * 1000, CLIENTS))
+    print("%10s %18s %12s %10s %8s" % ("back ends", "balancer", "edits/s", "p99 ms", "failed"))
+    try:
+        for balancer in ('least_outstanding', 'p2c'):
+            backend_client.backendConfig['balancer'] = balancer
+            for count in (1, 2, 4):
+                rate, p99, failed = run(urls[:count])
+                print("%10d %18s %12.0f %10.0f %8d" % (count, balancer, rate, p99 * 1000, failed))
+        backend_client.backendConfig['balancer'] = 'least_outstanding'
+        servers[0].failing = True
+        rate, p99, failed = run(urls)
+        print("%10s %18s %12.0f %10.0f %8d" % ("3+1 (503)", 'least_outstanding', rate, p99 * 1000, failed))
+        print("ejected: %s" % [url for url, backend in backend_client.client.pool.snapshot().items()
+                               if backend['ejected']])
+    finally:
+        backend_client.backendConfig.clear()
+        backend_client.backendConfig.update(saved[0])
+        backend_client.client.pool = saved[1]
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark of '/upload' against '/upload/bulk' for importing an album.
+
+Uploads ITEMS new images through the Flask test client, once with one '/upload' request per image and
+once with a single '/upload/bulk' request, and reports the seconds each took. S3 and the two DynamoDB
+tables are in-memory stand-ins that sleep LATENCY seconds per call, like a round trip to AWS; the
+stand-in batch_writer sleeps once per 25 items, like BatchWriteItem.
+
+Usage:
+    python benchmarks/bench_bulk_upload.py
+"""
+import io
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FrontEnd import webapp
+from FrontEnd import main as frontend
+
+LATENCY = 0.01
+ITEMS = 50
+
+
+class S3:
+    """Stand-in for the S3 client."""
+
+    def put_object(self, **kwargs):
+        time.sleep(LATENCY)
+
+    def upload_fileobj(self, source, bucket, key, ExtraArgs=None, Config=None):
+        time.sleep(LATENCY)
+
+
+class BatchWriter:
+    """Stand-in for table.batch_writer(), sending a request per 25 items."""
+
+    def __init__(self):
+        self.items = 0
+
+    def __enter__(self):
+        return self
+
+    def put_item(self, Item):
+        self.items += 1
+        if self.items % 25 == 0:
+            time.sleep(LATENCY)
+
+    def __exit__(self, *exc_info):
+        if self.items % 25:
+            time.sleep(LATENCY)
+
+
+class Table:
+    """Stand-in for both DynamoDB tables: every key is new."""
+
+    name = 'images'
+
+    def update_item(self, Key, ReturnValues='NONE', **kwargs):
+        time.sleep(LATENCY)
+        return {'Attributes': dict(Key, refs=1)} if ReturnValues == 'ALL_NEW' else {}
+
+    def batch_writer(self):
+        return BatchWriter()
+
+
+class DynamoDB:
+    """Stand-in for the DynamoDB resource."""
+
+    def batch_get_item(self, RequestItems):
+        time.sleep(LATENCY)
+        return {'Responses': {}}
+
+
+def album(prefix):
+    """ITEMS distinct (key, image) pairs."""
+    return [(f"{prefix}-{i}", b'image %d of %s' % (i, prefix.encode())) for i in range(ITEMS)]
+
+
+def main():
+    client = webapp.test_client()
+    patches = [patch.object(webapp, 'before_first_request_funcs', []),
+               patch.object(frontend, 's3_client', S3()), patch.object(frontend, 'dynamodb', DynamoDB()),
+               patch.object(frontend, 'table', Table(), create=True),
+               patch.object(frontend, 'objects_table', Table(), create=True)]
+    for patcher in patches:
+        patcher.start()
+    try:
+        print("%d new images, %d ms per AWS call" % (ITEMS, LATENCY * 1000))
+        start = time.perf_counter()
+        for image_key, data in album('single'):
+            client.post('/upload', data={'key': image_key, 'file': (io.BytesIO(data), 'a.raw')})
+        print("%-14s %8.2f s" % ("/upload", time.perf_counter() - start))
+        items = album('bulk')
+        start = time.perf_counter()
+        response = client.post('/upload/bulk', data={'key': [image_key for image_key, _ in items],
+                                                     'file': [(io.BytesIO(data), 'a.raw') for _, data in items]})
+        print("%-14s %8.2f s  (%d uploaded)" % ("/upload/bulk", time.perf_counter() - start,
+                                                response.get_json()['uploaded']))
+    finally:
+        for patcher in patches:
+            patcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark of the consistent-hashing memcache node pool.
+
+Starts local cache node processes (python -m FrontEnd.cachenode), spreads a fixed total capacity
+over 1, 2 and 4 of them and replays a Zipf workload through NodePoolCache: a GET, and a PUT after
+every miss. For each pool size it reports the hit rate, throughput and GET latency percentiles,
+then adds one more node and reports the hit rate of the next pass, which drops by roughly the
+1/(N+1) share of keys that moved to the new node.
+
+Usage:
+    python benchmarks/bench_cachenodes.py
+"""
+import os
+import sys
+import bisect
+import itertools
+import random
+import subprocess
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FrontEnd.cachenode import NodePoolCache
+
+TOTAL_CAPACITY_MB = 64
+VALUE = bytes(16384)
+KEYS = 20000
+OPS = 20000
+# cumulative Zipf(0.9) weights over KEYS keys
+ZIPF = list(itertools.accumulate(1 / (rank ** 0.9) for rank in range(1, KEYS + 1)))
+
+
+def startNode(capacity):
+    """Start one cache node process on a free port. Returns (process, 'host:port')."""
+    process = subprocess.Popen([sys.executable, '-m', 'FrontEnd.cachenode', '--host', '127.0.0.1',
+                                '--port', '0', '--capacity', str(capacity)],
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    return process, line.rsplit(' ', 1)[1].strip()
+
+
+def replay(pool, rng):
+    """Run OPS Zipf-distributed lookups. Returns (hit rate, ops/s, sorted GET latencies)."""
+    hits = 0
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(OPS):
+        image_key = 'key%d' % bisect.bisect(ZIPF, rng.random() * ZIPF[-1])
+        begin = time.perf_counter()
+        value = pool.get(image_key)
+        latencies.append(time.perf_counter() - begin)
+        if value is None:
+            pool.put(image_key, VALUE, len(VALUE))
+        else:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return hits / OPS, OPS / elapsed, latencies
+
+
+def main():
+    print("%6s %10s %10s %10s %10s %18s" % ("nodes", "hit rate", "ops/s", "p50 ms", "p99 ms", "hit rate +1 node"))
+    for node_count in (1, 2, 4):
+        processes = []
+        try:
+            nodes = []
+            for _ in range(node_count + 1):
+                process, address = startNode(TOTAL_CAPACITY_MB / node_count)
+                processes.append(process)
+                nodes.append(address)
+            pool = NodePoolCache(nodes[:node_count])
+            rng = random.Random(1)
+            replay(pool, rng)
+            hit_rate, throughput, latencies = replay(pool, rng)
+            pool.add_node(nodes[-1])
+            hit_rate_after, _, _ = replay(pool, rng)
+            print("%6d %10.3f %10.0f %10.3f %10.3f %18.3f" % (
+                node_count, hit_rate, throughput, latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000, hit_rate_after))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark of the binary and JSON wire formats between the front end and the back-end edit service.
+
+Starts a local stand-in for the back end that answers /rotate_image in both formats exactly like
+back_end/back/editfunc.py does, minus the OpenCV work: it decodes the request, and returns the image
+it got as the edited image. JSON requests are answered like an older back end would, so the front end
+keeps sending JSON. The front end sends images of several sizes through editImage in each format,
+and the benchmark reports per MB of image the wall time of a round trip, the CPU time spent on both
+sides (the stand-in runs in this process) and the bytes sent over the connection.
+
+Usage:
+    python benchmarks/bench_edit_protocol.py
+"""
+import os
+import sys
+import json
+import time
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FrontEnd import backend_client
+from FrontEnd.backend_client import editImage
+
+SIZES_MB = (0.25, 1, 4, 16)
+ROUNDS = 5
+
+
+class EditHandler(BaseHTTPRequestHandler):
+    """Answers every POST in the wire format of the request, with the request image as the result."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    received = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        EditHandler.received += len(body)
+        if self.headers['Content-Type'] == 'application/json':
+            params = json.loads(body)
+            image = base64.b64decode(params.pop('image_path'))
+            payload = json.dumps({'image_string': base64.b64encode(image).decode('utf-8')}).encode()
+            content_type = 'application/json'
+        else:
+            payload = body
+            content_type = 'image/png'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        if content_type == 'image/png':
+            # JSON requests are answered like a back end without the binary format, so they stay JSON
+            self.send_header(backend_client.PROTOCOL_HEADER, 'binary')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(base_url, image, binary):
+    """Return (wall seconds, CPU seconds, request bytes) of one round trip, averaged over ROUNDS."""
+    backend_client.protocols[base_url] = binary
+    editImage('/rotate_image', image, degree=90)
+    EditHandler.received = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(ROUNDS):
+        content, results = editImage('/rotate_image', image, degree=90)
+        assert content == image
+    return ((time.perf_counter() - wall) / ROUNDS, (time.process_time() - cpu) / ROUNDS,
+            EditHandler.received / ROUNDS)
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EditHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    backend_client.client.pool.set_endpoints([base_url])
+    print("%8s %8s %14s %14s %14s" % ("size MB", "format", "wall ms/MB", "CPU ms/MB", "sent bytes/MB"))
+    try:
+        for size in SIZES_MB:
+            image = os.urandom(int(size * 1048576))
+            rows = {}
+            for name, binary in (('json', False), ('binary', True)):
+                wall, cpu, sent = measure(base_url, image, binary)
+                rows[name] = (wall, cpu)
+                print("%8g %8s %14.2f %14.2f %14.0f" % (size, name, wall * 1000 / size, cpu * 1000 / size,
+                                                       sent / size))
+            print("%8g %8s %14.2f %14.2f" % (size, "saved", (rows['json'][0] - rows['binary'][0]) * 1000 / size,
+                                             (rows['json'][1] - rows['binary'][1]) * 1000 / size))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
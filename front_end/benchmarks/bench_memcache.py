@@ -0,0 +1,130 @@
+"""Microbenchmark for the front-end memcache.
+
+Fills the cache with a growing number of entries and times subPUT calls that each force an
+eviction, followed by subGET hits. With constant-time eviction the per-operation latency stays
+flat as the entry count grows.
+
+A second table runs a mixed GET/PUT workload from a growing number of threads, once with a
+single lock (1 shard) and once with the configured lock-striped shards, and reports throughput.
+
+A third table times PUTs of mixed-size images into a full cache, once with eviction done inline by
+each PUT and once with the background sweeper keeping the cache below its watermark.
+
+Usage:
+    python benchmarks/bench_memcache.py
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FrontEnd import config
+from FrontEnd import memcache as memcache_module
+from FrontEnd.memcache import POLICIES, ShardedMemCache, memcache, entrySize, subPUT, subGET, subCLEAR
+
+VALUE = bytes(1024)
+OPS = 20000
+
+
+def bench(entries):
+    """Return (put_us, get_us): mean microseconds per evicting PUT and per GET hit."""
+    subCLEAR()
+    value_size = entrySize('key%d' % entries, VALUE)
+    config.memcacheConfig['capacity'] = entries * value_size / 1048576
+    for i in range(entries):
+        subPUT('key%d' % i, VALUE)
+
+    start = time.perf_counter()
+    for i in range(entries, entries + OPS):
+        subPUT('key%d' % i, VALUE)
+    put_us = (time.perf_counter() - start) / OPS * 1e6
+
+    start = time.perf_counter()
+    for i in range(entries + OPS - 1, entries - 1, -1):
+        subGET('key%d' % i)
+    get_us = (time.perf_counter() - start) / OPS * 1e6
+    return put_us, get_us
+
+
+def bench_threads(shards, thread_count, ops_per_thread=20000):
+    """Return operations per second for a 90% GET / 10% PUT workload run from thread_count threads."""
+    memcache_module.memcache = ShardedMemCache(shards)
+    config.memcacheConfig['capacity'] = 64
+    for i in range(5000):
+        subPUT('key%d' % i, VALUE)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(ops_per_thread):
+            image_key = 'key%d' % int(rng.paretovariate(1.1) * 10)
+            if rng.random() < 0.9:
+                if not subGET(image_key):
+                    subPUT(image_key, VALUE)
+            else:
+                subPUT(image_key, VALUE)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(thread_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return thread_count * ops_per_thread / (time.perf_counter() - start)
+
+
+def bench_sweeper(sweeper, puts=20000):
+    """Return (p50_us, p99_us, max_us) of PUTs into a full cache, arriving in bursts of 50."""
+    memcache_module.memcache = ShardedMemCache(config.memcacheConfig.get('shards', 16))
+    config.memcacheConfig.update({'capacity': 64, 'sweepInterval': 0.001})
+    rng = random.Random(1)
+    for i in range(8000):
+        subPUT('fill%d' % i, bytes(rng.randint(1024, 16384)))
+    stop = memcache_module.startSweeper() if sweeper else None
+    latencies = []
+    try:
+        for i in range(puts):
+            value = bytes(rng.randint(1024, 65536))
+            start = time.perf_counter()
+            subPUT('key%d' % i, value)
+            latencies.append(time.perf_counter() - start)
+            if i % 50 == 49:
+                time.sleep(0.002)
+    finally:
+        if stop is not None:
+            stop.set()
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6, latencies[-1] * 1e6
+
+
+def main():
+    saved = dict(config.memcacheConfig)
+    print("%10s %10s %14s %14s" % ("policy", "entries", "put us/op", "get us/op"))
+    try:
+        for policy in POLICIES:
+            config.memcacheConfig['policy'] = policy
+            for entries in (1000, 10000, 50000, 100000):
+                put_us, get_us = bench(entries)
+                print("%10s %10d %14.2f %14.2f  (cached: %d)" % (policy, entries, put_us, get_us, len(memcache)))
+
+        config.memcacheConfig['policy'] = 'LRU'
+        shards = saved.get('shards', 16)
+        print()
+        print("%10s %16s %16s" % ("threads", "1 shard ops/s", "%d shards ops/s" % shards))
+        for thread_count in (1, 2, 4, 8, 16):
+            print("%10d %16.0f %16.0f" % (thread_count, bench_threads(1, thread_count), bench_threads(shards, thread_count)))
+
+        print()
+        print("%16s %10s %10s %10s" % ("full-cache PUT", "p50 us", "p99 us", "max us"))
+        for label, sweeper in (("inline evict", False), ("sweeper", True)):
+            print("%16s %10.1f %10.1f %10.1f" % ((label,) + bench_sweeper(sweeper)))
+    finally:
+        memcache_module.memcache = memcache
+        subCLEAR()
+        config.memcacheConfig.update(saved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark of the shared S3 client of FrontEnd/main.py under concurrent image requests.
+
+Starts a local S3 stand-in, an HTTP server that answers every GetObject after an injected delay,
+and points a boto3 client at it. It then reads pages of objects one by one (as get_images did) and
+with one request thread per object, as a browser loading a gallery page through '/image' does, for
+several connection pool sizes, and reports the wall time per page.
+
+Usage:
+    python benchmarks/bench_s3_fetch.py
+"""
+import os
+import sys
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3
+from botocore.config import Config as BotoConfig
+from FrontEnd import main as frontend
+
+LATENCY = 0.02
+JITTER = 0.01
+OBJECT = bytes(32768)
+PAGES = 10
+
+
+class SlowS3Handler(BaseHTTPRequestHandler):
+    """Answers every GET with OBJECT after LATENCY plus up to JITTER seconds."""
+
+    protocol_version = 'HTTP/1.1'
+    # like S3, do not hold back the last segment of a response until the client ACKs (delayed ACK
+    # would add 40 ms to every object on a reused connection)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(LATENCY + random.random() * JITTER)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(OBJECT)))
+        self.send_header('ETag', '"bench"')
+        self.end_headers()
+        self.wfile.write(OBJECT)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def useClient(endpoint, connections):
+    """Point the front end at the stand-in with a pool of `connections` connections."""
+    frontend.s3_client = boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1',
+                                      aws_access_key_id='bench', aws_secret_access_key='bench',
+                                      config=BotoConfig(max_pool_connections=connections,
+                                                        s3={'addressing_style': 'path'}))
+
+
+def readObject(path):
+    """Read one object through the front end's client, as the '/image' route does on a cache miss."""
+    return frontend.s3_client.get_object(Bucket=frontend.bucket_name, Key=path)['Body'].read()
+
+
+def readConcurrently(paths):
+    """Read the objects of a page with one request thread each."""
+    with ThreadPoolExecutor(max_workers=len(paths)) as requests:
+        return list(requests.map(readObject, paths))
+
+
+def timePages(fetch, page_size):
+    """Return the mean seconds per page of page_size objects."""
+    start = time.perf_counter()
+    for page in range(PAGES):
+        fetch(['image/%d-%d.jpg' % (page, i) for i in range(page_size)])
+    return (time.perf_counter() - start) / PAGES
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowS3Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = 'http://127.0.0.1:%d' % server.server_address[1]
+    saved = frontend.s3_client
+    print("S3 stand-in latency %d-%d ms per object" % (LATENCY * 1000, (LATENCY + JITTER) * 1000))
+    print("%10s %14s %14s %14s %14s" % ("page size", "sequential ms", "4 conns ms", "16 conns ms", "32 conns ms"))
+    try:
+        for page_size in (4, 16, 64):
+            useClient(endpoint, 1)
+            row = [timePages(lambda paths: [readObject(path) for path in paths], page_size)]
+            for connections in (4, 16, 32):
+                useClient(endpoint, connections)
+                timePages(readConcurrently, page_size)  # open the pooled connections first
+                row.append(timePages(readConcurrently, page_size))
+            print("%10d %14.1f %14.1f %14.1f %14.1f" % ((page_size,) + tuple(seconds * 1000 for seconds in row)))
+    finally:
+        frontend.s3_client = saved
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Trace-driven benchmark of the front-end memcache replacement policies.
+
+Replays access traces through subGET/subPUT against every policy in POLICIES and several cache
+capacities, and reports for each run the hit ratio, byte hit ratio, operations per second and the
+99th percentile operation latency. GETs are read-through: a miss is followed by a PUT of the image,
+as the /key route does after fetching it from S3.
+
+Synthetic traces (generated with a fixed seed, so runs are comparable):
+
+    zipf    Zipf(0.9) popularity over 20000 images of 16 KB
+    scan    the zipf trace with a one-off sequential scan of 2000 new images after every 5000 requests
+    mixed   Zipf(0.9) popularity over images of 1 KB to 2 MB (log-uniform, independent of popularity)
+
+Recorded traces are CSV files written by the front end when memcacheConfig['tracePath'] is set
+(time, op, key, size per row) and are passed with --trace.
+
+Capacities are fractions of the bytes of all distinct images in the trace. With --save the results
+are written to a JSON file; with --baseline the run fails if any hit ratio dropped by more than
+--tolerance against such a file, so a cache regression can be caught before shipping. Everything
+runs in-process, with no AWS access.
+
+Usage:
+    python benchmarks/bench_traces.py
+    python benchmarks/bench_traces.py --trace access.csv --capacities 0.05 0.2
+    python benchmarks/bench_traces.py --save baseline.json
+    python benchmarks/bench_traces.py --baseline baseline.json
+"""
+import os
+import sys
+import csv
+import json
+import math
+import time
+import bisect
+import random
+import argparse
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FrontEnd import config
+from FrontEnd import memcache as memcache_module
+from FrontEnd.memcache import POLICIES, ShardedMemCache, subPUT, subGET
+
+IMAGES = 20000
+
+
+def zipfSampler(count, skew, rng):
+    """Return a function drawing ranks 0..count-1 with Zipf(skew) probabilities."""
+    weights = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, count + 1)))
+    return lambda: bisect.bisect(weights, rng.random() * weights[-1])
+
+
+def zipfTrace(requests, seed=1):
+    rng = random.Random(seed)
+    sample = zipfSampler(IMAGES, 0.9, rng)
+    return [('GET', 'img%d' % sample(), 16384) for _ in range(requests)]
+
+
+def scanTrace(requests, seed=1):
+    trace = []
+    for i, row in enumerate(zipfTrace(requests, seed)):
+        trace.append(row)
+        if i % 5000 == 4999:
+            trace.extend(('GET', 'scan%d-%d' % (i, j), 16384) for j in range(2000))
+    return trace[:requests]
+
+
+def mixedTrace(requests, seed=1):
+    rng = random.Random(seed)
+    sample = zipfSampler(IMAGES, 0.9, rng)
+    sizes = [int(math.exp(rng.uniform(math.log(1024), math.log(2097152)))) for _ in range(IMAGES)]
+    return [('GET', 'img%d' % rank, sizes[rank]) for rank in (sample() for _ in range(requests))]
+
+
+SYNTHETIC = {'zipf': zipfTrace, 'scan': scanTrace, 'mixed': mixedTrace}
+
+
+def loadTrace(path):
+    """
+    Read a recorded trace. A GET that missed was recorded with size 0; it gets the size of the next PUT
+    of the same key (the read-through that followed it), and that PUT is dropped since replaying the
+    GET already does it.
+    """
+    with open(path, newline='') as file:
+        rows = [(op, image_key, int(size)) for timestamp, op, image_key, size in csv.reader(file)]
+    trace = []
+    pending = {}
+    known = {}
+    for op, image_key, size in rows:
+        if op == 'GET':
+            if size:
+                known[image_key] = size
+            else:
+                pending[image_key] = len(trace)
+            trace.append([op, image_key, size or known.get(image_key, 0)])
+        elif op == 'PUT':
+            known[image_key] = size
+            if image_key in pending:
+                trace[pending.pop(image_key)][2] = size
+            else:
+                trace.append([op, image_key, size])
+    return [tuple(row) for row in trace if row[2]]
+
+
+def replay(trace, policy, capacity_bytes, payloads):
+    """Replay trace against an empty cache. Returns a dict of the measured metrics."""
+    config.memcacheConfig.update({'policy': policy, 'capacity': capacity_bytes / 1048576})
+    memcache_module.memcache = ShardedMemCache(config.memcacheConfig.get('shards', 16))
+    gets = hits = requested_bytes = hit_bytes = 0
+    latencies = []
+    start = time.perf_counter()
+    for op, image_key, size in trace:
+        payload = payloads[size]
+        begin = time.perf_counter()
+        if op == 'PUT':
+            subPUT(image_key, payload)
+        else:
+            gets += 1
+            requested_bytes += size
+            if subGET(image_key):
+                hits += 1
+                hit_bytes += size
+            else:
+                subPUT(image_key, payload)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'hit_ratio': hits / gets if gets else 0.0,
+            'byte_hit_ratio': hit_bytes / requested_bytes if requested_bytes else 0.0,
+            'ops_per_second': len(trace) / elapsed,
+            'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay cache traces against every memcache policy.")
+    parser.add_argument('--trace', action='append', default=[], help="recorded trace CSV (repeatable)")
+    parser.add_argument('--synthetic', nargs='*', default=list(SYNTHETIC), choices=list(SYNTHETIC))
+    parser.add_argument('--requests', type=int, default=50000, help="requests per synthetic trace")
+    parser.add_argument('--capacities', type=float, nargs='+', default=[0.01, 0.05, 0.2],
+                        help="cache capacities as fractions of the distinct bytes in the trace")
+    parser.add_argument('--policies', nargs='+', default=list(POLICIES), choices=list(POLICIES))
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="fail if a hit ratio dropped against this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.01)
+    args = parser.parse_args(argv)
+
+    traces = {name: SYNTHETIC[name](args.requests) for name in args.synthetic}
+    traces.update({os.path.basename(path): loadTrace(path) for path in args.trace})
+
+    saved_config = dict(config.memcacheConfig)
+    saved_cache = memcache_module.memcache
+    # rejecting oversized images is part of the policies under test, TTLs and tracing are not
+    config.memcacheConfig.update({'ttl': None, 'tracePath': None})
+    results = {}
+    print("%-12s %10s %9s %10s %10s %12s %10s" % ("trace", "policy", "capacity", "hit ratio", "byte hit", "ops/s",
+                                                  "p99 us"))
+    try:
+        for name, trace in traces.items():
+            distinct = {}
+            for op, image_key, size in trace:
+                distinct[image_key] = size
+            payloads = {size: bytes(size) for size in set(distinct.values())}
+            for fraction in args.capacities:
+                for policy in args.policies:
+                    result = replay(trace, policy, sum(distinct.values()) * fraction, payloads)
+                    results['%s/%s/%g' % (name, policy, fraction)] = result
+                    print("%-12s %10s %9g %10.4f %10.4f %12.0f %10.1f" % (
+                        name, policy, fraction, result['hit_ratio'], result['byte_hit_ratio'],
+                        result['ops_per_second'], result['p99_us']))
+    finally:
+        memcache_module.memcache = saved_cache
+        config.memcacheConfig.clear()
+        config.memcacheConfig.update(saved_config)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = ['%s: hit ratio %.4f < baseline %.4f' % (run, results[run]['hit_ratio'], expected['hit_ratio'])
+                       for run, expected in baseline.items()
+                       if run in results and results[run]['hit_ratio'] < expected['hit_ratio'] - args.tolerance]
+        for line in regressions:
+            print("REGRESSION " + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())